@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark add_event_handler, remove_event_handler and fire_event on EventDispatcher.
+
+Every combination of the scenario options is run and the results are written as JSON, so two
+runs can be compared with --compare. Handlers are either plain functions, return an already
+fired Deferred or are coroutines yielding one, so nothing needs the reactor to be running.
+
+Example::
+
+    python benchmarks/dispatcher_benchmark.py --handler-counts 10 1000 100000 \\
+        --output before.json
+    python benchmarks/dispatcher_benchmark.py --handler-counts 10 1000 100000 \\
+        --compare before.json
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+import timeit
+
+from twisted.internet import defer
+
+# Run from a checkout without the package being installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from oni.twisted_event_dispatcher import EventDispatcher  # noqa: E402
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+def percentiles(samples):
+    '''
+    :returns: dict of summary statistics in microseconds for a list of durations in seconds
+    '''
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def percentile(fraction):
+        '''Nearest rank percentile'''
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1e6
+
+    return {
+        'count': len(samples),
+        'mean_us': sum(samples) / len(samples) * 1e6,
+        'p50_us': percentile(0.50),
+        'p90_us': percentile(0.90),
+        'p99_us': percentile(0.99),
+        'max_us': samples[-1] * 1e6,
+        'ops_per_second': len(samples) / sum(samples) if sum(samples) else None,
+    }
+
+
+class _Handler(object):
+    '''
+    Callable handler. An instance so it can be weakly referenced and kept alive by the
+    benchmark.
+    '''
+    def __init__(self, return_deferred):
+        self._return_deferred = return_deferred
+
+    def __call__(self, event):
+        if self._return_deferred:
+            return defer.succeed(None)
+        return None
+
+
+class _CoroutineHandler(object):
+    '''
+    Handler whose handle method is a coroutine, run by the dispatcher as with inlineCallbacks.
+    An instance so the method can be weakly referenced and kept alive by the benchmark.
+    '''
+    def handle(self, event):
+        '''
+        Coroutine yielding an already fired Deferred
+        '''
+        yield defer.succeed(None)
+
+
+class Scenario(object):
+    '''
+    A single combination of benchmark options
+    '''
+    def __init__(
+            self, handler_count, keyword_count, wildcard_ratio, phase_count, handler_kind,
+            use_weakref, index_engine, plan_cache_size, value_cardinality, fire_count,
+            modify_count, seed):
+        self.handler_count = handler_count
+        self.keyword_count = keyword_count
+        self.wildcard_ratio = wildcard_ratio
+        self.phase_count = phase_count
+        self.handler_kind = handler_kind
+        self.use_weakref = use_weakref
+        self.index_engine = index_engine
+        self.plan_cache_size = plan_cache_size
+        self.value_cardinality = value_cardinality
+        self.fire_count = fire_count
+        self.modify_count = modify_count
+        self.random = random.Random(seed)
+
+        self.keywords = tuple('keyword_{}'.format(index) for index in range(keyword_count))
+        self.phases = tuple('phase_{}'.format(index) for index in range(phase_count))
+        self.handlers = []
+
+    def parameters(self):
+        '''
+        :returns: dict describing the scenario
+        '''
+        return {
+            'handler_count': self.handler_count,
+            'keyword_count': self.keyword_count,
+            'wildcard_ratio': self.wildcard_ratio,
+            'phase_count': self.phase_count,
+            'handler_kind': self.handler_kind,
+            'use_weakref': self.use_weakref,
+            'index_engine': self.index_engine,
+            'plan_cache_size': self.plan_cache_size,
+            'value_cardinality': self.value_cardinality,
+        }
+
+    def key(self):
+        '''
+        :returns: String uniquely identifying the scenario parameters, used to compare runs.
+        '''
+        return json.dumps(self.parameters(), sort_keys=True)
+
+    def match_spec(self):
+        '''
+        :returns: Random match_spec for a handler
+        '''
+        return {
+            keyword: (
+                None if self.random.random() < self.wildcard_ratio
+                else self.random.randrange(self.value_cardinality))
+            for keyword in self.keywords}
+
+    def event_details(self):
+        '''
+        :returns: Random event_details for an event
+        '''
+        return {
+            keyword: self.random.randrange(self.value_cardinality)
+            for keyword in self.keywords}
+
+    def new_handler(self):
+        '''
+        :returns: New handler that will be kept alive for the duration of the scenario
+        '''
+        if self.handler_kind == 'coroutine':
+            handler = _CoroutineHandler()
+            self.handlers.append(handler)
+            return handler.handle
+        handler = _Handler(self.handler_kind == 'deferred')
+        self.handlers.append(handler)
+        return handler
+
+    def add(self, dispatcher):
+        '''
+        Add a random handler
+
+        :returns: (duration, handler_id)
+        '''
+        handler = self.new_handler()
+        phase = self.random.choice(self.phases)
+        match_spec = self.match_spec()
+        started = timeit.default_timer()
+        add_deferred = dispatcher.add_event_handler(
+            handler, phase, use_weakref=self.use_weakref, **match_spec)
+        duration = timeit.default_timer() - started
+        return duration, add_deferred.result
+
+    def run(self):
+        '''
+        Run scenario
+
+        :returns: dict of results
+        '''
+        dispatcher = EventDispatcher(
+            self.keywords,
+            phases=self.phases,
+            plan_cache_size=self.plan_cache_size,
+            index_engine=self.index_engine)
+        dispatcher.start()
+
+        add_samples = []
+        handler_ids = []
+        populate_started = timeit.default_timer()
+        for _ in range(self.handler_count):
+            duration, handler_id = self.add(dispatcher)
+            add_samples.append(duration)
+            handler_ids.append(handler_id)
+        populate_duration = timeit.default_timer() - populate_started
+
+        fire_samples = []
+        matched = 0
+        gc.collect()
+        for _ in range(self.fire_count):
+            event_details = self.event_details()
+            started = timeit.default_timer()
+            fire_deferred = dispatcher.fire_event(None, **event_details)
+            fire_samples.append(timeit.default_timer() - started)
+            assert fire_deferred.called, 'Benchmark handlers should complete synchronously'
+        for _ in range(min(self.fire_count, 100)):
+            phase_plan = dispatcher._resolve_phase_plan(self.event_details())
+            matched += sum(len(event_handlers) for event_handlers in phase_plan.itervalues())
+
+        remove_samples = []
+        for handler_id in self.random.sample(
+                handler_ids, min(self.modify_count, len(handler_ids))):
+            started = timeit.default_timer()
+            dispatcher.remove_event_handler(handler_id)
+            remove_samples.append(timeit.default_timer() - started)
+
+        memory_stats = dispatcher.memory_stats()
+        dispatcher.stop()
+        del self.handlers[:]
+
+        return {
+            'parameters': self.parameters(),
+            'populate_seconds': populate_duration,
+            'add_event_handler': percentiles(add_samples),
+            'remove_event_handler': percentiles(remove_samples),
+            'fire_event': percentiles(fire_samples),
+            'mean_handlers_matched': float(matched) / max(1, min(self.fire_count, 100)),
+            'memory_stats': memory_stats,
+        }
+
+
+def compare(baseline, results):
+    '''
+    Print the change in median fire_event latency and add/remove throughput from baseline.
+    '''
+    baseline_by_key = {
+        json.dumps(result['parameters'], sort_keys=True): result
+        for result in baseline['results']}
+    for result in results['results']:
+        key = json.dumps(result['parameters'], sort_keys=True)
+        if key not in baseline_by_key:
+            continue
+        old = baseline_by_key[key]
+        print(key)
+        for operation in ('add_event_handler', 'fire_event', 'remove_event_handler'):
+            old_p50 = old[operation].get('p50_us')
+            new_p50 = result[operation].get('p50_us')
+            if not old_p50 or new_p50 is None:
+                continue
+            print('    {:<22} p50 {:>10.2f}us -> {:>10.2f}us ({:+.1f}%)'.format(
+                operation, old_p50, new_p50, (new_p50 - old_p50) / old_p50 * 100))
+
+
+def parse_args(argv):
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--handler-counts', type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument('--keyword-counts', type=int, nargs='+', default=[2])
+    parser.add_argument('--wildcard-ratios', type=float, nargs='+', default=[0.5])
+    parser.add_argument('--phase-counts', type=int, nargs='+', default=[3])
+    parser.add_argument(
+        '--handler-kinds', nargs='+', choices=('sync', 'deferred', 'coroutine'),
+        default=['sync'])
+    parser.add_argument(
+        '--weakref', nargs='+', choices=('strong', 'weak'), default=['weak'])
+    parser.add_argument(
+        '--index-engines', nargs='+', choices=('set', 'bitset'), default=['set'])
+    parser.add_argument('--plan-cache-sizes', type=int, nargs='+', default=[1024])
+    parser.add_argument(
+        '--value-cardinality', type=int, default=100,
+        help='Number of distinct values each keyword can take')
+    parser.add_argument('--fire-count', type=int, default=1000)
+    parser.add_argument(
+        '--modify-count', type=int, default=1000,
+        help='Maximum number of handlers to time removing')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    '''
+    Run benchmark
+    '''
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    results = []
+    for (handler_count, keyword_count, wildcard_ratio, phase_count, handler_kind, weakref_mode,
+         index_engine, plan_cache_size) in itertools.product(
+            args.handler_counts, args.keyword_counts, args.wildcard_ratios, args.phase_counts,
+            args.handler_kinds, args.weakref, args.index_engines, args.plan_cache_sizes):
+        scenario = Scenario(
+            handler_count=handler_count,
+            keyword_count=keyword_count,
+            wildcard_ratio=wildcard_ratio,
+            phase_count=phase_count,
+            handler_kind=handler_kind,
+            use_weakref=weakref_mode == 'weak',
+            index_engine=index_engine,
+            plan_cache_size=plan_cache_size,
+            value_cardinality=args.value_cardinality,
+            fire_count=args.fire_count,
+            modify_count=args.modify_count,
+            seed=args.seed)
+        sys.stderr.write('Running {}\n'.format(scenario.key()))
+        results.append(scenario.run())
+
+    output = {
+        'python': sys.version,
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(json.load(baseline_file), output)
+
+
+if __name__ == '__main__':
+    main()
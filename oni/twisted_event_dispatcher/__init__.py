@@ -7,3 +7,23 @@ Establish external interface of twisted_event_dispatcher
 from oni.twisted_event_dispatcher._dispatcher import EventDispatcher
 from oni.twisted_event_dispatcher.interfaces import IEventDispatcher
 from oni.twisted_event_dispatcher.interfaces import IBackgroundUtility
+from oni.twisted_event_dispatcher.coalescing import Coalesce
+from oni.twisted_event_dispatcher.errors import DispatchQueueFull
+from oni.twisted_event_dispatcher.errors import EventDispatcherError
+from oni.twisted_event_dispatcher.errors import EventDropped
+from oni.twisted_event_dispatcher.errors import ExecutorQueueFull
+from oni.twisted_event_dispatcher.errors import HandlerTimeout
+from oni.twisted_event_dispatcher.errors import RemoteHandlerError
+from oni.twisted_event_dispatcher.errors import ShardWorkerLost
+from oni.twisted_event_dispatcher.errors import SubscriptionClosed
+from oni.twisted_event_dispatcher.executors import ProcessPoolExecutor
+from oni.twisted_event_dispatcher.executors import ReactorExecutor
+from oni.twisted_event_dispatcher.executors import ThreadPoolExecutor
+from oni.twisted_event_dispatcher.instrumentation import CallbackSink
+from oni.twisted_event_dispatcher.journal import EventJournal
+from oni.twisted_event_dispatcher.instrumentation import InMemorySink
+from oni.twisted_event_dispatcher.matchers import OneOf
+from oni.twisted_event_dispatcher.matchers import Prefix
+from oni.twisted_event_dispatcher.matchers import Range
+from oni.twisted_event_dispatcher.sharding import ShardedEventDispatcher
+from oni.twisted_event_dispatcher.subscriptions import Subscription
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control for events waiting to be dispatched
+"""
+import bisect
+import collections
+import itertools
+import logging
+import timeit
+
+from twisted.internet import defer
+
+from oni.twisted_event_dispatcher.errors import DispatchQueueFull
+from oni.twisted_event_dispatcher.errors import EventDropped
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_WAIT = 'wait'
+
+
+class _PriorityFifo(object):
+    '''
+    FIFO for each priority. Items are stored with a sequence number so the oldest item across
+    every priority can be found.
+    '''
+    def __init__(self):
+        self._fifos = {}
+        # Priorities with items, ascending
+        self._priorities = []
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, priority, sequence, item):
+        '''
+        Add item to the back of the FIFO for priority
+        '''
+        fifo = self._fifos.get(priority)
+        if fifo is None:
+            fifo = self._fifos[priority] = collections.deque()
+            bisect.insort(self._priorities, priority)
+        fifo.append((sequence, item))
+        self._length += 1
+
+    def pop(self, priority):
+        '''
+        :returns: (sequence, item) of the oldest item with priority
+        '''
+        fifo = self._fifos[priority]
+        sequenced_item = fifo.popleft()
+        if not fifo:
+            del self._fifos[priority]
+            self._priorities.remove(priority)
+        self._length -= 1
+        return sequenced_item
+
+    def highest_priority(self):
+        '''
+        :returns: Highest priority with any items
+        '''
+        return self._priorities[-1]
+
+    def lowest_priority(self):
+        '''
+        :returns: Lowest priority with any items
+        '''
+        return self._priorities[0]
+
+    def oldest_priority(self):
+        '''
+        :returns: Priority of the oldest item
+        '''
+        return min(self._priorities, key=lambda priority: self._fifos[priority][0][0])
+
+    def oldest_sequence(self):
+        '''
+        :returns: Sequence number of the oldest item or None if there are no items
+        '''
+        if not self._length:
+            return None
+        return min(fifo[0][0] for fifo in self._fifos.itervalues())
+
+    def depths(self):
+        '''
+        :returns: dict of priority to number of items
+        '''
+        return {priority: len(fifo) for priority, fifo in self._fifos.iteritems()}
+
+    def heads(self):
+        '''
+        :returns: dict of priority to the oldest item with that priority
+        '''
+        return {priority: fifo[0][1] for priority, fifo in self._fifos.iteritems()}
+
+
+class _PriorityStats(object):
+    '''
+    Admission counters for a single priority
+    '''
+    __slots__ = ('admitted', 'total_wait', 'max_wait')
+
+    def __init__(self):
+        self.admitted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class AdmissionQueue(object):
+    '''
+    Bounded queue of dispatches waiting for the number of events in flight to drop.
+
+    Dispatches are admitted highest priority first and in FIFO order within a priority. So that
+    a steady stream of urgent events can't hold back everything else forever, once
+    starvation_limit dispatches in a row have been admitted ahead of an older one the oldest
+    queued dispatch is admitted next whatever its priority.
+
+    :param int max_queued_events: Maximum number of dispatches to queue. None is unbounded.
+
+    :param str overflow_policy:
+        What to do with a new dispatch when the queue is full.
+
+        'reject'
+            Fail it with :py:class:`DispatchQueueFull`.
+        'drop_oldest'
+            Fail the oldest queued dispatch of the lowest priority with
+            :py:class:`EventDropped` and queue the new one. If every queued dispatch has a
+            higher priority than the new one, the new one is dropped instead.
+        'wait'
+            Hold it until there is room in the queue. Its Deferred won't fire until it's been
+            admitted and dispatched. Held dispatches move into the queue in priority order.
+            They aren't limited in number; producers should wait for :py:meth:`wait_for_room`
+            before adding more.
+
+    :param int starvation_limit: Number of dispatches that may be admitted ahead of an older
+        one before it's admitted regardless of priority. None never promotes older dispatches.
+    '''
+    overflow_policies = (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST, OVERFLOW_WAIT)
+
+    def __init__(
+            self, max_queued_events=None, overflow_policy=OVERFLOW_REJECT,
+            clock=timeit.default_timer, starvation_limit=16):
+        if overflow_policy not in self.overflow_policies:
+            raise ValueError('Unknown overflow_policy: {!r}'.format(overflow_policy))
+        self._max_queued_events = max_queued_events
+        self._overflow_policy = overflow_policy
+        self._clock = clock
+        self._starvation_limit = starvation_limit
+        self._queue = _PriorityFifo()
+        self._waiting = _PriorityFifo()
+        self._sequence = itertools.count()
+        self._skipped = 0
+        self._priority_stats = {}
+        self._room_waiters = []
+        self.rejected = 0
+        self.dropped = 0
+        self.promoted = 0
+
+    def __len__(self):
+        return len(self._queue) + len(self._waiting)
+
+    def wait_for_room(self):
+        '''
+        :returns: Deferred that will callback once a new dispatch would be queued straight
+            away, rather than held, rejected or dropped.
+        '''
+        if not self._full() and not self._waiting:
+            return defer.succeed(None)
+        room_deferred = defer.Deferred()
+        self._room_waiters.append(room_deferred)
+        return room_deferred
+
+    def _full(self):
+        '''
+        :returns: True if no more dispatches can be queued
+        '''
+        return (
+            self._max_queued_events is not None and
+            len(self._queue) >= self._max_queued_events)
+
+    def enqueue(self, dispatch_fn, dispatch_args, priority=0):
+        '''
+        Queue dispatch_fn to be called with dispatch_args once admitted.
+
+        :returns: Deferred that will be chained to the result of dispatch_fn.
+        '''
+        queued_deferred = defer.Deferred()
+        queued_dispatch = (dispatch_fn, dispatch_args, queued_deferred, self._clock(), priority)
+        sequence = next(self._sequence)
+
+        if not self._full():
+            self._queue.append(priority, sequence, queued_dispatch)
+        elif self._overflow_policy == OVERFLOW_REJECT:
+            self.rejected += 1
+            DEV_LOGGER.debug('Admission queue full; rejecting %r', dispatch_args)
+            return defer.fail(DispatchQueueFull(
+                'Already {!r} events queued'.format(len(self._queue))))
+        elif self._overflow_policy == OVERFLOW_DROP_OLDEST:
+            self.dropped += 1
+            if not self._queue:
+                DEV_LOGGER.debug('Admission queue has no room; dropping %r', dispatch_args)
+                return defer.fail(EventDropped('Dropped as no events can be queued'))
+            if self._queue.lowest_priority() > priority:
+                DEV_LOGGER.debug(
+                    'Admission queue full of higher priorities; dropping %r', dispatch_args)
+                return defer.fail(EventDropped(
+                    'Dropped as every queued event has a higher priority'))
+            _, (_, dropped_args, dropped_deferred, _, _) = self._queue.pop(
+                self._queue.lowest_priority())
+            DEV_LOGGER.debug('Admission queue full; dropping %r', dropped_args)
+            self._queue.append(priority, sequence, queued_dispatch)
+            dropped_deferred.errback(EventDropped(
+                'Dropped to make room for newer event'))
+        else:
+            self._waiting.append(priority, sequence, queued_dispatch)
+
+        return queued_deferred
+
+    def pop(self):
+        '''
+        :returns: Next (dispatch_fn, dispatch_args, deferred, enqueued_at, priority) tuple to
+            admit.
+        '''
+        if not self._queue:
+            _, queued_dispatch = self._waiting.pop(self._waiting.highest_priority())
+        else:
+            if self._starvation_limit is not None and self._skipped >= self._starvation_limit:
+                priority = self._queue.oldest_priority()
+                self.promoted += 1
+            else:
+                priority = self._queue.highest_priority()
+
+            sequence, queued_dispatch = self._queue.pop(priority)
+            oldest_sequence = self._queue.oldest_sequence()
+            if oldest_sequence is not None and oldest_sequence < sequence:
+                self._skipped += 1
+            else:
+                self._skipped = 0
+
+            if self._waiting:
+                waiting_priority = self._waiting.highest_priority()
+                waiting_sequence, waiting_dispatch = self._waiting.pop(waiting_priority)
+                self._queue.append(waiting_priority, waiting_sequence, waiting_dispatch)
+
+        priority_stats = self._priority_stats.get(queued_dispatch[4])
+        if priority_stats is None:
+            priority_stats = self._priority_stats[queued_dispatch[4]] = _PriorityStats()
+        wait = self._clock() - queued_dispatch[3]
+        priority_stats.admitted += 1
+        priority_stats.total_wait += wait
+        priority_stats.max_wait = max(priority_stats.max_wait, wait)
+
+        if self._room_waiters and not self._full() and not self._waiting:
+            room_waiters, self._room_waiters = self._room_waiters, []
+            for room_deferred in room_waiters:
+                room_deferred.callback(None)
+        return queued_dispatch
+
+    def stats(self):
+        '''
+        :returns: dict with the queue depth, number of dispatches waiting for room, counts of
+            rejected, dropped and promoted dispatches, and for each priority seen the number
+            queued and waiting, the number admitted, their mean and maximum wait in seconds and
+            how long the oldest still queued has waited.
+        '''
+        now = self._clock()
+        queued_depths = self._queue.depths()
+        waiting_depths = self._waiting.depths()
+        oldest = self._waiting.heads()
+        oldest.update(self._queue.heads())
+
+        priorities = {}
+        for priority in set(self._priority_stats).union(queued_depths, waiting_depths):
+            priority_stats = self._priority_stats.get(priority, _PriorityStats())
+            oldest_dispatch = oldest.get(priority)
+            priorities[priority] = {
+                'queued': queued_depths.get(priority, 0),
+                'waiting': waiting_depths.get(priority, 0),
+                'admitted': priority_stats.admitted,
+                'mean_wait': (
+                    priority_stats.total_wait / priority_stats.admitted
+                    if priority_stats.admitted else None),
+                'max_wait': priority_stats.max_wait,
+                'oldest_wait': (
+                    now - oldest_dispatch[3] if oldest_dispatch is not None else None),
+            }
+
+        return {
+            'queued': len(self._queue),
+            'waiting': len(self._waiting),
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'promoted': self.promoted,
+            'priorities': priorities,
+        }
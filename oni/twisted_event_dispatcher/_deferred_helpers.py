@@ -6,6 +6,7 @@ import logging
 import functools
 
 from twisted.internet import defer
+from twisted.internet import task
 
 DEV_LOGGER = logging.getLogger(__name__)
 
@@ -62,3 +63,52 @@ class InstanceMethodLockDecorator(object):
         return functools.wraps(orig_function)(wrapped_function)
 
 instance_method_lock = InstanceMethodLockDecorator
+
+
+def _started_coroutine(coroutine):
+    '''
+    Return the already started coroutine for inlineCallbacks to run
+    '''
+    return coroutine
+
+
+_run_started_coroutine = defer.inlineCallbacks(_started_coroutine)
+
+
+def run_coroutine(coroutine_fn, *args, **kwargs):
+    '''
+    Call coroutine_fn, a generator function written to be run by inlineCallbacks, and run the
+    generator it returns.
+
+    Unlike decorating coroutine_fn with inlineCallbacks this doesn't need a new function for
+    every coroutine_fn, so it works with any callable returning a generator.
+
+    :returns: Deferred with the result of the coroutine, or None if coroutine_fn returned None
+        rather than a generator.
+    '''
+    coroutine = coroutine_fn(*args, **kwargs)
+    if coroutine is None:
+        return None
+    return _run_started_coroutine(coroutine)
+
+
+def get_reactor(reactor):
+    '''
+    :returns: reactor or the global reactor if it's None
+    '''
+    if reactor is None:
+        from twisted.internet import reactor
+    return reactor
+
+
+def cooperate(iterator, reactor=None):
+    '''
+    Like task.cooperate but with the work scheduled on reactor rather than always on the
+    global reactor.
+
+    :returns: CooperativeTask running iterator.
+    '''
+    if reactor is None:
+        return task.cooperate(iterator)
+    cooperator = task.Cooperator(scheduler=lambda work: reactor.callLater(0, work))
+    return cooperator.cooperate(iterator)
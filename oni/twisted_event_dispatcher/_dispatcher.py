@@ -3,14 +3,40 @@
 Contains primary implementation of IEventDispatcher
 """
 import collections
+import functools
+import inspect
+import itertools
 import logging
+import sys
 import weakref
 
 from zope.interface import implementer
 from twisted.internet import defer
+from twisted.python import failure
 
+from oni.twisted_event_dispatcher._admission import AdmissionQueue
+from oni.twisted_event_dispatcher._admission import OVERFLOW_DROP_OLDEST
+from oni.twisted_event_dispatcher._admission import OVERFLOW_REJECT
 from oni.twisted_event_dispatcher._deferred_helpers import (
     instance_method_lock)
+from oni.twisted_event_dispatcher._deferred_helpers import cooperate
+from oni.twisted_event_dispatcher._deferred_helpers import get_reactor
+from oni.twisted_event_dispatcher._deferred_helpers import run_coroutine
+from oni.twisted_event_dispatcher._indexes import BitsetMatchIndex
+from oni.twisted_event_dispatcher._indexes import SetMatchIndex
+from oni.twisted_event_dispatcher._plan_cache import DispatchPlanCache
+from oni.twisted_event_dispatcher.coalescing import Coalescer
+from oni.twisted_event_dispatcher.coalescing import _CoalescedRegistration
+from oni.twisted_event_dispatcher.errors import HandlerTimeout
+from oni.twisted_event_dispatcher.executors import ProcessPoolExecutor
+from oni.twisted_event_dispatcher.extractors import compile_detail_extractor
+from oni.twisted_event_dispatcher.executors import ReactorExecutor
+from oni.twisted_event_dispatcher.executors import ThreadPoolExecutor
+from oni.twisted_event_dispatcher.instrumentation import DispatchInstrumentation
+from oni.twisted_event_dispatcher.instrumentation import METRIC_ADMISSION_WAIT
+from oni.twisted_event_dispatcher.instrumentation import METRIC_FIRE
+from oni.twisted_event_dispatcher.instrumentation import METRIC_PHASE
+from oni.twisted_event_dispatcher.subscriptions import Subscription
 from oni.twisted_event_dispatcher.interfaces import IEventDispatcher
 from oni.twisted_event_dispatcher.interfaces import IBackgroundUtility
 
@@ -21,9 +47,19 @@ class _CallableWeakProxy(object):
     '''
     Weakref proxy type class for just holding a callable. If the referent dissapears the function
     will return None and ignore arguments
+
+    :param on_dead: Optional callback passed the weakref once the referent has dissapeared
     '''
-    def __init__(self, orig_fn):
-        self.weakref = weakref.ref(orig_fn)
+    __slots__ = ('weakref',)
+
+    def __init__(self, orig_fn, on_dead=None):
+        self.weakref = weakref.ref(orig_fn, on_dead)
+
+    def resolve(self):
+        '''
+        :returns: The callable or None if it has dissapeared
+        '''
+        return self.weakref()
 
     def __call__(self, *args, **kwargs):
         callable = self.weakref()
@@ -38,11 +74,25 @@ class _MethodWeakProxy(object):
     Weakref proxy type class for just holding a bound method.
     The weakref is actual setup on the instance not the method itself.
     If the referent dissapears the function will return None and ignore arguments
+
+    :param on_dead: Optional callback passed the weakref once the referent has dissapeared
     '''
-    def __init__(self, orig_method):
-        self.weakref = weakref.ref(orig_method.im_self)
+    __slots__ = ('weakref', 'fn')
+
+    def __init__(self, orig_method, on_dead=None):
+        self.weakref = weakref.ref(orig_method.im_self, on_dead)
         self.fn = orig_method.im_func
 
+    def resolve(self):
+        '''
+        :returns: The bound method or None if the instance has dissapeared
+        '''
+        inst = self.weakref()
+        if inst is None:
+            return None
+        else:
+            return self.fn.__get__(inst, type(inst))
+
     def __call__(self, *args, **kwargs):
         inst = self.weakref()
         if inst is None:
@@ -51,33 +101,89 @@ class _MethodWeakProxy(object):
             return self.fn(inst, *args, **kwargs)
 
 
-class _EventHandlerRegistrationEntry(collections.Hashable):
+class _EventHandlerRegistrationEntry(object):
     '''
     Stores single event handler
+
+    :param tuple detail_values:
+        Value (or None for any value) to match for each of the dispatcher's
+        allowed_match_spec_keywords, in the same order.
+
+    :param tuple keywords: The dispatcher's allowed_match_spec_keywords.
+
+    :param auto_remove_callback:
+        Called with the registration id once a weakly referenced listen_fn has been garbage
+        collected.
+
+    :param executor: Optional executor that calls to listen_fn are submitted to. Otherwise a
+        generator function listen_fn is run as a coroutine by inlineCallbacks.
+
+    :param Coalesce coalesce: Optional coalescing of events delivered to listen_fn.
+
+    :param reactor: Reactor used for coalescing and timeout timers.
+
+    :param int max_calls: Optional number of events the registration is resolved for before
+        it's removed.
+
+    :param float timeout: Optional seconds to wait for a Deferred returned by listen_fn
+        before cancelling it.
+
+    :param timed_out_callback:
+        Called with the registration id, the result of the cancelled Deferred and timeout when
+        a Deferred is cancelled. Its result becomes the result of the Deferred.
     '''
-    def __init__(self, listen_fn, phase, use_weakref, remove_callback, **other_kwargs):
-        self.details = other_kwargs
+    __slots__ = (
+        'id', 'listen_fn', 'phase', 'sync', 'tag', 'detail_values', 'keywords', 'coalescer',
+        'remaining_calls')
+
+    def __init__(
+            self, listen_fn, phase, use_weakref, auto_remove_callback, detail_values, keywords,
+            sync=False, tag=None, executor=None, coalesce=None, reactor=None, max_calls=None,
+            timeout=None, timed_out_callback=None):
         self.id = id(self)
         self.phase = phase
-        self.remove_callback = remove_callback
+        self.sync = sync and not inspect.isgeneratorfunction(listen_fn)
+        self.tag = tag
+        self.remaining_calls = max_calls
+        self.detail_values = detail_values
+        self.keywords = keywords
 
         if use_weakref:
+            # The proxy keeps the weakref, and so its callback, alive for as long as we're
+            # registered. The callback only holds our id so doesn't keep us alive in turn.
+            on_dead = functools.partial(_auto_remove, auto_remove_callback, self.id)
             if hasattr(listen_fn, 'im_self'):
                 # This case we have a bound instance method. Weakref the instance not the method
-                weakref.ref(listen_fn.im_self, self._auto_remove)
-                self.listen_fn = _MethodWeakProxy(listen_fn)
+                self.listen_fn = _MethodWeakProxy(listen_fn, on_dead)
             else:
-                weakref.ref(listen_fn, self._auto_remove)
-                self.listen_fn = _CallableWeakProxy(listen_fn)
+                self.listen_fn = _CallableWeakProxy(listen_fn, on_dead)
         else:
             self.listen_fn = listen_fn
 
-    def _auto_remove(self, _weakref):
+        if executor is not None:
+            self.listen_fn = functools.partial(executor.submit, self.listen_fn)
+        elif inspect.isgeneratorfunction(listen_fn):
+            self.listen_fn = functools.partial(run_coroutine, self.listen_fn)
+
+        if timeout is not None and not self.sync:
+            self.listen_fn = functools.partial(
+                _call_with_timeout,
+                self.listen_fn,
+                timeout,
+                reactor,
+                functools.partial(timed_out_callback, self.id))
+
+        if coalesce is not None:
+            self.coalescer = Coalescer(self.listen_fn, coalesce, reactor)
+        else:
+            self.coalescer = None
+
+    @property
+    def details(self):
         '''
-        Function to auto remove self with weakrefs
+        dict of keyword to value matched for each of the allowed_match_spec_keywords
         '''
-        DEV_LOGGER.debug('Auto removing %r', self)
-        return self.remove_callback(self.id)
+        return dict(itertools.izip(self.keywords, self.detail_values))
 
     def __hash__(self):
         return self.id
@@ -86,7 +192,97 @@ class _EventHandlerRegistrationEntry(collections.Hashable):
         return (
             '<{inst.__class__.__module__}.{inst.__class__.__name__}'
             '(id={inst.id!r}, listen_fn={inst.listen_fn!r}, phase={inst.phase!r}, '
-            'details={inst.details!r})>').format(inst=self)
+            'sync={inst.sync!r}, tag={inst.tag!r}, details={inst.details!r})>').format(inst=self)
+
+
+class _Reindex(object):
+    '''
+    Indexes being rebuilt for new allowed_match_spec_keywords while the current indexes are
+    still in use.
+
+    :param index: Empty index for keywords.
+    :param tuple keywords: New allowed_match_spec_keywords.
+    :param convert: Callable converting detail_values for the current keywords to keywords.
+    '''
+    def __init__(self, index, keywords, convert):
+        self.index = index
+        self.keywords = keywords
+        self._convert = convert
+        self.detail_values = {}
+        self.interned_detail_values = {}
+
+    def add(self, event_handler):
+        '''
+        Index event_handler with its converted detail_values
+        '''
+        detail_values = self._convert(event_handler.detail_values)
+        interned = self.interned_detail_values.get(detail_values)
+        if interned is None:
+            interned = self.interned_detail_values[detail_values] = (detail_values, set())
+        interned[1].add(event_handler.id)
+        self.detail_values[event_handler.id] = interned[0]
+        self.index.add(event_handler, interned[0])
+
+    def discard(self, event_handler):
+        '''
+        Remove event_handler if it's been indexed
+        '''
+        detail_values = self.detail_values.pop(event_handler.id, None)
+        if detail_values is None:
+            return
+        self.index.remove(event_handler, detail_values)
+        interned = self.interned_detail_values[detail_values]
+        interned[1].discard(event_handler.id)
+        if not interned[1]:
+            del self.interned_detail_values[detail_values]
+
+
+class _PhasePlan(dict):
+    '''
+    dict mapping phase to a tuple of registrations, with the registrations that have a limited
+    number of calls remaining.
+    '''
+    __slots__ = ('limited',)
+
+    def __init__(self, phase_dict, limited):
+        dict.__init__(self, phase_dict)
+        self.limited = limited
+
+
+def _call_with_timeout(listen_fn, timeout, reactor, timed_out_callback, event):
+    '''
+    Call listen_fn with event, cancelling the Deferred it returns, if any, after timeout.
+    '''
+    result = listen_fn(event)
+    if isinstance(result, defer.Deferred) and not result.called:
+        result.addTimeout(timeout, get_reactor(reactor), timed_out_callback)
+    return result
+
+
+# Arguments of add_event_handler, subscribe and fire_event that match_spec or event_details
+# keyword arguments would be taken as
+_RESERVED_MATCH_SPEC_KEYWORDS = frozenset([
+    'listen_fn', 'phase', 'use_weakref', 'sync', 'tag', 'executor', 'coalesce', 'max_calls',
+    'timeout', 'max_size', 'overflow_policy', 'event', 'priority'])
+
+
+def _check_match_spec_keyword(keyword):
+    '''
+    Raise ValueError if keyword can't be a match spec keyword as it would clash with an
+    argument of add_event_handler, subscribe or fire_event
+    '''
+    if keyword in _RESERVED_MATCH_SPEC_KEYWORDS:
+        raise ValueError(
+            '{!r} can not be a match spec keyword as it is an argument of add_event_handler, '
+            'subscribe or fire_event'.format(keyword))
+
+
+def _auto_remove(auto_remove_callback, event_handler_id, _weakref):
+    '''
+    Weakref callback to auto remove a registration once its listen_fn has been collected
+    '''
+    DEV_LOGGER.debug('Auto removing event handler with id %r', event_handler_id)
+    auto_remove_callback(event_handler_id)
 
 
 @implementer(IBackgroundUtility, IEventDispatcher)
@@ -96,18 +292,171 @@ class EventDispatcher(object):
 
     :param allowed_match_spec_keywords:
         Sequence of strings which represent keyword arguments to allow when adding event handlers.
+        Names of arguments of add_event_handler, subscribe or fire_event, such as 'tag' or
+        'priority', aren't allowed.
+
+    :param phases: Sequence of phases handlers can be registered against, in the order they run.
+
+    :param int plan_cache_size:
+        Maximum number of resolved dispatch plans to cache, keyed on event_details.
+        0 disables the cache.
+
+    :param str index_engine:
+        How handler registrations are indexed. 'set' (the default) stores postings as sets of
+        registrations. 'bitset' stores them as integer bitmasks, which keeps matching cheap with
+        very large numbers of registered handlers.
+
+    :param int max_in_flight_events:
+        Maximum number of events (or batches from fire_events) to dispatch at once. Any more
+        are queued until an event in flight completes. None, the default, is unbounded.
+
+    :param int max_queued_events:
+        Maximum number of events to queue while max_in_flight_events are in flight.
+        None, the default, is unbounded.
+
+    :param str overflow_policy:
+        What to do with an event fired when the queue is full. 'reject' fails the returned
+        Deferred with :py:class:`DispatchQueueFull`, 'drop_oldest' fails the oldest queued
+        event with :py:class:`EventDropped` to make room, and 'wait' holds the event back
+        until there's room in the queue. As with the other policies the returned Deferred fires
+        once the event has been dispatched. Held events aren't limited in number, so producers
+        using 'wait' should wait for :py:meth:`wait_for_admission` before firing more.
+
+    :param int starvation_limit:
+        Queued events are admitted highest priority first. Once this many have been admitted
+        ahead of an older event, the oldest queued event is admitted next whatever its
+        priority. None lets higher priorities starve lower ones indefinitely.
+
+    :param dict phase_concurrency:
+        Mapping of phase to the maximum number of handlers in that phase that may be running
+        at once, across all events.
+
+    :param instrumentation_sinks:
+        Sequence of sinks, such as :py:class:`InMemorySink`, to report dispatch measurements
+        to. See :py:mod:`oni.twisted_event_dispatcher.instrumentation`. With no sinks nothing
+        is measured.
+
+    :param dict executors:
+        Mapping of name to executor (see :py:mod:`oni.twisted_event_dispatcher.executors`)
+        that handlers can be offloaded to by passing the name as executor to
+        add_event_handler. By default 'reactor', 'thread' and 'process' are available, the
+        latter two created with default sizing the first time they're used. Pass your own
+        executors under those names to change sizing or queue limits. Named executors are
+        stopped when the dispatcher is stopped.
+
+    :param reactor: Reactor used for timers, such as those of coalesced handlers and handler
+        timeouts. Defaults to the global reactor.
+
+    :param detail_extractor:
+        Lets events be fired without event_details, which are then extracted from the event.
+        'attributes' reads an attribute named after each of allowed_match_spec_keywords,
+        'items' an item keyed by each. Otherwise a callable returning a tuple of the value of
+        each of allowed_match_spec_keywords in order, such as those built by
+        :py:mod:`oni.twisted_event_dispatcher.extractors`. Extracted values are matched and
+        cached as a tuple so no event_details dict is built per event.
+
+    :param EventJournal journal:
+        Journal every event fired to, see :py:mod:`oni.twisted_event_dispatcher.journal`, so
+        they can be replayed with :py:meth:`replay_journal` after a restart. Events are
+        journaled once admitted, so those rejected or dropped by the admission queue aren't
+        replayed. Events and their event_details must then be picklable. The journal is flushed
+        when the dispatcher is stopped.
+
+    :param ordering_keyword:
+        One of allowed_match_spec_keywords. Events with the same value of it are run through
+        the phases one at a time, in the order they were fired, so each event's after phase
+        completes before the next one's before phase starts. Events with different values still
+        run concurrently. Events without a value for it are ordered with one another. By default
+        no events wait for one another. Each event in a fire_events batch is ordered separately.
+
+    :param float handler_timeout:
+        Default timeout for handlers registered without their own. See add_event_handler.
 
     After initialisation an instance will be in the stopped state until .start() is called.
     '''
     _registration_factory = _EventHandlerRegistrationEntry
+    _index_engines = {
+        'set': SetMatchIndex,
+        'bitset': BitsetMatchIndex,
+    }
+    _executor_factories = {
+        'reactor': ReactorExecutor,
+        'thread': ThreadPoolExecutor,
+        'process': ProcessPoolExecutor,
+    }
 
-    def __init__(self, allowed_match_spec_keywords, phases=('before', 'during', 'after')):
+    def __init__(
+            self,
+            allowed_match_spec_keywords,
+            phases=('before', 'during', 'after'),
+            plan_cache_size=1024,
+            index_engine='set',
+            max_in_flight_events=None,
+            max_queued_events=None,
+            overflow_policy=OVERFLOW_REJECT,
+            starvation_limit=16,
+            phase_concurrency=None,
+            instrumentation_sinks=(),
+            executors=None,
+            reactor=None,
+            detail_extractor=None,
+            journal=None,
+            ordering_keyword=None,
+            handler_timeout=None):
         self._allowed_match_spec_keywords = tuple(allowed_match_spec_keywords)
-        self._indexes = collections.defaultdict(self._index_factory)
+        for keyword in self._allowed_match_spec_keywords:
+            _check_match_spec_keyword(keyword)
+        try:
+            index_factory = self._index_engines[index_engine]
+        except KeyError:
+            raise ValueError('Unknown index_engine: {!r}'.format(index_engine))
+        self._indexes = index_factory(self._allowed_match_spec_keywords)
         self._event_handlers = {}
+        self._interned_detail_values = {}
+        self._tagged_event_handlers = {}
+        self._dead_event_handler_ids = []
         self._phases = tuple(phases)
         self._event_handler_modification_lock = defer.DeferredLock()
         self._running = False
+        self._in_flight_events = 0
+        self._quiescence_waiters = []
+        self._registry_generation = 0
+        self._plan_cache = DispatchPlanCache(plan_cache_size)
+        self._max_in_flight_events = max_in_flight_events
+        self._admission_queue = AdmissionQueue(
+            max_queued_events, overflow_policy, starvation_limit=starvation_limit)
+        self._admitting = False
+        self._phase_semaphores = {
+            phase: defer.DeferredSemaphore(tokens)
+            for phase, tokens in (phase_concurrency or {}).iteritems()}
+        self._executors = dict(executors or {})
+        self._reactor = reactor
+        self._detail_extractor_spec = detail_extractor
+        self._detail_extractor = compile_detail_extractor(
+            detail_extractor, self._allowed_match_spec_keywords)
+        self._reindex = None
+        self._journal = journal
+        if (ordering_keyword is not None and
+                ordering_keyword not in self._allowed_match_spec_keywords):
+            raise ValueError('ordering_keyword {!r} is not one of {!r}'.format(
+                ordering_keyword, self._allowed_match_spec_keywords))
+        self._ordering_keyword = ordering_keyword
+        self._ordering_index = None
+        self._index_ordering_keyword()
+        self._ordering_queues = {}
+        self._handler_timeout = handler_timeout
+        self._timed_out = collections.Counter()
+        self._instrumentation = None
+        for sink in instrumentation_sinks:
+            self.add_instrumentation_sink(sink)
+
+    def _index_ordering_keyword(self):
+        '''
+        Find the position of ordering_keyword in allowed_match_spec_keywords
+        '''
+        if self._ordering_keyword is not None:
+            self._ordering_index = self._allowed_match_spec_keywords.index(
+                self._ordering_keyword)
 
     def start(self):
         '''
@@ -125,75 +474,714 @@ class EventDispatcher(object):
         '''
         DEV_LOGGER.debug('Stopping EventDispatcher %r', self)
         self._running = False
-        return self._event_handler_modification_lock.acquire().addCallback(
+        stop_deferred = self._event_handler_modification_lock.acquire().addCallback(
             lambda lock: lock.release())
+        stop_deferred.addCallback(lambda _: self._wait_for_quiescence())
+        stop_deferred.addCallback(lambda _: self._flush_coalescers())
+        if self._journal is not None:
+            stop_deferred.addCallback(lambda _: self._journal.flush())
+        return stop_deferred.addCallback(lambda _: self._stop_executors())
+
+    def _flush_coalescers(self):
+        '''
+        Deliver every buffer of every coalesced handler.
+
+        :returns: Deferred that will callback once every delivery is complete.
+        '''
+        return defer.DeferredList([
+            event_handler.coalescer.flush_all()
+            for event_handler in self._event_handlers.values()
+            if event_handler.coalescer is not None])
+
+    def _stop_executors(self):
+        '''
+        Stop every named executor. They'll start again if used.
+
+        :returns: Deferred that will callback once every executor has stopped.
+        '''
+        return defer.gatherResults([
+            defer.maybeDeferred(executor.stop) for executor in self._executors.itervalues()
+        ]).addCallback(lambda _: None)
+
+    def _get_executor(self, executor):
+        '''
+        :param executor: Name of executor or executor.
+        :returns: executor
+        '''
+        if not isinstance(executor, basestring):
+            return executor
+
+        try:
+            return self._executors[executor]
+        except KeyError:
+            pass
+
+        try:
+            executor_factory = self._executor_factories[executor]
+        except KeyError:
+            raise ValueError('Unknown executor: {!r}'.format(executor))
+        executor_inst = self._executors[executor] = executor_factory()
+        return executor_inst
+
+    def _wait_for_quiescence(self):
+        '''
+        :returns: Deferred that will callback once there are no events in flight.
+        '''
+        if self._in_flight_events == 0:
+            return defer.succeed(None)
+
+        quiescence_deferred = defer.Deferred()
+        self._quiescence_waiters.append(quiescence_deferred)
+        return quiescence_deferred
+
+    def _event_complete_cb(self, result):
+        '''
+        Callback run when an event has passed through all phases. Notifies anyone waiting for
+        quiescence if this was the last event in flight.
+        '''
+        self._in_flight_events -= 1
+        if self._admission_queue:
+            self._admit_queued_events()
+        if self._in_flight_events == 0 and not self._admission_queue:
+            waiters, self._quiescence_waiters = self._quiescence_waiters, []
+            for waiter in waiters:
+                waiter.callback(None)
+        return result
+
+    def _admit(self, priority, dispatch_fn, *dispatch_args):
+        '''
+        Call dispatch_fn with dispatch_args now if there's room for another event in flight,
+        otherwise queue it with priority.
+
+        :returns: Deferred with the result of dispatch_fn, or that fails with whatever it
+            raised, such as TypeError for unhashable event_details.
+        '''
+        if (self._max_in_flight_events is None or
+                self._in_flight_events < self._max_in_flight_events):
+            return defer.maybeDeferred(dispatch_fn, *dispatch_args)
+        return self._admission_queue.enqueue(dispatch_fn, dispatch_args, priority)
+
+    def _admit_queued_events(self):
+        '''
+        Dispatch queued events until there's no more room for events in flight.
+        '''
+        # Dispatches that complete synchronously re-enter here through _event_complete_cb; the
+        # outermost call does the work so the stack doesn't grow with the queue.
+        if self._admitting:
+            return
+        self._admitting = True
+        try:
+            while self._admission_queue and (
+                    self._in_flight_events < self._max_in_flight_events):
+                dispatch_fn, dispatch_args, queued_deferred, enqueued_at, priority = (
+                    self._admission_queue.pop())
+                if self._instrumentation is not None:
+                    self._instrumentation.record_since(
+                        METRIC_ADMISSION_WAIT, priority, enqueued_at)
+                defer.maybeDeferred(dispatch_fn, *dispatch_args).chainDeferred(queued_deferred)
+        finally:
+            self._admitting = False
+
+    def add_instrumentation_sink(self, sink):
+        '''
+        Start reporting dispatch measurements to sink.
+
+        :param sink: Object with a record(metric, key, duration, failed) method.
+        '''
+        if self._instrumentation is None:
+            self._instrumentation = DispatchInstrumentation(())
+            # Cached plans hold uninstrumented registrations
+            self._registry_generation += 1
+        self._instrumentation.sinks.append(sink)
+
+    def remove_instrumentation_sink(self, sink):
+        '''
+        Stop reporting dispatch measurements to sink. Once the last sink is removed nothing is
+        measured.
+        '''
+        self._instrumentation.sinks.remove(sink)
+        if not self._instrumentation.sinks:
+            self._instrumentation = None
+            self._registry_generation += 1
+
+    def queue_stats(self):
+        '''
+        :returns: dict with the number of events in flight, the queue depth, the number of
+            events waiting for room in the queue, counts of rejected and dropped events and of
+            events promoted ahead of higher priorities to prevent starvation. priorities maps
+            each priority to its queue depth, number waiting, number admitted and the mean,
+            maximum and oldest current wait for admission in seconds.
+        '''
+        stats = self._admission_queue.stats()
+        stats['in_flight'] = self._in_flight_events
+        return stats
+
+    def wait_for_admission(self):
+        '''
+        Signal for producers to wait on before firing more events, so that events aren't held
+        back without limit by the 'wait' overflow_policy, or rejected or dropped by the others.
+
+        :returns: Deferred that will callback once an event fired now would be dispatched or
+            queued straight away.
+        '''
+        return self._admission_queue.wait_for_room()
 
     @property
     def running(self):
         '''RO property for running'''
         return self._running
 
-    @staticmethod
-    def _index_factory():
+    @property
+    def allowed_match_spec_keywords(self):
+        '''RO property for allowed_match_spec_keywords'''
+        return self._allowed_match_spec_keywords
+
+    def add_match_spec_keyword(self, keyword, chunk_size=1000):
+        '''
+        Allow handlers to be matched on keyword from now on. Every existing handler matches
+        any value of it.
+
+        See :py:meth:`remove_match_spec_keyword` for how the change is made.
+
+        :returns: Deferred that will callback once keyword can be used, or fail with ValueError
+            if it's already allowed or is the name of an argument of add_event_handler,
+            subscribe or fire_event.
         '''
-        Create new factory
+        return self._change_match_spec_keywords(keyword, True, chunk_size)
+
+    def remove_match_spec_keyword(self, keyword, chunk_size=1000):
+        '''
+        Stop allowing handlers to be matched on keyword.
+
+        The indexes are rebuilt for the new keywords chunk_size handlers at a time, cooperatively
+        across reactor iterations, while events carry on being dispatched with the current
+        indexes. Once the rebuild is complete the dispatcher switches to the new keywords in a
+        single step. Handlers can't be added or removed until then; those that are added
+        meanwhile are registered against the new keywords afterwards. Changes requested while
+        another is in progress are made one after another, each against the keywords left by
+        the one before.
+
+        The dispatcher's detail_extractor, if it has one, must be 'attributes' or 'items'.
+
+        :returns: Deferred that will callback once keyword has been removed, or fail with
+            ValueError if any handler is registered with a match_spec constraining it, or if it's
+            the ordering_keyword.
+        '''
+        return self._change_match_spec_keywords(keyword, False, chunk_size)
+
+    @instance_method_lock('_event_handler_modification_lock')
+    def _change_match_spec_keywords(self, keyword, add, chunk_size):
+        '''
+        Add keyword, or remove it if add is False, by rebuilding the indexes for the new keywords,
+        converting each registration's detail_values to match, then switching to them.
+
+        Everything is worked out from the keywords current once the lock is held, so changes
+        queued behind one another see each other's result.
+        '''
+        keywords = self._allowed_match_spec_keywords
+        self._remove_dead_event_handlers()
+        if add:
+            if keyword in keywords:
+                raise ValueError('{!r} is already allowed'.format(keyword))
+            _check_match_spec_keyword(keyword)
+            new_keywords = keywords + (keyword,)
+
+            def convert(detail_values):
+                '''Existing registrations match any value of keyword'''
+                return detail_values + (None,)
+        else:
+            if keyword not in keywords:
+                raise ValueError('{!r} is not allowed'.format(keyword))
+            if keyword == self._ordering_keyword:
+                raise ValueError('Can not remove ordering_keyword {!r}'.format(keyword))
+            keyword_index = keywords.index(keyword)
+            if any(detail_values[keyword_index] is not None
+                   for detail_values in self._interned_detail_values):
+                raise ValueError(
+                    'Handlers are registered with match_spec constraining {!r}'.format(keyword))
+            new_keywords = keywords[:keyword_index] + keywords[keyword_index + 1:]
+
+            def convert(detail_values):
+                '''Drop the value for keyword'''
+                return detail_values[:keyword_index] + detail_values[keyword_index + 1:]
+
+        detail_extractor = compile_detail_extractor(
+            None if callable(self._detail_extractor_spec) else self._detail_extractor_spec,
+            new_keywords)
+        if self._detail_extractor_spec is not None and detail_extractor is None:
+            raise ValueError('Can not change keywords with a custom detail_extractor')
+
+        DEV_LOGGER.debug('Reindexing %r for keywords %r', self, new_keywords)
+        reindex = self._reindex = _Reindex(
+            type(self._indexes)(new_keywords), new_keywords, convert)
+        rebuild = cooperate(self._rebuild_indexes(reindex, chunk_size), self._reactor)
+        return rebuild.whenDone().addCallback(
+            self._switch_indexes, reindex, detail_extractor).addErrback(
+                self._abandon_reindex)
+
+    def _rebuild_indexes(self, reindex, chunk_size):
         '''
-        return collections.defaultdict(set)
+        Add every registration to the index being rebuilt, yielding after every chunk_size.
+        '''
+        event_handlers = self._event_handlers.values()
+        for chunk_start in xrange(0, len(event_handlers), chunk_size):
+            for event_handler in event_handlers[chunk_start:chunk_start + chunk_size]:
+                # Registrations can still be removed by max_calls or garbage collection
+                if event_handler.id in self._event_handlers:
+                    reindex.add(event_handler)
+            yield None
 
-    def add_event_handler(self, listen_fn, phase, use_weakref=True, **match_spec):
+    def _switch_indexes(self, _result, reindex, detail_extractor):
+        '''
+        Switch to the rebuilt indexes and keywords in one step
+        '''
+        for event_handler_id, detail_values in reindex.detail_values.iteritems():
+            event_handler = self._event_handlers[event_handler_id]
+            event_handler.detail_values = detail_values
+            event_handler.keywords = reindex.keywords
+        self._indexes = reindex.index
+        self._interned_detail_values = reindex.interned_detail_values
+        self._allowed_match_spec_keywords = reindex.keywords
+        self._detail_extractor = detail_extractor
+        self._index_ordering_keyword()
+        self._reindex = None
+        self._registry_generation += 1
+        DEV_LOGGER.debug('Switched %r to keywords %r', self, reindex.keywords)
+
+    def _abandon_reindex(self, reindex_failure):
+        '''
+        Forget a rebuild that failed, carrying on with the current indexes
+        '''
+        self._reindex = None
+        return reindex_failure
+
+    def add_event_handler(
+            self, listen_fn, phase, use_weakref=True, sync=False, tag=None, executor=None,
+            coalesce=None, max_calls=None, timeout=None, **match_spec):
         '''
         See :py:func:`IEventDispatcher.add_event_handler`
+
+        As well as an exact value or None, each match_spec value may be one of the matchers in
+        :py:mod:`oni.twisted_event_dispatcher.matchers`; OneOf, Prefix or Range. They're
+        indexed like exact values so the handler is only called for events they match.
+
+        listen_fn may be a coroutine; a generator function written to be run by
+        :py:func:`twisted.internet.defer.inlineCallbacks`. It's run as one whenever it's called,
+        without needing to be decorated, and the phase waits for it to return.
+
+        :param bool sync:
+            Promise that listen_fn is an ordinary synchronous function. Its return value is
+            never inspected so, if it does return a Deferred, the phase won't wait for it.
+
+        :param tag:
+            Optional hashable label, such as the owner of the handler, that can be used to
+            remove all the handlers sharing it with :py:meth:`remove_event_handlers_by_tag`.
+
+        :param executor:
+            Name of one of the dispatcher's executors ('reactor', 'thread', 'process' or any
+            passed to the constructor) or an executor object to run listen_fn with. The
+            result is delivered as a Deferred so takes part in phase ordering as usual.
+            Handlers run by the 'process' executor, and the events passed to them, must be
+            picklable. sync is ignored for these handlers.
+
+        :param Coalesce coalesce:
+            Buffer the handler's events for each distinct event_details and deliver them
+            together, either as the latest event or a list of events, after a window or once
+            enough have been buffered. See :py:mod:`oni.twisted_event_dispatcher.coalescing`.
+            Buffers not yet delivered when the handler is removed are discarded.
+
+        :param int max_calls:
+            Remove the handler once it's been resolved for this many events. It's removed as
+            the last of those events is fired, before any handler is called, so events fired
+            after that never see it even if they're fired while the last event is in flight.
+            Can't be combined with coalesce.
+
+        :param float timeout:
+            Seconds to wait for a Deferred returned by listen_fn before cancelling it, so that
+            a handler that never completes can't hold up its event forever. The cancelled
+            handler fails with :py:class:`HandlerTimeout` and the phase carries on. Defaults to
+            the dispatcher's handler_timeout. Ignored for sync handlers.
+        '''
+        # instance_method_lock makes this return a Deferred; pylint: disable=no-member
+        return self._register_event_handlers(
+            [self._make_registration(
+                listen_fn, phase, use_weakref, sync, tag, executor, coalesce, max_calls,
+                timeout, **match_spec)],
+        ).addCallback(lambda event_handler_ids: event_handler_ids[0])
+
+    def subscribe(self, phase, max_size=1024, overflow_policy=OVERFLOW_DROP_OLDEST, tag=None,
+                  **match_spec):
+        '''
+        Subscribe to the events matching match_spec in phase, to be taken from a bounded
+        buffer at the consumer's own pace rather than pushed to a handler. See
+        :py:mod:`oni.twisted_event_dispatcher.subscriptions`.
+
+        :param int max_size: Most events to buffer.
+        :param str overflow_policy: What to do with an event once max_size are buffered.
+            'drop_oldest' or 'drop_newest' to discard one, 'wait' to make the event's phase wait
+            until there's room.
+        :param tag: As for :py:meth:`add_event_handler`.
+
+        :returns: Deferred that will callback with the :py:class:`Subscription` once it's
+            registered. Close it to remove the registration.
+        '''
+        subscription = Subscription(max_size, overflow_policy, self.remove_event_handler)
+        # instance_method_lock makes this return a Deferred; pylint: disable=no-member
+        add_deferred = self.add_event_handler(
+            subscription.deliver,
+            phase,
+            use_weakref=False,
+            sync=subscription.sync,
+            tag=tag,
+            **match_spec)
+
+        def registered_cb(event_handler_id):
+            '''Tell the subscription its registration id'''
+            subscription.event_handler_id = event_handler_id
+            return subscription
+
+        return add_deferred.addCallback(registered_cb)
+
+    def add_event_handlers(self, specs):
+        '''
+        Add many event handlers at once, applying every change to the indexes together.
+
+        :param specs:
+            Iterable of dicts, each containing the keyword arguments for a single call to
+            :py:meth:`add_event_handler`.
+
+        :returns:
+            Deferred that will callback with the list of ids of the new registrations, in the
+            same order as specs, once they've all been added.
+        '''
+        return self._register_event_handlers([self._make_registration(**spec) for spec in specs])
+
+    def _make_registration(
+            self, listen_fn, phase, use_weakref=True, sync=False, tag=None, executor=None,
+            coalesce=None, max_calls=None, timeout=None, **match_spec):
+        '''
+        Validate match_spec and create a registration for listen_fn.
         '''
-        match_spec_complete = {
-            key: match_spec.pop(key, None) for key in self._allowed_match_spec_keywords}
+        detail_values = tuple(
+            match_spec.pop(key, None) for key in self._allowed_match_spec_keywords)
 
         if len(match_spec):
             raise ValueError('Got unexpected match_spec: {!r}'.format(match_spec))
 
-        event_handler_inst = self._registration_factory(
+        if max_calls is not None:
+            if max_calls < 1:
+                raise ValueError('max_calls must be at least 1 not {!r}'.format(max_calls))
+            if coalesce is not None:
+                raise ValueError('max_calls can not be combined with coalesce')
+
+        if executor is not None:
+            executor = self._get_executor(executor)
+            executor.check(listen_fn)
+            sync = False
+
+        return self._registration_factory(
             listen_fn,
             phase=phase,
             use_weakref=use_weakref,
-            remove_callback=self.remove_event_handler,
-            **match_spec_complete)
-
-        return self._register_event_handler(event_handler_inst)
+            auto_remove_callback=self._dead_event_handler_ids.append,
+            detail_values=detail_values,
+            keywords=self._allowed_match_spec_keywords,
+            sync=sync,
+            tag=tag,
+            executor=executor,
+            coalesce=coalesce,
+            reactor=self._reactor,
+            max_calls=max_calls,
+            timeout=timeout if timeout is not None else self._handler_timeout,
+            timed_out_callback=self._handler_timed_out)
 
     @instance_method_lock('_event_handler_modification_lock')
-    def _register_event_handler(self, event_handler_inst):
+    def _register_event_handlers(self, event_handler_insts):
         '''
-        Used internally to actually store the registration and set up any indexes.
+        Used internally to actually store registrations and set up any indexes.
         '''
-        DEV_LOGGER.debug(
-            'Registering event handler: %r', event_handler_inst)
-        self._event_handlers[event_handler_inst.id] = event_handler_inst
-        for detail, detail_filter in event_handler_inst.details.iteritems():
-            self._indexes[detail][detail_filter].add(event_handler_inst)
-        return event_handler_inst.id
+        self._remove_dead_event_handlers()
+        for event_handler_inst in event_handler_insts:
+            if event_handler_inst.keywords != self._allowed_match_spec_keywords:
+                self._remap_detail_values(event_handler_inst)
+
+        for event_handler_inst in event_handler_insts:
+            DEV_LOGGER.debug(
+                'Registering event handler: %r', event_handler_inst)
+            # Share detail values with any other registration using the same ones
+            interned = self._interned_detail_values.get(event_handler_inst.detail_values)
+            if interned is None:
+                interned = self._interned_detail_values[event_handler_inst.detail_values] = (
+                    event_handler_inst.detail_values, set())
+            else:
+                event_handler_inst.detail_values = interned[0]
+            interned[1].add(event_handler_inst.id)
+
+            if event_handler_inst.tag is not None:
+                self._tagged_event_handlers.setdefault(event_handler_inst.tag, set()).add(
+                    event_handler_inst.id)
+
+            self._event_handlers[event_handler_inst.id] = event_handler_inst
+            self._indexes.add(event_handler_inst)
+        self._registry_generation += 1
+        return [event_handler_inst.id for event_handler_inst in event_handler_insts]
+
+    def _remap_detail_values(self, event_handler_inst):
+        '''
+        Map the detail_values of a registration made before allowed_match_spec_keywords
+        changed onto the current keywords.
+        '''
+        details = event_handler_inst.details
+        unexpected = {
+            key: value for key, value in details.iteritems()
+            if value is not None and key not in self._allowed_match_spec_keywords}
+        if unexpected:
+            raise ValueError('Got unexpected match_spec: {!r}'.format(unexpected))
+        event_handler_inst.detail_values = tuple(
+            details.get(key) for key in self._allowed_match_spec_keywords)
+        event_handler_inst.keywords = self._allowed_match_spec_keywords
 
-    @instance_method_lock('_event_handler_modification_lock')
     def remove_event_handler(self, event_handler_id):
         '''
         See :py:func:`IEventDispatcher.remove_event_handler`
         '''
-        DEV_LOGGER.debug('Removing event handler with id %r', event_handler_id)
-        event_handler = self._event_handlers.pop(event_handler_id)
+        # instance_method_lock makes this return a Deferred; pylint: disable=no-member
+        return self.remove_event_handlers([event_handler_id]).addCallback(lambda _: None)
 
-        for detail, filter_inst in event_handler.details.iteritems():
-            self._indexes[detail][filter_inst].remove(event_handler)
+    @instance_method_lock('_event_handler_modification_lock')
+    def remove_event_handlers(self, event_handler_ids):
+        '''
+        Remove many handler registrations at once, applying every change to the indexes
+        together.
 
-        del(event_handler)
+        :param event_handler_ids: Iterable of ids returned when adding the handlers.
+        :returns: Deferred that will callback with the list of removed ids once they've all been
+            removed. If any id isn't registered it will errback with KeyError and nothing will
+            have been removed.
+        '''
+        self._remove_dead_event_handlers()
+        event_handler_ids = list(event_handler_ids)
+        DEV_LOGGER.debug('Removing event handlers with ids %r', event_handler_ids)
+        event_handlers = [
+            self._event_handlers[event_handler_id] for event_handler_id in event_handler_ids]
+        for event_handler in event_handlers:
+            self._unregister_event_handler(event_handler)
+        return event_handler_ids
 
-    def _get_set_of_event_handlers(self, event_index, value):
+    @instance_method_lock('_event_handler_modification_lock')
+    def remove_event_handlers_by_tag(self, tag):
         '''
-        See which event_handlers match an event_index and value
+        Remove every handler registered with tag.
+
+        :returns: Deferred that will callback with the list of removed ids.
         '''
-        return self._indexes[event_index][None].union(self._indexes[event_index][value])
+        self._remove_dead_event_handlers()
+        event_handler_ids = list(self._tagged_event_handlers.get(tag, ()))
+        DEV_LOGGER.debug('Removing %r event handlers tagged %r', len(event_handler_ids), tag)
+        for event_handler_id in event_handler_ids:
+            self._unregister_event_handler(self._event_handlers[event_handler_id])
+        return event_handler_ids
 
     @instance_method_lock('_event_handler_modification_lock')
-    def fire_event(self, event, **event_details):
+    def remove_event_handlers_by_match_spec(self, **match_spec):
+        '''
+        Remove every handler registered with exactly match_spec. As when adding a handler, any
+        allowed keyword not in match_spec is taken to be None.
+
+        :returns: Deferred that will callback with the list of removed ids.
+        '''
+        self._remove_dead_event_handlers()
+        detail_values = tuple(
+            match_spec.pop(key, None) for key in self._allowed_match_spec_keywords)
+
+        if len(match_spec):
+            raise ValueError('Got unexpected match_spec: {!r}'.format(match_spec))
+
+        interned = self._interned_detail_values.get(detail_values)
+        event_handler_ids = list(interned[1]) if interned is not None else []
+        DEV_LOGGER.debug(
+            'Removing %r event handlers with detail values %r',
+            len(event_handler_ids),
+            detail_values)
+        for event_handler_id in event_handler_ids:
+            self._unregister_event_handler(self._event_handlers[event_handler_id])
+        return event_handler_ids
+
+    def _unregister_event_handler(self, event_handler):
+        '''
+        Used internally to actually remove a registration from the registry and indexes.
+        '''
+        del self._event_handlers[event_handler.id]
+        self._registry_generation += 1
+        self._indexes.remove(event_handler)
+        if self._reindex is not None:
+            self._reindex.discard(event_handler)
+
+        interned = self._interned_detail_values[event_handler.detail_values]
+        interned[1].discard(event_handler.id)
+        if not interned[1]:
+            del self._interned_detail_values[event_handler.detail_values]
+
+        if event_handler.tag is not None:
+            tagged = self._tagged_event_handlers[event_handler.tag]
+            tagged.discard(event_handler.id)
+            if not tagged:
+                del self._tagged_event_handlers[event_handler.tag]
+
+        if event_handler.coalescer is not None:
+            event_handler.coalescer.cancel()
+
+        self._timed_out.pop(event_handler.id, None)
+
+    def _handler_timed_out(self, event_handler_id, result, timeout):
+        '''
+        Count a handler Deferred cancelled after timeout, failing it with HandlerTimeout.
+        '''
+        if event_handler_id in self._event_handlers:
+            self._timed_out[event_handler_id] += 1
+        DEV_LOGGER.warning(
+            'Event handler with id %r timed out after %r seconds', event_handler_id, timeout)
+        if isinstance(result, failure.Failure):
+            result.trap(defer.CancelledError)
+            raise HandlerTimeout(
+                'Event handler with id {!r} timed out after {!r} seconds'.format(
+                    event_handler_id, timeout))
+        return result
+
+    def timeout_stats(self):
+        '''
+        :returns: dict mapping the id of each registered handler that has timed out to the
+            number of times it has.
+        '''
+        return dict(self._timed_out)
+
+    def _remove_dead_event_handlers(self):
+        '''
+        Remove registrations whose weakly referenced listen_fn has been garbage collected.
+
+        The weakref callbacks only queue the id; they can run at any point the garbage collector
+        does so the registry is only changed from here.
+        '''
+        while self._dead_event_handler_ids:
+            event_handler = self._event_handlers.get(self._dead_event_handler_ids.pop())
+            if event_handler is not None:
+                self._unregister_event_handler(event_handler)
+
+    def _resolve_phase_plan(self, event_details, detail_values=None):
+        '''
+        Resolve which event handlers should be triggered for event_details, or for
+        detail_values, the value of every one of allowed_match_spec_keywords in order, if
+        they're given instead.
+
+        The result is a snapshot; a _PhasePlan mapping phase to a tuple of registrations.
+        Because it's built synchronously before any handler runs, later additions or removals of
+        handlers won't affect an event already in flight.
+        '''
+        phase_dict = collections.defaultdict(list)
+        instrumentation = self._instrumentation
+        buffer_key = None
+        limited = []
+
+        if detail_values is None:
+            event_handlers = self._indexes.match(event_details)
+        else:
+            event_handlers = self._indexes.match_values(detail_values)
+
+        for event_handler in event_handlers:
+            if event_handler.remaining_calls is not None:
+                limited.append(event_handler)
+            if event_handler.coalescer is not None:
+                if buffer_key is None:
+                    if detail_values is not None:
+                        event_details = dict(
+                            itertools.izip(self._allowed_match_spec_keywords, detail_values))
+                    buffer_key = frozenset(event_details.iteritems())
+                event_handler = _CoalescedRegistration(event_handler, buffer_key)
+            if instrumentation is not None:
+                event_handler = instrumentation.wrap_registration(event_handler)
+            phase_dict[event_handler.phase].append(event_handler)
+
+        return _PhasePlan(
+            ((phase, tuple(event_handlers)) for phase, event_handlers in phase_dict.iteritems()),
+            tuple(limited))
+
+    def _consume_limited_calls(self, phase_plan):
+        '''
+        Count a call against every registration in phase_plan with limited calls, removing those
+        that have none left.
+
+        :returns: True if any registration was removed, in which case phase_plan is stale.
+        '''
+        exhausted = False
+        for event_handler in phase_plan.limited:
+            event_handler.remaining_calls -= 1
+            if event_handler.remaining_calls == 0:
+                DEV_LOGGER.debug('Removing event handler with no calls left: %r', event_handler)
+                self._unregister_event_handler(event_handler)
+                exhausted = True
+        return exhausted
+
+    def _get_phase_plan(self, event_details, plan_key=None, detail_values=None):
+        '''
+        Get phase plan for event_details, or detail_values if given, from the plan cache,
+        resolving and storing it on a miss.
+        '''
+        if plan_key is None:
+            if detail_values is None:
+                plan_key = frozenset(event_details.iteritems())
+            else:
+                plan_key = detail_values
+        phase_plan = self._plan_cache.get(plan_key, self._registry_generation)
+        if phase_plan is None:
+            phase_plan = self._resolve_phase_plan(event_details, detail_values)
+            self._plan_cache.store(plan_key, self._registry_generation, phase_plan)
+        return phase_plan
+
+    def coalesce_stats(self):
+        '''
+        :returns: dict mapping the id of each coalesced handler to a dict with the number of
+            events it's received, the number of deliveries made and the number of buffers
+            waiting to be delivered.
+        '''
+        return {
+            event_handler_id: event_handler.coalescer.stats()
+            for event_handler_id, event_handler in self._event_handlers.iteritems()
+            if event_handler.coalescer is not None}
+
+    def plan_cache_stats(self):
+        '''
+        :returns: dict with the size, hits, misses, evictions and invalidations of the plan cache.
+        '''
+        return self._plan_cache.stats()
+
+    def memory_stats(self):
+        '''
+        :returns:
+            dict with the number of registered handlers, the number of postings in the index
+            and an estimate of the bytes used by the registry and index.
+        '''
+        stats = self._indexes.memory_stats()
+        stats['handlers'] = len(self._event_handlers)
+        stats['estimated_bytes'] += (
+            sys.getsizeof(self._event_handlers) +
+            sys.getsizeof(self._interned_detail_values) +
+            sys.getsizeof(self._tagged_event_handlers))
+        return stats
+
+    def fire_event(self, event, priority=0, **event_details):
         '''
         See :py:func:`IEventDispatcher.fire_event`
+
+        Events don't wait for one another; each runs against a snapshot of the handlers
+        registered at the time it was fired so many events can be in flight at once.
+
+        :param priority:
+            Only matters once max_in_flight_events are in flight and events are being queued.
+            Queued events with a higher priority are admitted first, subject to
+            starvation_limit. 'priority' can't be used as an event detail.
+
+        If no event_details are given and the dispatcher has a detail_extractor they're
+        extracted from event.
         '''
         DEV_LOGGER.debug(
             'Firing for event %r with details %r',
@@ -201,48 +1189,393 @@ class EventDispatcher(object):
             event_details)
 
         if not self.running:
-            DEV_LOGGER.warning('Event %r received but dispatcher is not running')
+            DEV_LOGGER.warning('Event %r received but dispatcher is not running', event)
             return defer.succeed(None)
 
-        filter_sets = [
-            self._get_set_of_event_handlers(key, value)
-            for key, value in event_details.iteritems()]
+        if self._journal is not None:
+            dispatch_fn = self._dispatch_journaled_event
+        else:
+            dispatch_fn = self._dispatch_event
+
+        if self._instrumentation is not None:
+            return self._admit(priority, dispatch_fn, event, event_details).addBoth(
+                self._instrumentation.record_since_cb,
+                METRIC_FIRE,
+                None,
+                self._instrumentation.clock())
+
+        return self._admit(priority, dispatch_fn, event, event_details)
+
+    def _dispatch_journaled_event(self, event, event_details):
+        '''
+        Journal an event that's been admitted then dispatch it.
+        '''
+        try:
+            self._journal.append(event, event_details)
+        except Exception:
+            return defer.fail()
+        return self._dispatch_event(event, event_details)
+
+    def _dispatch_event(self, event, event_details):
+        '''
+        Resolve handlers for a single event and run it through every phase.
+        '''
+        if self._dead_event_handler_ids:
+            self._remove_dead_event_handlers()
+
+        detail_values = None
+        if not event_details and self._detail_extractor is not None:
+            # Extracted as the event is dispatched so that the values always match the current
+            # allowed_match_spec_keywords, even if they changed while the event was queued.
+            try:
+                detail_values = self._detail_extractor(event)
+            except Exception:
+                return defer.fail()
 
-        DEV_LOGGER.debug('Found %r filter_sets', len(filter_sets))
+        phase_plan = self._get_phase_plan(event_details, detail_values=detail_values)
+        if phase_plan.limited:
+            self._consume_limited_calls(phase_plan)
 
-        if len(filter_sets) < 1:
+        if not phase_plan:
             return defer.succeed(None)
-        elif len(filter_sets) == 1:
-            event_handlers = filter_sets[0]
-        else:
-            event_handlers = filter_sets[0].intersection(*(filter_sets[1:]))
 
-        phase_dict = collections.defaultdict(list)
+        self._in_flight_events += 1
+        if self._ordering_keyword is not None:
+            return self._run_in_order(
+                self._get_ordering_key(event_details, detail_values),
+                self._run_phase,
+                None,
+                iter(self._phases),
+                phase_plan,
+                event).addBoth(self._event_complete_cb)
 
-        for event_handler in event_handlers:
-            phase_dict[event_handler.phase].append(event_handler)
+        return self._run_phase(None, iter(self._phases), phase_plan, event).addBoth(
+            self._event_complete_cb)
+
+    def _get_ordering_key(self, event_details, detail_values):
+        '''
+        :returns: Value of ordering_keyword from detail_values if given, otherwise event_details.
+        '''
+        if detail_values is None:
+            return event_details.get(self._ordering_keyword)
+        return detail_values[self._ordering_index]
+
+    def _run_in_order(self, ordering_key, run_fn, *run_args):
+        '''
+        Call run_fn with run_args once every earlier run with ordering_key has completed.
+
+        :returns: Deferred with the result of run_fn.
+        '''
+        waiting = self._ordering_queues.get(ordering_key)
+        if waiting is not None:
+            queued_deferred = defer.Deferred()
+            waiting.append((run_fn, run_args, queued_deferred))
+            return queued_deferred
+
+        self._ordering_queues[ordering_key] = collections.deque()
+        return run_fn(*run_args).addBoth(self._run_next_in_order, ordering_key)
+
+    def _run_next_in_order(self, result, ordering_key):
+        '''
+        Callback run when a run with ordering_key completes. Starts the runs waiting on it until
+        one doesn't complete synchronously.
+        '''
+        # Runs that complete synchronously are handled here in a loop rather than by their own
+        # callback so the stack doesn't grow with the queue.
+        waiting = self._ordering_queues[ordering_key]
+        while waiting:
+            run_fn, run_args, queued_deferred = waiting.popleft()
+            run_deferred = run_fn(*run_args)
+            if not run_deferred.called:
+                run_deferred.addBoth(self._run_next_in_order, ordering_key)
+                run_deferred.chainDeferred(queued_deferred)
+                return result
+            run_deferred.chainDeferred(queued_deferred)
+        del self._ordering_queues[ordering_key]
+        return result
+
+    def _run_phase(self, _result, phase_iter, phase_dict, event):
+        '''
+        Run the remaining phases of event handlers.
+
+        Handlers are called directly. As long as none of them return a Deferred (or raise) we
+        move straight on to the next phase without building any Deferreds. Otherwise we wait on
+        a DeferredList of those that did before carrying on.
+        '''
+        phase_semaphores = self._phase_semaphores
+        instrumentation = self._instrumentation
+        phase_started = None
+        for phase in phase_iter:
+            event_handlers = phase_dict.get(phase)
+            if not event_handlers:
+                continue
+
+            DEV_LOGGER.debug(
+                'Running phase %r for event %r. Contains %r', phase, event, event_handlers)
+
+            if instrumentation is not None:
+                phase_started = instrumentation.clock()
+
+            if phase in phase_semaphores:
+                phase_deferred = self._run_limited_phase(
+                    phase_semaphores[phase], event_handlers, event)
+            else:
+                phase_deferreds = None
+                for event_handler in event_handlers:
+                    try:
+                        result = event_handler.listen_fn(event)
+                    except Exception:
+                        result = defer.fail()
+                    else:
+                        if event_handler.sync or not isinstance(result, defer.Deferred):
+                            continue
+
+                    if phase_deferreds is None:
+                        phase_deferreds = [result]
+                    else:
+                        phase_deferreds.append(result)
+
+                if phase_deferreds is None:
+                    if instrumentation is not None:
+                        instrumentation.record_since(METRIC_PHASE, phase, phase_started)
+                    continue
+
+                phase_deferred = defer.DeferredList(phase_deferreds)
+
+            if instrumentation is not None:
+                phase_deferred.addCallback(
+                    instrumentation.record_since_cb, METRIC_PHASE, phase, phase_started)
+            return phase_deferred.addCallback(self._run_phase, phase_iter, phase_dict, event)
+
+        return defer.succeed(None)
+
+    @staticmethod
+    def _run_limited_phase(semaphore, event_handlers, event):
+        '''
+        Run a phase whose handlers may only run while holding a token from semaphore.
+
+        :returns: DeferredList of the results of every handler.
+        '''
+        return defer.DeferredList([
+            semaphore.run(event_handler.listen_fn, event)
+            for event_handler in event_handlers])
+
+    def fire_events(self, events, collect_results=False, priority=0):
+        '''
+        See :py:func:`IEventDispatcher.fire_events`
+
+        Events with identical details share a single handler resolution, and each phase is run
+        for the whole batch with a single DeferredList. Details of events whose event_details
+        are empty are extracted with the detail_extractor, if the dispatcher has one.
+
+        :param priority: Priority of the batch in the admission queue. See fire_event.
+        '''
+        if not self.running:
+            DEV_LOGGER.warning('Events received but dispatcher is not running')
+            return defer.succeed([] if collect_results else None)
+
+        events = list(events)
+        if self._journal is not None:
+            dispatch_fn = self._dispatch_journaled_batch
+        else:
+            dispatch_fn = self._dispatch_batch
 
-        return self._run_phase(None, iter(self._phases), phase_dict, event)
+        if self._instrumentation is not None:
+            return self._admit(priority, dispatch_fn, events, collect_results).addBoth(
+                self._instrumentation.record_since_cb,
+                METRIC_FIRE,
+                None,
+                self._instrumentation.clock())
 
-    @classmethod
-    def _run_phase(cls, _result, phase_iter, phase_dict, event):
+        return self._admit(priority, dispatch_fn, events, collect_results)
+
+    def _dispatch_journaled_batch(self, events, collect_results):
         '''
-        Run the next phase of event handlers
+        Journal a batch of events that's been admitted then dispatch it.
         '''
         try:
-            phase = phase_iter.next()
-        except StopIteration:
-            return defer.succeed(None)
+            self._journal.append_many(events)
+        except Exception:
+            return defer.fail()
+        return self._dispatch_batch(events, collect_results)
+
+    def replay_journal(self, offset=0, batch_size=256):
+        '''
+        Fire the events in the dispatcher's journal from offset again, without journaling them
+        a second time. Events are dispatched in batches of batch_size, as with fire_events,
+        each batch completing every phase before the next is read. Batches are dispatched
+        cooperatively so a long replay doesn't hold up the reactor.
+
+        :returns: Deferred that will callback with the offset after the last event replayed,
+            from which a later replay can carry on, or fail with ValueError if the dispatcher
+            has no journal.
+        '''
+        if self._journal is None:
+            return defer.fail(ValueError('EventDispatcher has no journal to replay'))
+        if not self.running:
+            DEV_LOGGER.warning('Replay requested but dispatcher is not running')
+            return defer.succeed(offset)
+
+        replayed_offset = [offset]
+
+        def flushed_cb(_):
+            '''Replay every record appended so far once written'''
+            replay_task = cooperate(
+                self._replay_batches(self._journal.read(offset), batch_size, replayed_offset),
+                self._reactor)
+            return replay_task.whenDone()
+
+        replay_deferred = self._journal.flush().addCallback(flushed_cb)
+        return replay_deferred.addCallback(lambda _: replayed_offset[0])
+
+    def _replay_batches(self, records, batch_size, replayed_offset):
+        '''
+        Dispatch records in batches, yielding the Deferred of each batch.
+        '''
+        events = []
+        for next_offset, event, event_details in records:
+            events.append((event, event_details))
+            if len(events) >= batch_size:
+                yield self._admit(0, self._dispatch_batch, events, False)
+                replayed_offset[0] = next_offset
+                events = []
+        if events:
+            yield self._admit(0, self._dispatch_batch, events, False)
+            replayed_offset[0] = next_offset
+
+    def _dispatch_batch(self, events, collect_results):
+        '''
+        Resolve handlers for a batch of events and run them through every phase together.
+        '''
+        if self._dead_event_handler_ids:
+            self._remove_dead_event_handlers()
+        plans = {}
+        batch = []
+        ordering_keys = [] if self._ordering_keyword is not None else None
+        detail_extractor = self._detail_extractor
+        if detail_extractor is not None:
+            # Extract every event's details before any max_calls are counted so that an
+            # extractor failing fails the whole batch without side effects.
+            try:
+                extracted = [
+                    None if event_details else detail_extractor(event)
+                    for event, event_details in events]
+            except Exception:
+                return defer.fail()
+        else:
+            extracted = itertools.repeat(None)
+
+        for (event, event_details), detail_values in itertools.izip(events, extracted):
+            if detail_values is not None:
+                plan_key = detail_values
+            else:
+                plan_key = frozenset(event_details.iteritems())
+            try:
+                phase_plan = plans[plan_key]
+            except KeyError:
+                phase_plan = plans[plan_key] = self._get_phase_plan(
+                    event_details, plan_key, detail_values)
+            if phase_plan.limited and self._consume_limited_calls(phase_plan):
+                # Later events in the batch must be resolved again without the removed handlers
+                plans.clear()
+            batch.append((event, phase_plan))
+            if ordering_keys is not None:
+                ordering_keys.append(self._get_ordering_key(event_details, detail_values))
 
         DEV_LOGGER.debug(
-            'Running phase %r for event %r. Contains %r',
-            phase,
-            event,
-            phase_dict[phase])
+            'Firing batch of %r events with %r distinct details', len(batch), len(plans))
+
+        results = [[] for _ in batch] if collect_results else None
+
+        if not any(phase_plan for _, phase_plan in batch):
+            return defer.succeed(results)
+
+        self._in_flight_events += 1
+        if ordering_keys is not None:
+            batch_deferred = self._run_batch_in_order(batch, ordering_keys, results)
+        else:
+            batch_deferred = self._run_batch_phase(None, iter(self._phases), batch, results)
+        return batch_deferred.addBoth(self._event_complete_cb)
 
-        phase_deferreds = [
-            defer.maybeDeferred(event_handler.listen_fn, event)
-            for event_handler in phase_dict[phase]]
+    def _run_batch_in_order(self, batch, ordering_keys, results):
+        '''
+        Run each event in batch through every phase on its own, in order with other events
+        sharing its ordering key.
+
+        :returns: Deferred that will callback with results once every event has completed.
+        '''
+        event_deferreds = []
+        for event_index, (event_plan, ordering_key) in enumerate(
+                itertools.izip(batch, ordering_keys)):
+            if not event_plan[1]:
+                continue
+            event_deferreds.append(self._run_in_order(
+                ordering_key,
+                self._run_batch_phase,
+                None,
+                iter(self._phases),
+                [event_plan],
+                None if results is None else [results[event_index]]))
+        return defer.DeferredList(event_deferreds, consumeErrors=True).addCallback(
+            lambda _: results)
+
+    def _run_batch_phase(self, _result, phase_iter, batch, results):
+        '''
+        Run the remaining phases of event handlers for every event in batch.
 
-        return defer.DeferredList(phase_deferreds).addCallback(
-            cls._run_phase, phase_iter, phase_dict, event)
+        When results is not None the (success, result) tuple for each handler is appended to the
+        list for its event. Like _run_phase, only handlers that return a Deferred (or raise) are
+        waited on with a DeferredList.
+        '''
+        phase_semaphores = self._phase_semaphores
+        instrumentation = self._instrumentation
+        phase_started = None
+        for phase in phase_iter:
+            DEV_LOGGER.debug('Running phase %r for batch of %r events', phase, len(batch))
+
+            if instrumentation is not None:
+                phase_started = instrumentation.clock()
+
+            semaphore = phase_semaphores.get(phase)
+            phase_deferreds = []
+            owners = []
+            for event_index, (event, phase_dict) in enumerate(batch):
+                for event_handler in phase_dict.get(phase, ()):
+                    if semaphore is not None:
+                        phase_deferreds.append(semaphore.run(event_handler.listen_fn, event))
+                        owners.append(event_index)
+                        continue
+                    try:
+                        result = event_handler.listen_fn(event)
+                    except Exception:
+                        result = defer.fail()
+                    else:
+                        if event_handler.sync or not isinstance(result, defer.Deferred):
+                            if results is not None:
+                                results[event_index].append((True, result))
+                            continue
+                    phase_deferreds.append(result)
+                    owners.append(event_index)
+
+            if phase_deferreds:
+                phase_list = defer.DeferredList(
+                    phase_deferreds, consumeErrors=results is not None)
+                if instrumentation is not None:
+                    phase_list.addCallback(
+                        instrumentation.record_since_cb, METRIC_PHASE, phase, phase_started)
+                if results is not None:
+                    phase_list.addCallback(self._collect_batch_results, owners, results)
+                return phase_list.addCallback(self._run_batch_phase, phase_iter, batch, results)
+
+            if instrumentation is not None:
+                instrumentation.record_since(METRIC_PHASE, phase, phase_started)
+
+        return defer.succeed(results)
+
+    @staticmethod
+    def _collect_batch_results(phase_results, owners, results):
+        '''
+        Append the results of a batch phase to the results list of the event they belong to.
+        '''
+        for event_index, handler_result in zip(owners, phase_results):
+            results[event_index].append(handler_result)
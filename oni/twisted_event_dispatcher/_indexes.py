@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+"""
+Index engines used by EventDispatcher to find which registrations match some event_details
+"""
+import bisect
+import heapq
+import itertools
+import logging
+import sys
+
+from oni.twisted_event_dispatcher.matchers import OneOf
+from oni.twisted_event_dispatcher.matchers import Prefix
+from oni.twisted_event_dispatcher.matchers import Range
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+_EMPTY_POSTING = frozenset()
+_EMPTY_POSTINGS = {}
+
+# Exact postings of BitsetMatchIndex with at least this many slots are stored as bitmasks,
+# and go back to tuples of slots once they fall below half of it.
+_DENSE_POSTING_SIZE = 64
+
+
+def _exact_values(detail_filter):
+    '''
+    :returns: Values detail_filter is stored against in the exact (and None) postings
+    '''
+    if isinstance(detail_filter, OneOf):
+        return detail_filter.values
+    return (detail_filter,)
+
+
+class _TrieNode(object):
+    '''
+    Node of a _PrefixTrie
+    '''
+    __slots__ = ('children', 'items')
+
+    def __init__(self):
+        self.children = {}
+        self.items = set()
+
+
+class _PrefixTrie(object):
+    '''
+    Character trie of Prefix matchers. Each node holds the items of the prefixes ending there,
+    so looking up a value only visits as many nodes as the value has characters.
+    '''
+    def __init__(self):
+        self._root = _TrieNode()
+        self.size = 0
+
+    def add(self, prefix, item):
+        '''
+        Store item against prefix
+        '''
+        node = self._root
+        for character in prefix:
+            child = node.children.get(character)
+            if child is None:
+                child = node.children[character] = _TrieNode()
+            node = child
+        node.items.add(item)
+        self.size += 1
+
+    def remove(self, prefix, item):
+        '''
+        Remove item stored against prefix, pruning any nodes left empty
+        '''
+        path = [self._root]
+        for character in prefix:
+            path.append(path[-1].children[character])
+        path[-1].items.remove(item)
+        self.size -= 1
+
+        for depth in range(len(prefix), 0, -1):
+            node = path[depth]
+            if node.items or node.children:
+                break
+            del path[depth - 1].children[prefix[depth - 1]]
+
+    def match(self, value):
+        '''
+        :returns: List of the items of every prefix of value
+        '''
+        if not isinstance(value, basestring):
+            return []
+        node = self._root
+        items = list(node.items)
+        for character in value:
+            node = node.children.get(character)
+            if node is None:
+                break
+            items.extend(node.items)
+        return items
+
+    def memory_stats(self):
+        '''
+        :returns: (nodes, estimated_bytes) tuple
+        '''
+        nodes = 0
+        estimated_bytes = 0
+        pending = [self._root]
+        while pending:
+            node = pending.pop()
+            nodes += 1
+            estimated_bytes += (
+                sys.getsizeof(node) + sys.getsizeof(node.children) + sys.getsizeof(node.items))
+            pending.extend(node.children.itervalues())
+        return nodes, estimated_bytes
+
+
+class _RangeList(object):
+    '''
+    Range matchers sorted by their lower bound. Looking up a value bisects to find the ranges
+    starting at or before it and only checks the upper bounds of those.
+    '''
+    def __init__(self):
+        # Parallel lists; open lower bounds sort first
+        self._lows = []
+        self._ranges = []
+
+    def __len__(self):
+        return len(self._ranges)
+
+    @staticmethod
+    def _low_key(range_matcher):
+        '''
+        :returns: Sort key of range_matcher's lower bound
+        '''
+        return (range_matcher.low is not None, range_matcher.low)
+
+    def add(self, range_matcher, item):
+        '''
+        Store item against range_matcher
+        '''
+        low_key = self._low_key(range_matcher)
+        index = bisect.bisect_right(self._lows, low_key)
+        self._lows.insert(index, low_key)
+        self._ranges.insert(index, (range_matcher, item))
+
+    def remove(self, range_matcher, item):
+        '''
+        Remove item stored against range_matcher
+        '''
+        low_key = self._low_key(range_matcher)
+        index = bisect.bisect_left(self._lows, low_key)
+        index = self._ranges.index((range_matcher, item), index)
+        del self._lows[index]
+        del self._ranges[index]
+
+    def match(self, value):
+        '''
+        :returns: List of the items of every range containing value
+        '''
+        if value is None:
+            return []
+        end = bisect.bisect_right(self._lows, (True, value))
+        return [
+            item for range_matcher, item in itertools.islice(self._ranges, end)
+            if range_matcher.high is None or value < range_matcher.high]
+
+    def memory_stats(self):
+        '''
+        :returns: (ranges, estimated_bytes) tuple
+        '''
+        return len(self._ranges), sys.getsizeof(self._lows) + sys.getsizeof(self._ranges)
+
+
+class SetMatchIndex(object):
+    '''
+    Index storing each (keyword, value) posting as a set of registrations.
+
+    Matching unions the wildcard (None) and exact postings, and any prefix or range matchers,
+    for each detail and then intersects the results. OneOf matchers are expanded into the exact
+    postings of each of their values.
+
+    :param allowed_match_spec_keywords: Sequence of keywords registrations can be matched on.
+    '''
+    def __init__(self, allowed_match_spec_keywords):
+        self._allowed_match_spec_keywords = tuple(allowed_match_spec_keywords)
+        self._postings = {}
+        self._prefixes = {}
+        self._ranges = {}
+
+    def add(self, event_handler, detail_values=None):
+        '''
+        Index event_handler against each of its details, or detail_values if given
+        '''
+        if detail_values is None:
+            detail_values = event_handler.detail_values
+        for detail, detail_filter in itertools.izip(
+                self._allowed_match_spec_keywords, detail_values):
+            if isinstance(detail_filter, Prefix):
+                self._prefixes.setdefault(detail, _PrefixTrie()).add(
+                    detail_filter.prefix, event_handler)
+            elif isinstance(detail_filter, Range):
+                self._ranges.setdefault(detail, _RangeList()).add(detail_filter, event_handler)
+            else:
+                postings = self._postings.setdefault(detail, {})
+                for value in _exact_values(detail_filter):
+                    postings.setdefault(value, set()).add(event_handler)
+
+    def remove(self, event_handler, detail_values=None):
+        '''
+        Remove event_handler, indexed against detail_values if given, from the index, pruning
+        any postings left empty
+        '''
+        if detail_values is None:
+            detail_values = event_handler.detail_values
+        for detail, detail_filter in itertools.izip(
+                self._allowed_match_spec_keywords, detail_values):
+            if isinstance(detail_filter, Prefix):
+                prefixes = self._prefixes[detail]
+                prefixes.remove(detail_filter.prefix, event_handler)
+                if not prefixes.size:
+                    del self._prefixes[detail]
+            elif isinstance(detail_filter, Range):
+                ranges = self._ranges[detail]
+                ranges.remove(detail_filter, event_handler)
+                if not ranges:
+                    del self._ranges[detail]
+            else:
+                postings = self._postings[detail]
+                for value in _exact_values(detail_filter):
+                    posting = postings[value]
+                    posting.remove(event_handler)
+                    if not posting:
+                        del postings[value]
+                if not postings:
+                    del self._postings[detail]
+
+    def _get_set_of_event_handlers(self, key, value):
+        '''
+        See which event_handlers in the postings for a single keyword match value
+        '''
+        postings = self._postings.get(key, _EMPTY_POSTINGS)
+        matched = postings.get(None, _EMPTY_POSTING).union(postings.get(value, _EMPTY_POSTING))
+        prefixes = self._prefixes.get(key)
+        if prefixes is not None:
+            matched = matched.union(prefixes.match(value))
+        ranges = self._ranges.get(key)
+        if ranges is not None:
+            matched = matched.union(ranges.match(value))
+        return matched
+
+    def match(self, event_details):
+        '''
+        :returns: Iterable of registrations whose match_spec matches event_details.
+
+        Lookups never modify the index.
+        '''
+        return self._match_items(event_details.iteritems())
+
+    def match_values(self, detail_values):
+        '''
+        :returns: Iterable of registrations whose match_spec matches detail_values, the value
+            of every one of allowed_match_spec_keywords in the same order.
+        '''
+        return self._match_items(
+            itertools.izip(self._allowed_match_spec_keywords, detail_values))
+
+    def _match_items(self, detail_items):
+        '''
+        :returns: Iterable of registrations whose match_spec matches every (key, value) pair of
+            detail_items.
+        '''
+        filter_sets = []
+        for key, value in detail_items:
+            filter_set = self._get_set_of_event_handlers(key, value)
+            if not filter_set:
+                return ()
+            filter_sets.append(filter_set)
+
+        DEV_LOGGER.debug('Found %r filter_sets', len(filter_sets))
+
+        if len(filter_sets) < 1:
+            return ()
+        elif len(filter_sets) == 1:
+            return filter_sets[0]
+        else:
+            return filter_sets[0].intersection(*(filter_sets[1:]))
+
+    def memory_stats(self):
+        '''
+        :returns: dict with the number of postings and an estimate of the bytes used by the index
+        '''
+        postings_count = 0
+        estimated_bytes = sys.getsizeof(self._postings)
+        for postings in self._postings.itervalues():
+            postings_count += len(postings)
+            estimated_bytes += sys.getsizeof(postings)
+            for posting in postings.itervalues():
+                estimated_bytes += sys.getsizeof(posting)
+        for matcher_index in itertools.chain(
+                self._prefixes.itervalues(), self._ranges.itervalues()):
+            matcher_postings, matcher_bytes = matcher_index.memory_stats()
+            postings_count += matcher_postings
+            estimated_bytes += matcher_bytes
+        return {
+            'postings': postings_count,
+            'estimated_bytes': estimated_bytes,
+        }
+
+
+class BitsetMatchIndex(object):
+    '''
+    Index that gives each registration an integer slot and stores each wildcard (None) posting,
+    and each (keyword, value) posting of at least _DENSE_POSTING_SIZE registrations, as an
+    integer bitmask of slots. Smaller exact postings are tuples of slots, as a bitmask is as
+    wide as the highest slot in it and one for each of many rarely shared values would make
+    memory grow with the square of the number of registrations.
+
+    Matching is a bitwise OR of the wildcard and exact postings, and the bits of any prefix or
+    range matchers, for each detail followed by a bitwise AND across details, so no
+    intermediate sets are built however many registrations exist. OneOf matchers are expanded
+    into the exact postings of each of their values. Freed slots are reused lowest first to keep
+    the masks narrow.
+
+    :param allowed_match_spec_keywords: Sequence of keywords registrations can be matched on.
+    '''
+    def __init__(self, allowed_match_spec_keywords):
+        self._allowed_match_spec_keywords = tuple(allowed_match_spec_keywords)
+        self._postings = {keyword: {} for keyword in self._allowed_match_spec_keywords}
+        self._prefixes = {}
+        self._ranges = {}
+        self._slot_entries = []
+        self._slots = {}
+        self._free_slots = []
+
+    def _allocate_slot(self, event_handler):
+        '''
+        :returns: Free slot now assigned to event_handler
+        '''
+        if self._free_slots:
+            slot = heapq.heappop(self._free_slots)
+            self._slot_entries[slot] = event_handler
+        else:
+            slot = len(self._slot_entries)
+            self._slot_entries.append(event_handler)
+        self._slots[event_handler.id] = slot
+        return slot
+
+    def add(self, event_handler, detail_values=None):
+        '''
+        Index event_handler against each of its details, or detail_values if given
+        '''
+        if detail_values is None:
+            detail_values = event_handler.detail_values
+        slot = self._allocate_slot(event_handler)
+        bit = 1 << slot
+        for detail, detail_filter in itertools.izip(
+                self._allowed_match_spec_keywords, detail_values):
+            if isinstance(detail_filter, Prefix):
+                self._prefixes.setdefault(detail, _PrefixTrie()).add(detail_filter.prefix, bit)
+            elif isinstance(detail_filter, Range):
+                self._ranges.setdefault(detail, _RangeList()).add(detail_filter, bit)
+            else:
+                postings = self._postings[detail]
+                for value in _exact_values(detail_filter):
+                    posting = postings.get(value)
+                    if posting is None:
+                        postings[value] = bit if value is None else (slot,)
+                    elif not isinstance(posting, tuple):
+                        postings[value] = posting | bit
+                    elif len(posting) + 1 < _DENSE_POSTING_SIZE:
+                        postings[value] = posting + (slot,)
+                    else:
+                        dense_posting = bit
+                        for posting_slot in posting:
+                            dense_posting |= 1 << posting_slot
+                        postings[value] = dense_posting
+
+    def remove(self, event_handler, detail_values=None):
+        '''
+        Remove event_handler, indexed against detail_values if given, from the index and free
+        its slot, pruning any postings left empty
+        '''
+        if detail_values is None:
+            detail_values = event_handler.detail_values
+        slot = self._slots.pop(event_handler.id)
+        bit = 1 << slot
+        mask = ~bit
+        for detail, detail_filter in itertools.izip(
+                self._allowed_match_spec_keywords, detail_values):
+            if isinstance(detail_filter, Prefix):
+                prefixes = self._prefixes[detail]
+                prefixes.remove(detail_filter.prefix, bit)
+                if not prefixes.size:
+                    del self._prefixes[detail]
+            elif isinstance(detail_filter, Range):
+                ranges = self._ranges[detail]
+                ranges.remove(detail_filter, bit)
+                if not ranges:
+                    del self._ranges[detail]
+            else:
+                postings = self._postings[detail]
+                for value in _exact_values(detail_filter):
+                    posting = postings[value]
+                    if isinstance(posting, tuple):
+                        posting = tuple(
+                            posting_slot for posting_slot in posting if posting_slot != slot)
+                    else:
+                        posting &= mask
+                        if value is not None:
+                            posting = self._sparse_posting(posting)
+                    if posting:
+                        postings[value] = posting
+                    else:
+                        del postings[value]
+
+        self._slot_entries[slot] = None
+        heapq.heappush(self._free_slots, slot)
+
+    @staticmethod
+    def _sparse_posting(posting):
+        '''
+        :returns: posting, a bitmask, as a tuple of slots if it has fallen below half of
+            _DENSE_POSTING_SIZE slots
+        '''
+        # bin() is linear in the width of the mask, as is the AND that produced it
+        bits = bin(posting)[:1:-1]
+        if bits.count('1') >= _DENSE_POSTING_SIZE // 2:
+            return posting
+        return tuple(slot for slot, slot_bit in enumerate(bits) if slot_bit == '1')
+
+    def match(self, event_details):
+        '''
+        :returns: Iterable of registrations whose match_spec matches event_details.
+        '''
+        if not event_details:
+            return ()
+        return self._match_items(event_details.iteritems())
+
+    def match_values(self, detail_values):
+        '''
+        :returns: Iterable of registrations whose match_spec matches detail_values, the value
+            of every one of allowed_match_spec_keywords in the same order.
+        '''
+        if not detail_values:
+            return ()
+        return self._match_items(
+            itertools.izip(self._allowed_match_spec_keywords, detail_values))
+
+    def _match_items(self, detail_items):
+        '''
+        :returns: Iterable of registrations whose match_spec matches every (key, value) pair of
+            detail_items.
+        '''
+        matched = -1
+        for key, value in detail_items:
+            postings = self._postings.get(key)
+            if postings is None:
+                return ()
+            detail_mask = postings.get(None, 0)
+            posting = postings.get(value)
+            if isinstance(posting, tuple):
+                for slot in posting:
+                    detail_mask |= 1 << slot
+            elif posting is not None:
+                detail_mask |= posting
+            prefixes = self._prefixes.get(key)
+            if prefixes is not None:
+                for bit in prefixes.match(value):
+                    detail_mask |= bit
+            ranges = self._ranges.get(key)
+            if ranges is not None:
+                for bit in ranges.match(value):
+                    detail_mask |= bit
+            matched &= detail_mask
+            if not matched:
+                return ()
+
+        return self._entries_for_mask(matched)
+
+    def _entries_for_mask(self, mask):
+        '''
+        :returns: List of registrations whose slots are set in mask
+        '''
+        # bin() is linear in the width of the mask and lets str.find skip runs of zero bits.
+        # Reversed so that string index == slot.
+        bits = bin(mask)[:1:-1]
+        slot_entries = self._slot_entries
+        entries = []
+        slot = bits.find('1')
+        while slot != -1:
+            entries.append(slot_entries[slot])
+            slot = bits.find('1', slot + 1)
+        return entries
+
+    def memory_stats(self):
+        '''
+        :returns: dict with the number of postings and an estimate of the bytes used by the index
+        '''
+        postings_count = 0
+        estimated_bytes = (
+            sys.getsizeof(self._postings) +
+            sys.getsizeof(self._slot_entries) +
+            sys.getsizeof(self._slots) +
+            sys.getsizeof(self._free_slots))
+        for postings in self._postings.itervalues():
+            postings_count += len(postings)
+            estimated_bytes += sys.getsizeof(postings)
+            for posting in postings.itervalues():
+                estimated_bytes += sys.getsizeof(posting)
+        for matcher_index in itertools.chain(
+                self._prefixes.itervalues(), self._ranges.itervalues()):
+            matcher_postings, matcher_bytes = matcher_index.memory_stats()
+            postings_count += matcher_postings
+            estimated_bytes += matcher_bytes
+        return {
+            'postings': postings_count,
+            'estimated_bytes': estimated_bytes,
+        }
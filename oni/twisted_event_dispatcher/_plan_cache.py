@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of resolved dispatch plans
+"""
+import collections
+import logging
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+class DispatchPlanCache(object):
+    '''
+    Bounded LRU cache of dispatch plans keyed on frozen event_details.
+
+    Every entry is only valid for the registry generation it was stored under. As soon as a
+    lookup or store is made with a different generation the whole cache is dropped.
+
+    :param int max_size: Maximum number of plans to keep. 0 disables caching.
+    '''
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._plans = collections.OrderedDict()
+        self._generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_generation(self, generation):
+        '''
+        Drop every plan if the registry has changed since they were stored.
+        '''
+        if generation != self._generation:
+            if self._plans:
+                DEV_LOGGER.debug(
+                    'Invalidating %r cached plans; generation %r -> %r',
+                    len(self._plans), self._generation, generation)
+                self._plans.clear()
+                self.invalidations += 1
+            self._generation = generation
+
+    def get(self, key, generation):
+        '''
+        :returns: Cached plan for key or None if there isn't one for this generation.
+        '''
+        self._check_generation(generation)
+        try:
+            plan = self._plans.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Reinsert to mark as most recently used
+        self._plans[key] = plan
+        self.hits += 1
+        return plan
+
+    def store(self, key, generation, plan):
+        '''
+        Store plan for key, evicting the least recently used plan if the cache is full.
+        '''
+        if self._max_size <= 0:
+            return
+        self._check_generation(generation)
+        self._plans[key] = plan
+        if len(self._plans) > self._max_size:
+            self._plans.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        '''
+        :returns: dict of counters describing cache effectiveness.
+        '''
+        return {
+            'size': len(self._plans),
+            'max_size': self._max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Wire protocol between a ShardedEventDispatcher and its worker processes
+"""
+import logging
+import pickle
+import struct
+
+from twisted.protocols import basic
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+class MessageConnection(basic.Int32StringReceiver):
+    '''
+    Sends and receives pickled messages, one per length prefixed frame.
+
+    Messages are pickled as soon as they're sent, so anything unpicklable is reported to the
+    sender, but the frames are buffered and written together once per reactor iteration or as
+    soon as max_batch_size are waiting, whichever is first.
+
+    :param message_received: Called with each message received.
+    :param int max_batch_size: Most frames to buffer before writing.
+    :param reactor: Reactor used to schedule writes.
+    '''
+    MAX_LENGTH = 2 ** 31 - 1
+
+    def __init__(self, message_received, max_batch_size, reactor):
+        self._message_received = message_received
+        self._max_batch_size = max_batch_size
+        self._reactor = reactor
+        self._frames = []
+        self._flush_call = None
+
+    def send(self, message):
+        '''
+        Queue message to be written
+
+        :raises pickle.PicklingError: or anything else pickling message raises
+        '''
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        self._frames.append(struct.pack(self.structFormat, len(data)))
+        self._frames.append(data)
+        if len(self._frames) >= self._max_batch_size * 2:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self._reactor.callLater(0, self.flush)
+
+    def flush(self):
+        '''
+        Write every buffered frame
+        '''
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if self._frames and self.transport is not None:
+            self.transport.write(''.join(self._frames))
+        del self._frames[:]
+
+    def stringReceived(self, string):
+        self._message_received(pickle.loads(string))
+
+    def connectionLost(self, reason=None):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        del self._frames[:]
+        basic.Int32StringReceiver.connectionLost(self, reason)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Worker process of a ShardedEventDispatcher.
+
+Run as ``python -m oni.twisted_event_dispatcher._shard_worker``. Messages are read from stdin
+and replies written to what was stdout; stdout itself is redirected to stderr so handlers
+printing can't corrupt the stream. The worker exits once stdin is closed and every request
+it has received has completed.
+"""
+import logging
+import os
+import sys
+import traceback
+
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.internet import interfaces
+
+from oni.twisted_event_dispatcher._dispatcher import EventDispatcher
+from oni.twisted_event_dispatcher._shard_protocol import MessageConnection
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+def _portable_failure(failure):
+    '''
+    :returns: (description, traceback) tuple describing failure that can always be pickled
+    '''
+    return repr(failure.value), failure.getTraceback()
+
+
+@implementer(interfaces.IHalfCloseableProtocol)
+class _WorkerConnection(MessageConnection):
+    '''
+    Connection to the parent over stdio that tells the worker when the parent closes stdin
+    '''
+    def __init__(self, worker, max_batch_size, reactor):
+        MessageConnection.__init__(self, worker.message_received, max_batch_size, reactor)
+        self._worker = worker
+
+    def readConnectionLost(self):
+        self._worker.input_closed()
+
+    def writeConnectionLost(self):
+        pass
+
+    def connectionLost(self, reason=None):
+        MessageConnection.connectionLost(self, reason)
+        self._worker.connection_lost()
+
+
+class ShardWorker(object):
+    '''
+    Runs an EventDispatcher on behalf of a ShardedEventDispatcher.
+
+    Every request carries an id and is answered with a ('result', request_id, success, value)
+    message. Events are run one at a time for each value of the partition keyword, in the order
+    they were received, while events for different values run concurrently.
+
+    :param reactor: Reactor the worker runs on.
+    :param int max_batch_size: Most replies to buffer before writing.
+    '''
+    def __init__(self, reactor, max_batch_size=256):
+        self._reactor = reactor
+        self.connection = _WorkerConnection(self, max_batch_size, reactor)
+        self._dispatcher = None
+        self._partition_keyword = None
+        self._handler_ids = {}
+        self._partition_locks = {}
+        self._outstanding = 0
+        self._input_closed = False
+
+    def message_received(self, message):
+        '''
+        Handle a single request from the parent
+        '''
+        request_type, request_id = message[:2]
+        self._outstanding += 1
+        result_deferred = defer.maybeDeferred(
+            getattr(self, '_handle_' + request_type), *message[2:])
+        result_deferred.addCallbacks(
+            self._reply, self._reply_failure, callbackArgs=(request_id,),
+            errbackArgs=(request_id,))
+
+    def _reply(self, value, request_id):
+        '''
+        Send successful result of a request to the parent
+        '''
+        try:
+            self.connection.send(('result', request_id, True, value))
+        except Exception:  # Pickling raises all sorts; pylint: disable=broad-except
+            self.connection.send((
+                'result', request_id, False, ('Unpicklable result', traceback.format_exc())))
+        self._request_complete()
+
+    def _reply_failure(self, failure, request_id):
+        '''
+        Send failure of a request to the parent
+        '''
+        self.connection.send(('result', request_id, False, _portable_failure(failure)))
+        self._request_complete()
+
+    def _request_complete(self):
+        '''
+        Exit if this was the last request after the parent closed stdin
+        '''
+        self._outstanding -= 1
+        if self._input_closed and not self._outstanding:
+            self._shutdown()
+
+    def _handle_configure(
+            self, allowed_match_spec_keywords, partition_keyword, dispatcher_options):
+        '''
+        Create the dispatcher
+        '''
+        self._partition_keyword = partition_keyword
+        self._dispatcher = EventDispatcher(allowed_match_spec_keywords, **dispatcher_options)
+        self._dispatcher.start()
+
+    def _handle_add(self, handler_id, listen_fn, phase, match_spec):
+        '''
+        Register handler under the id the parent gave it
+        '''
+        add_deferred = self._dispatcher.add_event_handler(
+            listen_fn, phase, use_weakref=False, **match_spec)
+        return add_deferred.addCallback(
+            lambda local_handler_id: self._handler_ids.__setitem__(handler_id, local_handler_id))
+
+    def _handle_remove(self, handler_id):
+        '''
+        Remove handler registered under the id the parent gave it
+        '''
+        return self._dispatcher.remove_event_handler(self._handler_ids.pop(handler_id))
+
+    def _handle_fire(self, event, event_details, collect_results):
+        '''
+        Fire event once every earlier event with the same partition key has completed
+        '''
+        partition_key = event_details.get(self._partition_keyword)
+        lock = self._partition_locks.get(partition_key)
+        if lock is None:
+            lock = self._partition_locks[partition_key] = defer.DeferredLock()
+        fire_deferred = lock.run(self._fire, event, event_details, collect_results)
+        return fire_deferred.addBoth(self._release_partition_lock, partition_key, lock)
+
+    def _fire(self, event, event_details, collect_results):
+        '''
+        Fire a single event
+        '''
+        if not collect_results:
+            return self._dispatcher.fire_event(event, **event_details).addCallback(
+                lambda _: None)
+        return self._dispatcher.fire_events([(event, event_details)], True).addCallback(
+            lambda results: [
+                (success, value if success else _portable_failure(value))
+                for success, value in results[0]])
+
+    def _release_partition_lock(self, result, partition_key, lock):
+        '''
+        Forget the lock for partition_key once nothing is waiting on it
+        '''
+        if not lock.locked and not lock.waiting:
+            del self._partition_locks[partition_key]
+        return result
+
+    def input_closed(self):
+        '''
+        Called once the parent has closed stdin. Exit as soon as every request has completed.
+        '''
+        self._input_closed = True
+        if not self._outstanding:
+            self._shutdown()
+
+    def _shutdown(self):
+        '''
+        Stop the dispatcher and close the connection once any remaining replies are written
+        '''
+        if self._dispatcher is None:
+            stop_deferred = defer.succeed(None)
+        else:
+            stop_deferred = self._dispatcher.stop()
+        stop_deferred.addBoth(lambda _: self.connection.flush())
+        stop_deferred.addBoth(lambda _: self.connection.transport.loseConnection())
+
+    def connection_lost(self):
+        '''
+        Called once the connection to the parent has closed
+        '''
+        if self._reactor.running:
+            self._reactor.stop()
+
+
+def main():
+    '''
+    Run a worker over stdio until the parent closes stdin
+    '''
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    from twisted.internet import reactor
+    from twisted.internet import stdio
+
+    # Keep the real stdout for replies and send anything else written to it to stderr
+    reply_fd = os.dup(sys.stdout.fileno())
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    worker = ShardWorker(reactor)
+    stdio.StandardIO(worker.connection, stdout=reply_fd, reactor=reactor)
+    reactor.run()  # pylint: disable=no-member
+
+
+if __name__ == '__main__':
+    main()
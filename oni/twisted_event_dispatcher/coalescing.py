@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Coalescing of events for handlers that only need the latest event, or a batch of events, for
+each event_details.
+
+A handler opts in by passing a :py:class:`Coalesce` as coalesce to add_event_handler. Its
+events are then buffered separately for each distinct event_details. A buffer is delivered in
+a single call once window seconds have passed since its first event or once it holds
+max_events, whichever is first, and any buffers still waiting are delivered when the
+dispatcher is stopped.
+
+Buffering an event completes the handler's part in that event's phase immediately, so
+deliveries happen outside of phase ordering and events never wait on them.
+"""
+import functools
+import logging
+
+from twisted.internet import defer
+
+from oni.twisted_event_dispatcher._deferred_helpers import get_reactor
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+COALESCE_LAST = 'last'
+COALESCE_BATCH = 'batch'
+
+
+class Coalesce(object):
+    '''
+    How a handler's events should be coalesced.
+
+    :param float window: Seconds to buffer events for after the first. None to only deliver
+        on max_events.
+    :param int max_events: Deliver as soon as this many events are buffered. None to only
+        deliver after window.
+    :param str deliver: 'last' to call the handler with the most recent event only or 'batch'
+        to call it with a list of every event buffered, oldest first.
+    '''
+    def __init__(self, window=None, max_events=None, deliver=COALESCE_LAST):
+        if window is None and max_events is None:
+            raise ValueError('Coalesce needs a window or max_events')
+        if deliver not in (COALESCE_LAST, COALESCE_BATCH):
+            raise ValueError('Unknown deliver: {!r}'.format(deliver))
+        self.window = window
+        self.max_events = max_events
+        self.deliver = deliver
+
+    def __repr__(self):
+        return '{}(window={!r}, max_events={!r}, deliver={!r})'.format(
+            type(self).__name__, self.window, self.max_events, self.deliver)
+
+
+class _CoalesceBuffer(object):
+    '''
+    Events buffered for a single event_details
+    '''
+    __slots__ = ('events', 'count', 'delayed_call')
+
+    def __init__(self):
+        self.events = []
+        self.count = 0
+        self.delayed_call = None
+
+
+class Coalescer(object):
+    '''
+    Buffers the events of a single registration for each event_details and delivers them to
+    listen_fn.
+
+    :param listen_fn: Handler to deliver to.
+    :param Coalesce coalesce: How to coalesce.
+    :param reactor: Reactor used for window timers. Defaults to the global reactor.
+    '''
+    def __init__(self, listen_fn, coalesce, reactor=None):
+        self._listen_fn = listen_fn
+        self._coalesce = coalesce
+        self._reactor = reactor
+        self._buffers = {}
+        self._deliveries = set()
+        self.received = 0
+        self.delivered = 0
+
+    def submit(self, buffer_key, event):
+        '''
+        Buffer event under buffer_key, delivering the buffer if it's now full.
+        '''
+        self.received += 1
+        coalesce_buffer = self._buffers.get(buffer_key)
+        if coalesce_buffer is None:
+            coalesce_buffer = self._buffers[buffer_key] = _CoalesceBuffer()
+            if self._coalesce.window is not None:
+                coalesce_buffer.delayed_call = get_reactor(self._reactor).callLater(
+                    self._coalesce.window, self.flush, buffer_key)
+
+        if self._coalesce.deliver == COALESCE_LAST:
+            coalesce_buffer.events[:] = (event,)
+        else:
+            coalesce_buffer.events.append(event)
+        coalesce_buffer.count += 1
+
+        if self._coalesce.max_events is not None and (
+                coalesce_buffer.count >= self._coalesce.max_events):
+            self.flush(buffer_key)
+
+    def flush(self, buffer_key):
+        '''
+        Deliver the events buffered under buffer_key now.
+        '''
+        coalesce_buffer = self._buffers.pop(buffer_key)
+        if coalesce_buffer.delayed_call is not None and coalesce_buffer.delayed_call.active():
+            coalesce_buffer.delayed_call.cancel()
+
+        if self._coalesce.deliver == COALESCE_LAST:
+            payload, = coalesce_buffer.events
+        else:
+            payload = coalesce_buffer.events
+        self.delivered += 1
+
+        delivery = defer.maybeDeferred(self._listen_fn, payload)
+        if delivery.called:
+            delivery.addErrback(self._delivery_failed_eb)
+            return
+        self._deliveries.add(delivery)
+        delivery.addBoth(self._delivery_complete_cb, delivery)
+        delivery.addErrback(self._delivery_failed_eb)
+
+    def _delivery_complete_cb(self, result, delivery):
+        '''
+        Stop tracking a delivery once it's complete
+        '''
+        self._deliveries.discard(delivery)
+        return result
+
+    def _delivery_failed_eb(self, delivery_failure):
+        '''
+        Log a failed delivery
+        '''
+        DEV_LOGGER.error(
+            'Coalesced delivery to %r failed: %s',
+            self._listen_fn,
+            delivery_failure.getTraceback())
+
+    def flush_all(self):
+        '''
+        Deliver every buffer now.
+
+        :returns: Deferred that will callback once every delivery is complete.
+        '''
+        for buffer_key in self._buffers.keys():
+            self.flush(buffer_key)
+        return defer.DeferredList(list(self._deliveries))
+
+    def cancel(self):
+        '''
+        Discard every buffer without delivering it.
+        '''
+        for coalesce_buffer in self._buffers.itervalues():
+            if coalesce_buffer.delayed_call is not None and coalesce_buffer.delayed_call.active():
+                coalesce_buffer.delayed_call.cancel()
+        self._buffers.clear()
+
+    def stats(self):
+        '''
+        :returns: dict with the number of events received and deliveries made, and the number of
+            buffers waiting to be delivered.
+        '''
+        return {
+            'received': self.received,
+            'delivered': self.delivered,
+            'buffered': len(self._buffers),
+        }
+
+
+class _CoalescedRegistration(object):
+    '''
+    Stand-in for a coalesced registration in the dispatch plan for a single event_details.
+    '''
+    __slots__ = ('id', 'phase', 'sync', 'listen_fn')
+
+    def __init__(self, event_handler, buffer_key):
+        self.id = event_handler.id
+        self.phase = event_handler.phase
+        self.sync = True
+        self.listen_fn = functools.partial(event_handler.coalescer.submit, buffer_key)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Exceptions raised by twisted_event_dispatcher
+"""
+import logging
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+class EventDispatcherError(Exception):
+    '''
+    Base class for errors raised by twisted_event_dispatcher
+    '''
+
+
+class DispatchQueueFull(EventDispatcherError):
+    '''
+    An event was rejected because the dispatcher already has as many events queued as it
+    allows.
+    '''
+
+
+class EventDropped(EventDispatcherError):
+    '''
+    A queued event was dropped to make room for a newer one before it could be dispatched.
+    '''
+
+
+class ExecutorQueueFull(EventDispatcherError):
+    '''
+    A handler call was rejected because its executor already has as many calls pending as it
+    allows.
+    '''
+
+
+class HandlerTimeout(EventDispatcherError):
+    '''
+    A handler's Deferred was cancelled because it didn't fire within the handler's timeout.
+    '''
+
+
+class RemoteHandlerError(EventDispatcherError):
+    '''
+    A handler run in another process raised an exception.
+
+    :param str description: repr of the original exception
+    :param str remote_traceback: Formatted traceback from the other process
+    '''
+    def __init__(self, description, remote_traceback):
+        super(RemoteHandlerError, self).__init__(description, remote_traceback)
+        self.description = description
+        self.remote_traceback = remote_traceback
+
+    def __str__(self):
+        return '{}\n\nRemote traceback:\n{}'.format(self.description, self.remote_traceback)
+
+
+class SubscriptionClosed(EventDispatcherError):
+    '''
+    A subscription was closed while waiting for, or before, an event.
+    '''
+
+
+class ShardWorkerLost(EventDispatcherError):
+    '''
+    A worker process of a ShardedEventDispatcher exited before it completed a request.
+    '''
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Executors that handlers can be offloaded to.
+
+An executor has a submit(fn, *args) method returning a Deferred with the result of calling
+fn(*args), a check(fn) method that raises ValueError if fn can't be run by the executor, and a
+stop() method that may return a Deferred. Executors start lazily on the first submit so can be
+stopped and reused.
+"""
+import logging
+import multiprocessing
+import pickle
+import traceback
+
+from twisted.internet import defer
+from twisted.internet import threads
+from twisted.python import threadpool
+
+from oni.twisted_event_dispatcher._deferred_helpers import get_reactor
+from oni.twisted_event_dispatcher.errors import ExecutorQueueFull
+from oni.twisted_event_dispatcher.errors import RemoteHandlerError
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+class ReactorExecutor(object):
+    '''
+    Runs handlers directly on the reactor thread. This is what happens to handlers without an
+    executor; it's here for completeness.
+    '''
+    @staticmethod
+    def check(fn):
+        '''
+        Any callable can run on the reactor
+        '''
+
+    @staticmethod
+    def submit(fn, *args):
+        '''
+        :returns: Deferred with the result of fn(*args)
+        '''
+        return defer.maybeDeferred(fn, *args)
+
+    def stop(self):
+        '''
+        Nothing to stop
+        '''
+
+
+class _BoundedExecutor(object):
+    '''
+    Base for executors with a limit on how many calls may be pending at once
+
+    :param int max_pending: Maximum number of calls submitted but not finished. None is
+        unbounded.
+    '''
+    def __init__(self, max_pending=None):
+        self._max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+
+    def check(self, fn):
+        '''
+        Raise ValueError if fn can't be run by this executor
+        '''
+
+    def submit(self, fn, *args):
+        '''
+        :returns: Deferred with the result of fn(*args) or that fails with ExecutorQueueFull if
+            there are already max_pending calls pending. Cancelling it doesn't stop the call,
+            which stays pending until it finishes.
+        '''
+        if self._max_pending is not None and self.pending >= self._max_pending:
+            self.rejected += 1
+            return defer.fail(ExecutorQueueFull(
+                '{!r} already has {!r} calls pending'.format(self, self.pending)))
+
+        self.pending += 1
+        # Chained rather than returned so that cancelling, such as on a handler timeout, doesn't
+        # count the call as finished while its thread or process is still running it
+        result_deferred = defer.Deferred()
+        self._submit(fn, *args).addBoth(self._finished_cb).chainDeferred(result_deferred)
+        return result_deferred
+
+    def _finished_cb(self, result):
+        '''
+        Callback to track the number of calls pending
+        '''
+        self.pending -= 1
+        return result
+
+    def _submit(self, fn, *args):
+        '''
+        Actually run fn
+        '''
+        raise NotImplementedError()
+
+
+class ThreadPoolExecutor(_BoundedExecutor):
+    '''
+    Runs handlers in a pool of threads.
+
+    :param int size: Maximum number of threads.
+    :param int max_pending: Maximum number of calls submitted but not finished. None is
+        unbounded.
+    :param reactor: Reactor to deliver results on. Defaults to the global reactor.
+    '''
+    def __init__(self, size=4, max_pending=None, reactor=None):
+        super(ThreadPoolExecutor, self).__init__(max_pending)
+        self._size = size
+        self._reactor = reactor
+        self._pool = None
+
+    def _submit(self, fn, *args):
+        if self._pool is None:
+            self._pool = threadpool.ThreadPool(
+                minthreads=0, maxthreads=self._size, name='EventDispatcherThreadPoolExecutor')
+            self._pool.start()
+        return threads.deferToThreadPool(get_reactor(self._reactor), self._pool, fn, *args)
+
+    def stop(self):
+        '''
+        Stop the threads. The pool will be recreated on the next submit.
+
+        :returns: Deferred that will callback once every thread has finished.
+        '''
+        if self._pool is None:
+            return defer.succeed(None)
+        pool, self._pool = self._pool, None
+        # Joining waits for calls still running, so mustn't happen on the reactor thread
+        reactor = get_reactor(self._reactor)
+        return threads.deferToThreadPool(reactor, reactor.getThreadPool(), pool.stop)
+
+
+def _run_in_process(fn, args):
+    '''
+    Run fn(*args) in a pool process, returning a (success, result) tuple that can always be
+    pickled back to the parent.
+    '''
+    try:
+        result = fn(*args)
+        pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    # Everything has to go back to the parent; pylint: disable=broad-except
+    except Exception as exc:
+        return False, (repr(exc), traceback.format_exc())
+    return True, result
+
+
+class ProcessPoolExecutor(_BoundedExecutor):
+    '''
+    Runs handlers in a pool of local processes with multiprocessing. Handlers, events and
+    results must all be picklable.
+
+    :param int size: Number of processes. Defaults to the number of CPUs.
+    :param int max_pending: Maximum number of calls submitted but not finished. None is
+        unbounded.
+    :param reactor: Reactor to deliver results on. Defaults to the global reactor.
+    '''
+    def __init__(self, size=None, max_pending=None, reactor=None):
+        super(ProcessPoolExecutor, self).__init__(max_pending)
+        self._size = size
+        self._reactor = reactor
+        self._pool = None
+
+    @staticmethod
+    def check(fn):
+        '''
+        Raise ValueError if fn can't be pickled
+        '''
+        try:
+            pickle.dumps(fn, pickle.HIGHEST_PROTOCOL)
+        except Exception as exc:  # Pickling raises all sorts; pylint: disable=broad-except
+            raise ValueError('{!r} must be picklable to run in a process: {!r}'.format(fn, exc))
+
+    def _submit(self, fn, *args):
+        resolve = getattr(fn, 'resolve', None)
+        if resolve is not None:
+            # Weak proxies can't be pickled; send what they refer to instead
+            fn = resolve()
+            if fn is None:
+                return defer.succeed(None)
+
+        # The pool never calls back for a task it can't pickle, so check first
+        try:
+            pickle.dumps((fn, args), pickle.HIGHEST_PROTOCOL)
+        except Exception as exc:  # Pickling raises all sorts; pylint: disable=broad-except
+            return defer.fail(ValueError(
+                '{!r} and its arguments must be picklable to run in a process: {!r}'.format(
+                    fn, exc)))
+
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self._size)
+
+        reactor = get_reactor(self._reactor)
+        result_deferred = defer.Deferred()
+        self._pool.apply_async(
+            _run_in_process,
+            (fn, args),
+            callback=lambda result: reactor.callFromThread(
+                self._deliver_result, result_deferred, result))
+        return result_deferred
+
+    @staticmethod
+    def _deliver_result(result_deferred, result):
+        '''
+        Fire result_deferred on the reactor thread with the (success, result) tuple from a pool
+        process
+        '''
+        success, value = result
+        if success:
+            result_deferred.callback(value)
+        else:
+            result_deferred.errback(RemoteHandlerError(*value))
+
+    def stop(self):
+        '''
+        Stop the processes. The pool will be recreated on the next submit.
+
+        :returns: Deferred that will callback once every process has exited.
+        '''
+        if self._pool is None:
+            return defer.succeed(None)
+        pool, self._pool = self._pool, None
+        pool.close()
+        # Joining waits for calls still running, so mustn't happen on the reactor thread
+        reactor = get_reactor(self._reactor)
+        return threads.deferToThreadPool(reactor, reactor.getThreadPool(), pool.join)
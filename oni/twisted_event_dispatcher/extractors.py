@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Detail extractors let events be fired without event_details.
+
+An extractor is called with the event and returns a tuple of the value of each of the
+dispatcher's allowed_match_spec_keywords, in order. The helpers here compile attribute and item
+lookups once with :py:mod:`operator` so extraction doesn't run any Python code per detail.
+
+>>> import collections
+>>> User = collections.namedtuple('User', ('name', 'role'))
+>>> Event = collections.namedtuple('Event', ('event_type', 'user'))
+>>> extract = attributes('event_type', 'user.name')
+>>> extract(Event('user_created', User('bob', 'admin')))
+('user_created', 'bob')
+"""
+import logging
+import operator
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+def _tuple_getter(getter, count):
+    '''
+    :returns: getter, or for a single value a callable wrapping its result in a tuple as
+        operator's getters only return a tuple for more than one value.
+    '''
+    if count == 1:
+        return lambda event: (getter(event),)
+    return getter
+
+
+def attributes(*names):
+    '''
+    :param names: Attribute name, which may be dotted, for each keyword in order.
+    :returns: Extractor reading attributes of the event
+    '''
+    return _tuple_getter(operator.attrgetter(*names), len(names))
+
+
+def items(*keys):
+    '''
+    :param keys: Item key for each keyword in order.
+    :returns: Extractor reading items of the event, such as keys of a dict
+    '''
+    return _tuple_getter(operator.itemgetter(*keys), len(keys))
+
+
+def compile_detail_extractor(detail_extractor, allowed_match_spec_keywords):
+    '''
+    :param detail_extractor: None, 'attributes' or 'items' to use the keywords themselves as
+        attribute names or item keys, or an extractor.
+    :returns: Extractor or None
+    '''
+    if detail_extractor is None or callable(detail_extractor):
+        return detail_extractor
+    elif detail_extractor == 'attributes':
+        return attributes(*allowed_match_spec_keywords)
+    elif detail_extractor == 'items':
+        return items(*allowed_match_spec_keywords)
+    raise ValueError('Unknown detail_extractor: {!r}'.format(detail_extractor))
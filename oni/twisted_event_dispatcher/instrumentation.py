@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of event dispatch.
+
+An EventDispatcher with no sinks does no timing at all. Once a sink is added the dispatcher
+reports each of the following to it as ``sink.record(metric, key, duration, failed)``;
+
+``handler``
+    A single handler call. key is the registration id returned by add_event_handler. failed is
+    True if the handler raised or its Deferred failed.
+``phase``
+    A whole phase of an event (or batch). key is the phase.
+``fire``
+    An event (or batch) from being fired until it completed every phase. key is None.
+``admission_wait``
+    Time an event (or batch) spent queued waiting for admission. key is its priority.
+"""
+import bisect
+import functools
+import logging
+import timeit
+
+from twisted.internet import defer
+from twisted.python import failure
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+METRIC_HANDLER = 'handler'
+METRIC_PHASE = 'phase'
+METRIC_FIRE = 'fire'
+METRIC_ADMISSION_WAIT = 'admission_wait'
+
+
+class LatencyHistogram(object):
+    '''
+    Histogram of durations in seconds with fixed, roughly logarithmic, bucket bounds.
+
+    :param bucket_bounds: Ascending upper bounds of each bucket. A final unbounded bucket is
+        always added.
+    '''
+    default_bucket_bounds = (
+        0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, bucket_bounds=default_bucket_bounds):
+        self._bucket_bounds = tuple(bucket_bounds)
+        self._buckets = [0] * (len(self._bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, duration):
+        '''
+        Record a single duration
+        '''
+        self._buckets[bisect.bisect_left(self._bucket_bounds, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+
+    def snapshot(self):
+        '''
+        :returns: dict describing the histogram. buckets is a list of (upper_bound, count) pairs
+            with None as the upper bound of the last bucket.
+        '''
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'buckets': zip(self._bucket_bounds + (None,), self._buckets),
+        }
+
+
+class InMemorySink(object):
+    '''
+    Sink that aggregates everything it's given into histograms that can be inspected with
+    snapshot().
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget everything recorded so far
+        '''
+        self._handlers = {}
+        self._phases = {}
+        self._fire_latency = LatencyHistogram()
+        self._admission_wait = LatencyHistogram()
+
+    def record(self, metric, key, duration, failed=False):
+        '''
+        Record a single measurement
+        '''
+        if metric == METRIC_HANDLER:
+            try:
+                handler_stats = self._handlers[key]
+            except KeyError:
+                handler_stats = self._handlers[key] = {
+                    'calls': 0, 'errors': 0, 'latency': LatencyHistogram()}
+            handler_stats['calls'] += 1
+            if failed:
+                handler_stats['errors'] += 1
+            handler_stats['latency'].add(duration)
+        elif metric == METRIC_PHASE:
+            try:
+                phase_histogram = self._phases[key]
+            except KeyError:
+                phase_histogram = self._phases[key] = LatencyHistogram()
+            phase_histogram.add(duration)
+        elif metric == METRIC_FIRE:
+            self._fire_latency.add(duration)
+        elif metric == METRIC_ADMISSION_WAIT:
+            self._admission_wait.add(duration)
+
+    def snapshot(self):
+        '''
+        :returns: dict of everything recorded so far. handlers is keyed by registration id and
+            phases by phase.
+        '''
+        return {
+            'handlers': {
+                registration_id: {
+                    'calls': handler_stats['calls'],
+                    'errors': handler_stats['errors'],
+                    'latency': handler_stats['latency'].snapshot(),
+                }
+                for registration_id, handler_stats in self._handlers.iteritems()},
+            'phases': {
+                phase: phase_histogram.snapshot()
+                for phase, phase_histogram in self._phases.iteritems()},
+            'fire_latency': self._fire_latency.snapshot(),
+            'admission_wait': self._admission_wait.snapshot(),
+        }
+
+
+class CallbackSink(object):
+    '''
+    Sink that passes every measurement straight to callback as
+    ``callback(metric, key, duration, failed)``.
+    '''
+    def __init__(self, callback):
+        self._callback = callback
+
+    def record(self, metric, key, duration, failed=False):
+        '''
+        Pass measurement to callback
+        '''
+        self._callback(metric, key, duration, failed)
+
+
+class _InstrumentedRegistration(object):
+    '''
+    Stand-in for a registration in a dispatch plan whose listen_fn times every call.
+    '''
+    __slots__ = ('id', 'phase', 'sync', 'listen_fn')
+
+    def __init__(self, event_handler, instrumentation):
+        self.id = event_handler.id
+        self.phase = event_handler.phase
+        self.sync = event_handler.sync
+        self.listen_fn = functools.partial(
+            instrumentation.call_handler, event_handler.id, event_handler.listen_fn)
+
+
+class DispatchInstrumentation(object):
+    '''
+    Takes measurements for an EventDispatcher and passes them on to every sink.
+
+    :param sinks: Sequence of objects with a record(metric, key, duration, failed) method.
+    :param clock: Callable returning the current time in seconds.
+    '''
+    def __init__(self, sinks, clock=timeit.default_timer):
+        self.sinks = list(sinks)
+        self.clock = clock
+
+    def record(self, metric, key, duration, failed=False):
+        '''
+        Pass measurement to every sink
+        '''
+        for sink in self.sinks:
+            sink.record(metric, key, duration, failed)
+
+    def record_since(self, metric, key, started, failed=False):
+        '''
+        Record the time elapsed since started
+        '''
+        self.record(metric, key, self.clock() - started, failed)
+
+    def record_since_cb(self, result, metric, key, started):
+        '''
+        Callback version of record_since. Passes result through.
+        '''
+        self.record_since(metric, key, started, isinstance(result, failure.Failure))
+        return result
+
+    def wrap_registration(self, event_handler):
+        '''
+        :returns: Object standing in for event_handler in a dispatch plan that times its calls.
+        '''
+        return _InstrumentedRegistration(event_handler, self)
+
+    def call_handler(self, registration_id, listen_fn, event):
+        '''
+        Call listen_fn with event, recording how long it (or its Deferred) took.
+        '''
+        started = self.clock()
+        try:
+            result = listen_fn(event)
+        except Exception:
+            self.record_since(METRIC_HANDLER, registration_id, started, True)
+            raise
+
+        if isinstance(result, defer.Deferred):
+            return result.addBoth(self.record_since_cb, METRIC_HANDLER, registration_id, started)
+
+        self.record_since(METRIC_HANDLER, registration_id, started)
+        return result
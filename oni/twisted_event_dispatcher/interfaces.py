@@ -89,3 +89,19 @@ class IEventDispatcher(zope.interface.Interface):
         :param **event_details:
             An event_details is a set (dict) of key-value pairs.
         '''
+
+    def fire_events(events, collect_results=False):
+        '''
+        Trigger many incoming events at once.
+
+        Each event is handled exactly as if it had been passed to fire_event; phases still run in
+        order for every event. The whole batch moves from one phase to the next together.
+
+        :param events: Iterable of (event, event_details) pairs.
+
+        :param bool collect_results:
+            If True the returned Deferred calls back with a list containing, for each event in
+            order, a list of the (success, result) tuples of its handlers in phase order.
+
+        :returns: Deferred that will callback when every event has passed through every phase.
+        '''
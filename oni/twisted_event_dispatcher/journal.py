@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Durable journal of fired events that can be replayed through a dispatcher after a restart.
+
+Each fired event and its event_details are pickled into a length prefixed record appended to
+a local file. Appends are buffered and written together, with a single fsync, either
+flush_interval seconds after the first buffered record or as soon as max_batch_size records
+are buffered (group commit). Writes happen in the reactor's thread pool, one at a time, with
+records appended meanwhile buffered for the next write. Firing an event never waits for its
+record to be written, so after a crash up to flush_interval seconds of events, plus any
+still being written, may be missing from the journal.
+
+Records are read back with mmap from a byte offset. Each record read comes with the offset
+of the record after it, which can be stored to resume replay later from that point.
+"""
+import cPickle as pickle
+import logging
+import mmap
+import os
+import struct
+
+from twisted.internet import defer
+from twisted.internet import threads
+
+from oni.twisted_event_dispatcher._deferred_helpers import get_reactor
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+_LENGTH = struct.Struct('>I')
+
+
+class EventJournal(object):
+    '''
+    Append only journal of (event, event_details) records in a local file.
+
+    :param str path: File to append to. Created if it doesn't exist.
+    :param float flush_interval: Most seconds a record is buffered before it's written.
+    :param int max_batch_size: Most records to buffer before writing them straight away.
+    :param bool fsync: fsync the file after each write. Without it records survive the
+        process crashing but not the machine.
+    :param reactor: Reactor used for the flush timer and whose thread pool writes records.
+        Defaults to the global reactor.
+    '''
+    def __init__(
+            self, path, flush_interval=0.05, max_batch_size=1024, fsync=True, reactor=None):
+        self.path = path
+        self._flush_interval = flush_interval
+        self._max_batch_size = max_batch_size
+        self._fsync = fsync
+        self._reactor = reactor
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._written_offset = os.fstat(self._fd).st_size
+        self._buffer = []
+        self._buffered_records = 0
+        self._buffered_bytes = 0
+        self._writing_records = 0
+        self._writing_bytes = None
+        self._flush_waiters = []
+        self._delayed_flush = None
+        self.appended = 0
+        self.flushes = 0
+
+    @property
+    def end_offset(self):
+        '''RO property for the offset the next record appended will start at'''
+        return self._written_offset + (self._writing_bytes or 0) + self._buffered_bytes
+
+    def append(self, event, event_details):
+        '''
+        Buffer a record of event and event_details to be written with the next flush.
+
+        :raises pickle.PicklingError: or anything else pickling the record raises.
+        '''
+        self.append_many(((event, event_details),))
+
+    def append_many(self, records):
+        '''
+        Buffer a record of each (event, event_details) pair in records to be written with the
+        next flush. Every record is pickled before any is buffered, so if one can't be pickled
+        none are appended.
+
+        :raises pickle.PicklingError: or anything else pickling a record raises.
+        '''
+        dumps = pickle.dumps
+        datas = [dumps(record, pickle.HIGHEST_PROTOCOL) for record in records]
+        for data in datas:
+            self._buffer.append(_LENGTH.pack(len(data)))
+            self._buffer.append(data)
+            self._buffered_bytes += _LENGTH.size + len(data)
+        self._buffered_records += len(datas)
+        self.appended += len(datas)
+
+        if self._buffered_records >= self._max_batch_size:
+            self._background_flush()
+        elif self._delayed_flush is None:
+            self._delayed_flush = get_reactor(self._reactor).callLater(
+                self._flush_interval, self._background_flush)
+
+    def _background_flush(self):
+        '''
+        Flush without anything waiting for the result. Failures are logged by _written_cb.
+        '''
+        self.flush().addErrback(lambda _: None)
+
+    def flush(self):
+        '''
+        Write, and fsync, every buffered record now. If a write is already in progress the
+        buffered records are written once it's done.
+
+        :returns: Deferred that will callback once every record appended so far is written, or
+            fail with whatever writing them raised.
+        '''
+        if self._delayed_flush is not None:
+            if self._delayed_flush.active():
+                self._delayed_flush.cancel()
+            self._delayed_flush = None
+
+        flushed = defer.Deferred()
+        if self._writing_bytes is not None:
+            self._flush_waiters.append(flushed)
+        elif self._buffer:
+            self._write_buffer([flushed])
+        else:
+            flushed.callback(None)
+        return flushed
+
+    def _write_buffer(self, waiters):
+        '''
+        Start writing every buffered record in the reactor's thread pool, firing each of waiters
+        once done.
+        '''
+        data = ''.join(self._buffer)
+        del self._buffer[:]
+        self._writing_records = self._buffered_records
+        self._writing_bytes = len(data)
+        self._buffered_records = 0
+        self._buffered_bytes = 0
+        reactor = get_reactor(self._reactor)
+        threads.deferToThreadPool(
+            reactor, reactor.getThreadPool(), self._write, self._fd, data, self._fsync,
+        ).addBoth(self._written_cb, waiters)
+
+    @staticmethod
+    def _write(fd, data, fsync):
+        '''
+        Write, and maybe fsync, data to fd. Runs in a thread.
+        '''
+        view = buffer(data)
+        while view:
+            view = view[os.write(fd, view):]
+        if fsync:
+            os.fsync(fd)
+
+    def _written_cb(self, result, waiters):
+        '''
+        Callback once a write is done. Starts writing records buffered meanwhile if anything is
+        waiting for them or there are max_batch_size of them.
+        '''
+        if result is None:
+            self._written_offset += self._writing_bytes
+            self.flushes += 1
+        else:
+            DEV_LOGGER.error(
+                'Failed writing %r records to journal %r: %s',
+                self._writing_records, self.path, result.getErrorMessage())
+            # Cut off any part of the records that was written so later records are framed
+            # from the end of the last complete one
+            try:
+                os.ftruncate(self._fd, self._written_offset)
+            except OSError as exc:
+                DEV_LOGGER.error(
+                    'Failed truncating journal %r to offset %r: %s',
+                    self.path, self._written_offset, exc)
+        self._writing_records = 0
+        self._writing_bytes = None
+
+        # Start the next write before firing any waiter, as they may append or flush
+        pending, self._flush_waiters = self._flush_waiters, []
+        if self._buffer and (pending or self._buffered_records >= self._max_batch_size):
+            self._write_buffer(pending)
+        else:
+            waiters = waiters + pending
+        for waiter in waiters:
+            if result is None:
+                waiter.callback(None)
+            else:
+                waiter.errback(result)
+
+    def close(self):
+        '''
+        Flush and close the file. Nothing more can be appended.
+
+        :returns: Deferred that will callback once the file is closed.
+        '''
+        if self._fd is None:
+            return defer.succeed(None)
+        return self.flush().addBoth(self._close_cb)
+
+    def _close_cb(self, result):
+        '''
+        Close the file once every record has been written
+        '''
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        return result
+
+    def read(self, offset=0):
+        '''
+        Read the records written from offset. Records still buffered or being written aren't
+        read, so wait for :py:meth:`flush` first to read every record appended so far. Records
+        appended while reading aren't read, nor is any incomplete record left at the end of the
+        file by a crash.
+
+        :returns: Iterator of (next_offset, event, event_details) tuples, where next_offset is
+            the offset of the following record.
+        '''
+        with open(self.path, 'rb') as journal_file:
+            end = os.fstat(journal_file.fileno()).st_size
+            if offset >= end:
+                return
+            journal_map = mmap.mmap(journal_file.fileno(), end, access=mmap.ACCESS_READ)
+
+        try:
+            while offset + _LENGTH.size <= end:
+                length, = _LENGTH.unpack_from(journal_map, offset)
+                record_end = offset + _LENGTH.size + length
+                if record_end > end:
+                    DEV_LOGGER.warning(
+                        'Ignoring incomplete record at offset %r of journal %r', offset, self.path)
+                    return
+                event, event_details = pickle.loads(journal_map[offset + _LENGTH.size:record_end])
+                offset = record_end
+                yield offset, event, event_details
+        finally:
+            journal_map.close()
+
+    def stats(self):
+        '''
+        :returns: dict with the number of records appended, the number of flushes, the number
+            of records buffered, the number being written and the end offset.
+        '''
+        return {
+            'appended': self.appended,
+            'flushes': self.flushes,
+            'buffered': self._buffered_records,
+            'writing': self._writing_records,
+            'end_offset': self.end_offset,
+        }
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Matchers that can be used as match_spec values in place of an exact value.
+
+Each is indexed so handlers whose matchers don't match an event are excluded when the event's
+handlers are looked up rather than being called and having to filter the event themselves.
+"""
+import logging
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+class _Matcher(object):
+    '''
+    Base for matchers. Matchers are immutable and compare equal if they match the same values.
+    Matching itself is left to the indexes.
+    '''
+    __slots__ = ()
+
+    def _key(self):
+        '''
+        :returns: Hashable tuple identifying what the matcher matches. Overridden by each
+            matcher.
+        '''
+        return ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), self._key()))
+
+    def __getstate__(self):
+        return self._key()
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(repr(part) for part in self._key()))
+
+
+class OneOf(_Matcher):
+    '''
+    Matches any one of values.
+
+    >>> OneOf('admin', 'owner') == OneOf('owner', 'admin')
+    True
+    '''
+    __slots__ = ('values',)
+
+    def __init__(self, *values):
+        if not values:
+            raise ValueError('OneOf needs at least one value')
+        if None in values:
+            raise ValueError('OneOf can not contain None; use None to match any value')
+        self.values = frozenset(values)
+
+    def _key(self):
+        return tuple(sorted(self.values))
+
+    def __setstate__(self, state):
+        self.values = frozenset(state)
+
+
+class Prefix(_Matcher):
+    '''
+    Matches strings starting with prefix.
+
+    >>> Prefix('svc-')
+    Prefix('svc-')
+    '''
+    __slots__ = ('prefix',)
+
+    def __init__(self, prefix):
+        if not isinstance(prefix, basestring):
+            raise TypeError('Prefix must be a string not {!r}'.format(prefix))
+        self.prefix = prefix
+
+    def _key(self):
+        return (self.prefix,)
+
+    def __setstate__(self, state):
+        self.prefix, = state
+
+
+class Range(_Matcher):
+    '''
+    Matches values from low up to but not including high. Either bound may be None to leave
+    that side of the range open.
+
+    >>> Range(high=65)
+    Range(None, 65)
+    '''
+    __slots__ = ('low', 'high')
+
+    def __init__(self, low=None, high=None):
+        if low is None and high is None:
+            raise ValueError('Range needs low or high; use None to match any value')
+        if low is not None and high is not None and not low < high:
+            raise ValueError('Range low {!r} must be less than high {!r}'.format(low, high))
+        self.low = low
+        self.high = high
+
+    def _key(self):
+        return (self.low, self.high)
+
+    def __setstate__(self, state):
+        self.low, self.high = state
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+IEventDispatcher that spreads events across several local worker processes.
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import sys
+
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.python import failure
+
+from oni.twisted_event_dispatcher._deferred_helpers import get_reactor
+from oni.twisted_event_dispatcher._shard_protocol import MessageConnection
+from oni.twisted_event_dispatcher.errors import RemoteHandlerError
+from oni.twisted_event_dispatcher.errors import ShardWorkerLost
+from oni.twisted_event_dispatcher.executors import ProcessPoolExecutor
+from oni.twisted_event_dispatcher.interfaces import IBackgroundUtility
+from oni.twisted_event_dispatcher.interfaces import IEventDispatcher
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+_WORKER_MODULE = 'oni.twisted_event_dispatcher._shard_worker'
+# Relative entries in sys.path are relative to the directory python started in
+_STARTING_DIRECTORY = os.getcwd()
+
+
+def _gather(deferreds):
+    '''
+    :returns: Deferred with the list of results of deferreds or the first failure among them.
+    '''
+    return defer.gatherResults(deferreds, consumeErrors=True).addErrback(
+        lambda gather_failure: gather_failure.value.subFailure)
+
+
+class _ShardWorkerProcess(protocol.ProcessProtocol):
+    '''
+    Parent side of a single worker process.
+
+    :param int index: Index of the worker, used in log messages.
+    :param int max_batch_size: Most requests to buffer before writing.
+    :param reactor: Reactor the worker is run with.
+    '''
+    def __init__(self, index, max_batch_size, reactor):
+        self.index = index
+        self._reactor = reactor
+        self._connection = MessageConnection(self._message_received, max_batch_size, reactor)
+        self._request_ids = itertools.count()
+        self._pending = {}
+        self._ended = defer.Deferred()
+        self.alive = False
+
+    def spawn(self):
+        '''
+        Start the worker process. It inherits this process's sys.path.
+        '''
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join(
+            os.path.join(_STARTING_DIRECTORY, path) for path in sys.path)
+        self._reactor.spawnProcess(
+            self,
+            sys.executable,
+            [sys.executable, '-m', _WORKER_MODULE],
+            env=environment)
+        self.alive = True
+
+    def connectionMade(self):
+        self._connection.makeConnection(self.transport)
+
+    def outReceived(self, data):
+        self._connection.dataReceived(data)
+
+    def errReceived(self, data):
+        DEV_LOGGER.warning('Shard worker %r: %s', self.index, data.rstrip())
+
+    def request(self, request_type, *args):
+        '''
+        Send request to the worker.
+
+        :returns: Deferred with the worker's result or that fails with RemoteHandlerError or
+            ShardWorkerLost.
+        '''
+        if not self.alive:
+            return defer.fail(ShardWorkerLost('Shard worker {!r} is not running'.format(
+                self.index)))
+        request_id = next(self._request_ids)
+        try:
+            self._connection.send((request_type, request_id) + args)
+        except Exception:  # Pickling raises all sorts; pylint: disable=broad-except
+            return defer.fail()
+        result_deferred = self._pending[request_id] = defer.Deferred()
+        return result_deferred
+
+    def _message_received(self, message):
+        '''
+        Fire the Deferred waiting on the result of a request
+        '''
+        _, request_id, success, value = message
+        result_deferred = self._pending.pop(request_id)
+        if success:
+            result_deferred.callback(value)
+        else:
+            result_deferred.errback(RemoteHandlerError(*value))
+
+    def stop(self):
+        '''
+        Close the worker's stdin. It will exit once it's completed every request.
+
+        :returns: Deferred that will callback once the worker has exited.
+        '''
+        if self.alive:
+            self._connection.flush()
+            self.transport.closeStdin()
+        return self._ended
+
+    def processEnded(self, reason):
+        DEV_LOGGER.debug('Shard worker %r ended: %s', self.index, reason.getErrorMessage())
+        self.alive = False
+        self._connection.connectionLost(reason)
+        pending = self._pending.values()
+        self._pending.clear()
+        for result_deferred in pending:
+            result_deferred.errback(ShardWorkerLost(
+                'Shard worker {!r} exited: {}'.format(self.index, reason.getErrorMessage())))
+        ended, self._ended = self._ended, defer.Deferred()
+        ended.callback(None)
+
+
+@implementer(IBackgroundUtility, IEventDispatcher)
+class ShardedEventDispatcher(object):
+    '''
+    Dispatcher that runs an EventDispatcher in each of several local worker processes so that
+    events can be handled on more than one core.
+
+    Every handler is registered with every worker, and each event is sent to a single worker
+    chosen by the value of its partition_keyword detail. Events with the same value always go
+    to the same worker, which completes them one at a time in the order they were fired, so
+    ordering is preserved for each partition key. Events for different keys are handled
+    concurrently.
+
+    Handlers and events are pickled to reach the workers, so handlers must be importable
+    functions (or other picklable callables) and events and results must be picklable.
+    Requests to each worker are written to its stdin in batches, at most once per reactor
+    iteration. A worker that exits unexpectedly isn't restarted; requests to it fail with
+    ShardWorkerLost until the dispatcher is stopped and started again.
+
+    :param allowed_match_spec_keywords: Sequence of keywords handlers can be matched on.
+    :param partition_keyword: One of allowed_match_spec_keywords used to choose the worker for
+        each event.
+    :param int worker_count: Number of worker processes. Defaults to the number of CPUs.
+    :param int max_batch_size: Most requests buffered for a worker before they're written.
+    :param dict dispatcher_options: Keyword arguments, such as phases or index_engine, for the
+        EventDispatcher in each worker.
+    :param reactor: Reactor to run the workers with. Defaults to the global reactor.
+    '''
+    def __init__(
+            self, allowed_match_spec_keywords, partition_keyword, worker_count=None,
+            max_batch_size=256, dispatcher_options=None, reactor=None):
+        self._allowed_match_spec_keywords = tuple(allowed_match_spec_keywords)
+        if partition_keyword not in self._allowed_match_spec_keywords:
+            raise ValueError('partition_keyword {!r} is not one of {!r}'.format(
+                partition_keyword, self._allowed_match_spec_keywords))
+        self._partition_keyword = partition_keyword
+        self._worker_count = worker_count or multiprocessing.cpu_count()
+        self._max_batch_size = max_batch_size
+        self._dispatcher_options = dict(dispatcher_options or {})
+        self._phases = self._dispatcher_options.get('phases', ('before', 'during', 'after'))
+        self._reactor = reactor
+        self._handler_ids = itertools.count()
+        self._registrations = {}
+        self._workers = []
+        self._running = False
+
+    @property
+    def running(self):
+        '''RO property for running'''
+        return self._running
+
+    def start(self):
+        '''
+        Start the worker processes and register every handler with them.
+
+        :returns: Deferred that will callback once every worker is ready.
+        '''
+        if self._workers:
+            return defer.succeed(None)
+
+        DEV_LOGGER.debug('Starting %r shard workers for %r', self._worker_count, self)
+        reactor = get_reactor(self._reactor)
+        ready_deferreds = []
+        for index in range(self._worker_count):
+            worker = _ShardWorkerProcess(index, self._max_batch_size, reactor)
+            worker.spawn()
+            self._workers.append(worker)
+            ready_deferreds.append(worker.request(
+                'configure',
+                self._allowed_match_spec_keywords,
+                self._partition_keyword,
+                self._dispatcher_options))
+            for handler_id, registration in sorted(self._registrations.iteritems()):
+                ready_deferreds.append(worker.request('add', handler_id, *registration))
+
+        def started_cb(_):
+            '''Only accept events once every worker is ready'''
+            self._running = True
+
+        return _gather(ready_deferreds).addCallback(started_cb)
+
+    def stop(self):
+        '''
+        Stop accepting events and wait for the workers to complete every event already fired
+        and exit.
+
+        :returns: Deferred that will callback once every worker has exited.
+        '''
+        DEV_LOGGER.debug('Stopping %r', self)
+        self._running = False
+        workers, self._workers = self._workers, []
+        return _gather([worker.stop() for worker in workers]).addCallback(
+            lambda _: None)
+
+    def _request_all(self, request_type, *args):
+        '''
+        :returns: Deferred that will callback once every worker has completed request.
+        '''
+        return _gather([worker.request(request_type, *args) for worker in self._workers])
+
+    def add_event_handler(self, listen_fn, phase, use_weakref=True, **match_spec):
+        '''
+        See :py:func:`IEventDispatcher.add_event_handler`
+
+        listen_fn is pickled and registered with every worker. use_weakref is ignored as each
+        worker holds its own copy of listen_fn.
+        '''
+        unexpected = set(match_spec).difference(self._allowed_match_spec_keywords)
+        if unexpected:
+            raise ValueError('Got unexpected match_spec: {!r}'.format(
+                {key: match_spec[key] for key in unexpected}))
+        if phase not in self._phases:
+            raise ValueError('Unknown phase: {!r}'.format(phase))
+        ProcessPoolExecutor.check(listen_fn)
+
+        handler_id = next(self._handler_ids)
+        registration = self._registrations[handler_id] = (listen_fn, phase, match_spec)
+        return self._request_all('add', handler_id, *registration).addCallback(
+            lambda _: handler_id)
+
+    def remove_event_handler(self, event_handler_id):
+        '''
+        See :py:func:`IEventDispatcher.remove_event_handler`
+        '''
+        try:
+            del self._registrations[event_handler_id]
+        except KeyError:
+            return defer.fail()
+        return self._request_all('remove', event_handler_id).addCallback(lambda _: None)
+
+    def _worker_for(self, event_details):
+        '''
+        :returns: Worker that handles events with event_details
+        '''
+        partition_key = event_details.get(self._partition_keyword)
+        return self._workers[hash(partition_key) % len(self._workers)]
+
+    def fire_event(self, event, **event_details):
+        '''
+        See :py:func:`IEventDispatcher.fire_event`
+
+        :returns: Deferred that will callback once the event has been through every phase in
+            its worker.
+        '''
+        if not self.running:
+            DEV_LOGGER.warning('Event %r received but dispatcher is not running', event)
+            return defer.succeed(None)
+        return self._worker_for(event_details).request('fire', event, event_details, False)
+
+    def fire_events(self, events, collect_results=False):
+        '''
+        See :py:func:`IEventDispatcher.fire_events`
+
+        Events are sent to their workers individually, so unlike EventDispatcher events in
+        different partitions don't move through the phases together. Failed handler results
+        are Failures wrapping RemoteHandlerError.
+        '''
+        if not self.running:
+            DEV_LOGGER.warning('Events received but dispatcher is not running')
+            return defer.succeed([] if collect_results else None)
+
+        fire_deferreds = [
+            self._worker_for(event_details).request(
+                'fire', event, event_details, collect_results)
+            for event, event_details in events]
+        batch_deferred = _gather(fire_deferreds)
+        if not collect_results:
+            return batch_deferred.addCallback(lambda _: None)
+        return batch_deferred.addCallback(lambda results: [
+            [
+                (success, value if success else failure.Failure(RemoteHandlerError(*value)))
+                for success, value in event_results]
+            for event_results in results])
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Pull based consumption of events.
+
+A :py:class:`Subscription` is registered like a handler but, rather than handling events as
+they're dispatched, buffers them in a bounded buffer for a consumer to take at its own pace
+with get() or drain(). When the buffer is full the subscription's overflow_policy decides
+what happens to a new event:
+
+* 'drop_oldest' discards the oldest buffered event to make room.
+* 'drop_newest' discards the new event.
+* 'wait' holds the new event back and makes its phase wait until the consumer has made room,
+  slowing dispatch down to the consumer's pace.
+"""
+import collections
+import logging
+
+from twisted.internet import defer
+
+from oni.twisted_event_dispatcher._admission import OVERFLOW_DROP_OLDEST
+from oni.twisted_event_dispatcher._admission import OVERFLOW_WAIT
+from oni.twisted_event_dispatcher.errors import SubscriptionClosed
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+
+
+class Subscription(object):
+    '''
+    Bounded buffer of the events dispatched to a subscription, created by
+    :py:meth:`EventDispatcher.subscribe`.
+
+    :param int max_size: Most events to buffer.
+    :param str overflow_policy: 'drop_oldest', 'drop_newest' or 'wait'.
+    :param remove_event_handler: Callable removing the registration of deliver by its id.
+    '''
+    def __init__(
+            self, max_size=1024, overflow_policy=OVERFLOW_DROP_OLDEST, remove_event_handler=None):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1 not {!r}'.format(max_size))
+        if overflow_policy not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_WAIT):
+            raise ValueError('Unknown overflow_policy: {!r}'.format(overflow_policy))
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.event_handler_id = None
+        self._remove_event_handler = remove_event_handler
+        self._buffer = collections.deque()
+        self._getters = collections.deque()
+        self._waiting = collections.deque()
+        self.delivered = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.closed = False
+
+    @property
+    def sync(self):
+        '''RO property; whether deliver never returns a Deferred'''
+        return self.overflow_policy != OVERFLOW_WAIT
+
+    def deliver(self, event):
+        '''
+        Handler registered with the dispatcher. Buffers event or hands it straight to a waiting
+        get().
+
+        :returns: None, or with the 'wait' overflow_policy and a full buffer a Deferred that
+            will callback once event has been buffered.
+        '''
+        if self.closed:
+            return None
+        self.delivered += 1
+        if self._getters:
+            self._getters.popleft().callback(event)
+            return None
+
+        if len(self._buffer) < self.max_size:
+            self._buffer.append(event)
+        elif self.overflow_policy == OVERFLOW_DROP_OLDEST:
+            self._buffer.popleft()
+            self._buffer.append(event)
+            self.dropped_oldest += 1
+        elif self.overflow_policy == OVERFLOW_DROP_NEWEST:
+            self.dropped_newest += 1
+        else:
+            waiting_deferred = defer.Deferred()
+            self._waiting.append((event, waiting_deferred))
+            return waiting_deferred
+        return None
+
+    def _admit_waiting(self):
+        '''
+        Move events held back by the 'wait' overflow_policy into the buffer while there's room
+        '''
+        while self._waiting and len(self._buffer) < self.max_size:
+            event, waiting_deferred = self._waiting.popleft()
+            self._buffer.append(event)
+            waiting_deferred.callback(None)
+
+    def get(self):
+        '''
+        :returns: Deferred that will callback with the next event, or fail with
+            SubscriptionClosed if the subscription is closed first. Cancelling it, such as with
+            addTimeout, leaves the next event for a later get().
+        '''
+        if self._buffer:
+            event = self._buffer.popleft()
+            self._admit_waiting()
+            return defer.succeed(event)
+        if self.closed:
+            return defer.fail(SubscriptionClosed('Subscription is closed'))
+        getter = defer.Deferred(canceller=self._cancel_get)
+        self._getters.append(getter)
+        return getter
+
+    def _cancel_get(self, getter):
+        '''
+        Canceller for a pending get() so that it isn't handed an event
+        '''
+        self._getters.remove(getter)
+
+    def drain(self, max_events=None):
+        '''
+        Take up to max_events buffered events at once, or every buffered event if max_events
+        is None.
+
+        :returns: List of events, oldest first. Empty if none are buffered.
+        '''
+        if max_events is None or max_events >= len(self._buffer):
+            events = list(self._buffer)
+            self._buffer.clear()
+        else:
+            popleft = self._buffer.popleft
+            events = [popleft() for _ in xrange(max_events)]
+        self._admit_waiting()
+        return events
+
+    def close(self):
+        '''
+        Stop receiving events. Events already buffered can still be taken, while pending and
+        later get() calls that find the buffer empty fail with SubscriptionClosed. Events held
+        back by the 'wait' overflow_policy are discarded so their phases can carry on.
+
+        :returns: Deferred that will callback once the subscription's handler is removed.
+        '''
+        if self.closed:
+            return defer.succeed(None)
+        self.closed = True
+        getters, self._getters = self._getters, collections.deque()
+        for getter in getters:
+            getter.errback(SubscriptionClosed('Subscription is closed'))
+        waiting, self._waiting = self._waiting, collections.deque()
+        for _, waiting_deferred in waiting:
+            waiting_deferred.callback(None)
+        if self._remove_event_handler is None or self.event_handler_id is None:
+            return defer.succeed(None)
+        return self._remove_event_handler(self.event_handler_id)
+
+    def stats(self):
+        '''
+        :returns: dict with the number of events buffered, delivered, dropped as oldest and
+            dropped as newest, and the number of events held back by the 'wait'
+            overflow_policy and of get() calls waiting for an event.
+        '''
+        return {
+            'buffered': len(self._buffer),
+            'delivered': self.delivered,
+            'dropped_oldest': self.dropped_oldest,
+            'dropped_newest': self.dropped_newest,
+            'waiting': len(self._waiting),
+            'getters': len(self._getters),
+        }
+
+    def __len__(self):
+        return len(self._buffer)
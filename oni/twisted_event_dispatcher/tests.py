@@ -2,17 +2,66 @@
 """
 Tests for twisted_event_dispatcher module
 """
+import errno
+import functools
 import logging
+import os
+import threading
 import mock
 
 from twisted.trial import unittest
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
 
+from oni.twisted_event_dispatcher import DispatchQueueFull
+from oni.twisted_event_dispatcher import CallbackSink
+from oni.twisted_event_dispatcher import Coalesce
 from oni.twisted_event_dispatcher import EventDispatcher
+from oni.twisted_event_dispatcher import EventDropped
+from oni.twisted_event_dispatcher import EventJournal
+from oni.twisted_event_dispatcher import ExecutorQueueFull
+from oni.twisted_event_dispatcher import HandlerTimeout
+from oni.twisted_event_dispatcher import InMemorySink
+from oni.twisted_event_dispatcher import OneOf
+from oni.twisted_event_dispatcher import Prefix
+from oni.twisted_event_dispatcher import Range
+from oni.twisted_event_dispatcher import RemoteHandlerError
+from oni.twisted_event_dispatcher import ShardedEventDispatcher
+from oni.twisted_event_dispatcher import SubscriptionClosed
+from oni.twisted_event_dispatcher import ThreadPoolExecutor
+from oni.twisted_event_dispatcher import extractors
 
 DEV_LOGGER = logging.getLogger(__name__)
 
 
+def _process_handler(event):
+    '''
+    Picklable handler for process executor tests
+    '''
+    if event is None:
+        raise ValueError('No event')
+    return os.getpid(), event * 2
+
+
+_COMPLETED_EVENTS = []
+
+
+def _delayed_handler(event):
+    '''
+    Picklable handler for sharding tests that completes after a delay and returns every event
+    completed so far in its process
+    '''
+    value, delay = event
+
+    def complete():
+        '''Record completion'''
+        _COMPLETED_EVENTS.append(value)
+        return list(_COMPLETED_EVENTS)
+
+    return task.deferLater(reactor, delay, complete)
+
+
 class TestEventDispatcher(unittest.TestCase):
     '''
     Test EventDispatcher
@@ -120,6 +169,7 @@ class TestEventDispatcher(unittest.TestCase):
         yield self.inst.fire_event(event, username='bob', role='admin')
 
         self.assertFalse(listen_fn.called, 'function should not have been called')
+        self.assertEqual(self.inst.memory_stats()['handlers'], 0)
 
     @defer.inlineCallbacks
     def test_auto_remove_with_instance_method(self):
@@ -152,6 +202,7 @@ class TestEventDispatcher(unittest.TestCase):
         yield self.inst.fire_event(event, username='bob', role='admin')
 
         self.assertFalse(listen_fn.called, 'function should not have been called')
+        self.assertEqual(self.inst.memory_stats()['handlers'], 0)
 
     @defer.inlineCallbacks
     def test_stop_start(self):
@@ -192,3 +243,1894 @@ class TestEventDispatcher(unittest.TestCase):
             listen_fn,
             'during',
             password='admin')
+
+    def test_fire_not_blocked_by_slow_event(self):
+        '''
+        Test that an event whose handler hasn't finished doesn't prevent another event from being
+        handled.
+        '''
+        slow_deferred = defer.Deferred()
+        slow_fn = mock.Mock(return_value=slow_deferred)
+        listen_fn = self.listen_fn_mock()
+
+        self.inst.add_event_handler(slow_fn, 'after', use_weakref=False, username='bob')
+        self.inst.add_event_handler(listen_fn, 'during', username='susan')
+
+        completed = []
+        self.inst.fire_event('slow_event', username='bob').addCallback(
+            lambda _: completed.append('slow_event'))
+        self.inst.fire_event('fast_event', username='susan').addCallback(
+            lambda _: completed.append('fast_event'))
+
+        self.assertEqual(completed, ['fast_event'])
+        listen_fn.assert_called_once_with('fast_event')
+
+        slow_deferred.callback(None)
+        self.assertEqual(completed, ['fast_event', 'slow_event'])
+
+    def test_stop_waits_for_in_flight_events(self):
+        '''
+        Test that stop doesn't callback until events in flight have passed through all phases.
+        '''
+        slow_deferred = defer.Deferred()
+        slow_fn = mock.Mock(return_value=slow_deferred)
+        self.inst.add_event_handler(slow_fn, 'during', use_weakref=False)
+
+        self.inst.fire_event('some_event', username='bob')
+        stopped = []
+        self.inst.stop().addCallback(stopped.append)
+
+        self.assertEqual(stopped, [], 'stop should wait for event in flight')
+
+        slow_deferred.callback(None)
+        self.assertEqual(stopped, [None])
+
+    @defer.inlineCallbacks
+    def test_plan_cache_hit(self):
+        '''
+        Test that repeated events with the same details reuse the resolved plan.
+        '''
+        listen_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(listen_fn, 'during', role='admin')
+
+        yield self.inst.fire_event('event_1', username='bob', role='admin')
+        yield self.inst.fire_event('event_2', role='admin', username='bob')
+
+        stats = self.inst.plan_cache_stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(listen_fn.call_count, 2)
+
+    @defer.inlineCallbacks
+    def test_plan_cache_invalidated_by_registration(self):
+        '''
+        Test that adding and removing handlers invalidates cached plans.
+        '''
+        listen_fn = self.listen_fn_mock()
+        yield self.inst.fire_event('event_1', role='admin')
+
+        handle = yield self.inst.add_event_handler(listen_fn, 'during', role='admin')
+        yield self.inst.fire_event('event_2', role='admin')
+        listen_fn.assert_called_once_with('event_2')
+
+        yield self.inst.remove_event_handler(handle)
+        yield self.inst.fire_event('event_3', role='admin')
+        listen_fn.assert_called_once_with('event_2')
+
+        self.assertEqual(self.inst.plan_cache_stats()['misses'], 3)
+
+    @defer.inlineCallbacks
+    def test_plan_cache_eviction(self):
+        '''
+        Test that the plan cache is bounded.
+        '''
+        inst = self.factory(('username', 'role'), plan_cache_size=2)
+        inst.start()
+
+        for username in ('bob', 'susan', 'alice', 'bob'):
+            yield inst.fire_event('some_event', username=username)
+
+        stats = inst.plan_cache_stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['misses'], 4)
+
+    @defer.inlineCallbacks
+    def test_fire_events(self):
+        '''
+        Test that a batch of events triggers the same handlers as firing each event on its own,
+        resolving handlers once for each distinct set of details.
+        '''
+        calls = []
+        admin_fn = mock.Mock(side_effect=lambda event: calls.append(('admin', event)))
+        before_fn = mock.Mock(side_effect=lambda event: calls.append(('before', event)))
+
+        yield self.inst.add_event_handler(admin_fn, 'during', use_weakref=False, role='admin')
+        yield self.inst.add_event_handler(before_fn, 'before', use_weakref=False)
+
+        yield self.inst.fire_events([
+            ('event_1', {'username': 'bob', 'role': 'admin'}),
+            ('event_2', {'username': 'susan', 'role': 'user'}),
+            ('event_3', {'username': 'bob', 'role': 'admin'}),
+        ])
+
+        self.assertEqual(calls, [
+            ('before', 'event_1'),
+            ('before', 'event_2'),
+            ('before', 'event_3'),
+            ('admin', 'event_1'),
+            ('admin', 'event_3'),
+        ])
+        self.assertEqual(self.inst.plan_cache_stats()['misses'], 2)
+
+    @defer.inlineCallbacks
+    def test_fire_events_collect_results(self):
+        '''
+        Test that per event handler results can be collected from a batch.
+        '''
+        error = ValueError('bad event')
+        yield self.inst.add_event_handler(
+            mock.Mock(return_value='ok'), 'before', use_weakref=False, role='admin')
+        yield self.inst.add_event_handler(
+            mock.Mock(side_effect=error), 'after', use_weakref=False, username='bob')
+
+        results = yield self.inst.fire_events([
+            ('event_1', {'username': 'bob', 'role': 'admin'}),
+            ('event_2', {'username': 'susan', 'role': 'admin'}),
+            ('event_3', {'username': 'susan', 'role': 'user'}),
+        ], collect_results=True)
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0][0], (True, 'ok'))
+        self.assertFalse(results[0][1][0])
+        self.assertIs(results[0][1][1].value, error)
+        self.assertEqual(results[1], [(True, 'ok')])
+        self.assertEqual(results[2], [])
+
+    @defer.inlineCallbacks
+    def test_phase_order_with_deferred_phase(self):
+        '''
+        Test that a phase returning a Deferred holds up later phases while synchronous phases
+        run straight through.
+        '''
+        calls = []
+        during_deferred = defer.Deferred()
+
+        def during_fn(event):
+            '''Record call and return a Deferred'''
+            calls.append('during')
+            return during_deferred
+
+        yield self.inst.add_event_handler(
+            lambda event: calls.append('before'), 'before', use_weakref=False)
+        yield self.inst.add_event_handler(during_fn, 'during', use_weakref=False)
+        yield self.inst.add_event_handler(
+            lambda event: calls.append('after'), 'after', use_weakref=False)
+
+        fired = []
+        self.inst.fire_event('some_event', role='admin').addCallback(fired.append)
+        self.assertEqual(calls, ['before', 'during'])
+
+        during_deferred.callback(None)
+        self.assertEqual(calls, ['before', 'during', 'after'])
+        self.assertEqual(fired, [None])
+
+    @defer.inlineCallbacks
+    def test_handler_error_does_not_stop_phases(self):
+        '''
+        Test that a handler raising an exception doesn't prevent the other handlers running.
+        '''
+        listen_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(
+            mock.Mock(side_effect=ValueError('bad event')), 'before', use_weakref=False)
+        yield self.inst.add_event_handler(listen_fn, 'after')
+
+        yield self.inst.fire_event('some_event', role='admin')
+
+        listen_fn.assert_called_once_with('some_event')
+        self.flushLoggedErrors(ValueError)
+
+    @defer.inlineCallbacks
+    def test_sync_handler_result_not_waited_on(self):
+        '''
+        Test that the result of a handler registered with sync=True is never waited on.
+        '''
+        listen_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(
+            mock.Mock(return_value=defer.Deferred()), 'before', use_weakref=False, sync=True)
+        yield self.inst.add_event_handler(listen_fn, 'after')
+
+        yield self.inst.fire_event('some_event', role='admin')
+
+        listen_fn.assert_called_once_with('some_event')
+
+    @defer.inlineCallbacks
+    def test_auto_remove_then_add(self):
+        '''
+        Test a garbage collected handler is removed before the registry is next changed.
+        '''
+        def listen_fn(event):
+            '''Handler that will be deleted'''
+
+        other_listen_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(listen_fn, 'during', role='admin')
+        del listen_fn
+
+        yield self.inst.add_event_handler(other_listen_fn, 'during', role='admin')
+
+        self.assertEqual(self.inst.memory_stats()['handlers'], 1)
+
+    @defer.inlineCallbacks
+    def test_detail_values_interned(self):
+        '''
+        Test registrations with the same match_spec share their detail values.
+        '''
+        first_id = yield self.inst.add_event_handler(
+            self.listen_fn_mock(), 'during', use_weakref=False, role='admin')
+        second_id = yield self.inst.add_event_handler(
+            self.listen_fn_mock(), 'after', use_weakref=False, role='admin')
+
+        first = self.inst._event_handlers[first_id]
+        second = self.inst._event_handlers[second_id]
+        self.assertIs(first.detail_values, second.detail_values)
+        self.assertEqual(first.details, {'username': None, 'role': 'admin'})
+
+    @defer.inlineCallbacks
+    def test_add_and_remove_event_handlers(self):
+        '''
+        Test many handlers can be added and removed in one go.
+        '''
+        listen_fns = [self.listen_fn_mock() for _ in range(3)]
+        handles = yield self.inst.add_event_handlers([
+            {'listen_fn': listen_fns[0], 'phase': 'before', 'role': 'admin'},
+            {'listen_fn': listen_fns[1], 'phase': 'during', 'username': 'bob'},
+            {'listen_fn': listen_fns[2], 'phase': 'after'},
+        ])
+        self.assertEqual(len(handles), 3)
+
+        yield self.inst.fire_event('event_1', username='bob', role='admin')
+        for listen_fn in listen_fns:
+            listen_fn.assert_called_once_with('event_1')
+
+        removed = yield self.inst.remove_event_handlers(handles[:2])
+        self.assertEqual(removed, handles[:2])
+
+        yield self.inst.fire_event('event_2', username='bob', role='admin')
+        listen_fns[0].assert_called_once_with('event_1')
+        listen_fns[1].assert_called_once_with('event_1')
+        self.assertEqual(listen_fns[2].call_count, 2)
+
+    @defer.inlineCallbacks
+    def test_remove_event_handlers_unknown_id(self):
+        '''
+        Test nothing is removed if any of the ids to remove isn't registered.
+        '''
+        handle = yield self.inst.add_event_handler(
+            self.listen_fn_mock(), 'during', use_weakref=False)
+
+        yield self.assertFailure(
+            self.inst.remove_event_handlers([handle, object()]), KeyError)
+        self.assertEqual(self.inst.memory_stats()['handlers'], 1)
+
+    def test_add_event_handlers_invalid_spec(self):
+        '''
+        Test nothing is added if any of the specs is invalid.
+        '''
+        self.assertRaises(
+            ValueError,
+            self.inst.add_event_handlers,
+            [{'listen_fn': self.listen_fn_mock(), 'phase': 'during'},
+             {'listen_fn': self.listen_fn_mock(), 'phase': 'during', 'password': 'admin'}])
+        self.assertEqual(self.inst.memory_stats()['handlers'], 0)
+
+    @defer.inlineCallbacks
+    def test_remove_event_handlers_by_tag(self):
+        '''
+        Test removing every handler sharing a tag.
+        '''
+        owned_fn = self.listen_fn_mock()
+        other_fn = self.listen_fn_mock()
+        owned = yield self.inst.add_event_handlers([
+            {'listen_fn': owned_fn, 'phase': 'during', 'tag': 'owner'},
+            {'listen_fn': owned_fn, 'phase': 'after', 'tag': 'owner', 'role': 'admin'},
+        ])
+        yield self.inst.add_event_handler(other_fn, 'during', tag='someone_else')
+
+        removed = yield self.inst.remove_event_handlers_by_tag('owner')
+        self.assertEqual(sorted(removed), sorted(owned))
+
+        yield self.inst.fire_event('some_event', role='admin')
+        self.assertFalse(owned_fn.called, 'function should not have been called')
+        other_fn.assert_called_once_with('some_event')
+
+    @defer.inlineCallbacks
+    def test_remove_event_handlers_by_match_spec(self):
+        '''
+        Test removing every handler registered with exactly a match_spec.
+        '''
+        admin_fn = self.listen_fn_mock()
+        bob_admin_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(admin_fn, 'during', role='admin')
+        yield self.inst.add_event_handler(admin_fn, 'after', role='admin')
+        yield self.inst.add_event_handler(bob_admin_fn, 'during', role='admin', username='bob')
+
+        removed = yield self.inst.remove_event_handlers_by_match_spec(role='admin')
+        self.assertEqual(len(removed), 2)
+
+        yield self.inst.fire_event('some_event', username='bob', role='admin')
+        self.assertFalse(admin_fn.called, 'function should not have been called')
+        bob_admin_fn.assert_called_once_with('some_event')
+
+    @defer.inlineCallbacks
+    def test_one_of_matcher(self):
+        '''
+        Test OneOf matches any of its values alongside other details.
+        '''
+        listen_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(
+            listen_fn, 'during', username='bob', role=OneOf('admin', 'owner'))
+
+        yield self.inst.fire_event('admin_event', username='bob', role='admin')
+        yield self.inst.fire_event('owner_event', username='bob', role='owner')
+        yield self.inst.fire_event('user_event', username='bob', role='user')
+        yield self.inst.fire_event('susan_event', username='susan', role='admin')
+        self.assertEqual(
+            listen_fn.call_args_list, [mock.call('admin_event'), mock.call('owner_event')])
+
+    @defer.inlineCallbacks
+    def test_prefix_matcher(self):
+        '''
+        Test Prefix matches strings starting with it, however many prefixes are registered.
+        '''
+        service_fn = self.listen_fn_mock()
+        backup_fn = self.listen_fn_mock()
+        everyone_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(service_fn, 'during', username=Prefix('svc-'))
+        yield self.inst.add_event_handler(backup_fn, 'during', username=Prefix('svc-backup'))
+        yield self.inst.add_event_handler(everyone_fn, 'during', username=Prefix(''))
+
+        yield self.inst.fire_event('backup_event', username='svc-backup-1')
+        yield self.inst.fire_event('web_event', username='svc-web')
+        yield self.inst.fire_event('bob_event', username='bob')
+        yield self.inst.fire_event('number_event', username=5)
+
+        self.assertEqual(
+            service_fn.call_args_list, [mock.call('backup_event'), mock.call('web_event')])
+        backup_fn.assert_called_once_with('backup_event')
+        self.assertEqual(everyone_fn.call_count, 3)
+
+    @defer.inlineCallbacks
+    def test_range_matcher(self):
+        '''
+        Test Range matches from low up to but not including high.
+        '''
+        adult_fn = self.listen_fn_mock()
+        senior_fn = self.listen_fn_mock()
+        child_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(adult_fn, 'during', username=Range(18, 65))
+        yield self.inst.add_event_handler(senior_fn, 'during', username=Range(65))
+        yield self.inst.add_event_handler(child_fn, 'during', username=Range(high=18))
+
+        for age in (5, 18, 64, 65, 90):
+            yield self.inst.fire_event(age, username=age)
+
+        self.assertEqual(adult_fn.call_args_list, [mock.call(18), mock.call(64)])
+        self.assertEqual(senior_fn.call_args_list, [mock.call(65), mock.call(90)])
+        self.assertEqual(child_fn.call_args_list, [mock.call(5)])
+
+    @defer.inlineCallbacks
+    def test_remove_matchers(self):
+        '''
+        Test handlers with matchers can be removed, including by match_spec.
+        '''
+        first_fn = self.listen_fn_mock()
+        second_fn = self.listen_fn_mock()
+        first_id = yield self.inst.add_event_handler(
+            first_fn, 'during', username=Prefix('b'), role=OneOf('admin', 'user'))
+        yield self.inst.add_event_handler(second_fn, 'during', username=Range('a', 'c'))
+
+        yield self.inst.remove_event_handler(first_id)
+        removed = yield self.inst.remove_event_handlers_by_match_spec(username=Range('a', 'c'))
+        self.assertEqual(len(removed), 1)
+
+        yield self.inst.fire_event('some_event', username='bob', role='admin')
+        self.assertFalse(first_fn.called, 'removed function should not have been called')
+        self.assertFalse(second_fn.called, 'removed function should not have been called')
+
+    @defer.inlineCallbacks
+    def test_detail_extractor_attributes(self):
+        '''
+        Test details are extracted from event attributes when fired without event_details.
+        '''
+        yield self.inst.stop()
+        self.inst = self.factory(('username', 'role'), detail_extractor='attributes')
+        self.inst.start()
+        listen_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(listen_fn, 'during', role=OneOf('admin', 'owner'))
+
+        admin_event = mock.Mock(username='bob', role='admin')
+        user_event = mock.Mock(username='bob', role='user')
+        yield self.inst.fire_event(admin_event)
+        yield self.inst.fire_event(admin_event)
+        yield self.inst.fire_event(user_event)
+        yield self.inst.fire_events([(user_event, None), (admin_event, None)])
+        # Explicit event_details still take precedence
+        yield self.inst.fire_event(user_event, role='owner')
+
+        self.assertEqual(
+            listen_fn.call_args_list,
+            [mock.call(admin_event), mock.call(admin_event), mock.call(admin_event),
+             mock.call(user_event)])
+        self.assertEqual(self.inst.plan_cache_stats()['hits'], 3)
+
+    @defer.inlineCallbacks
+    def test_detail_extractor_callable(self):
+        '''
+        Test details are extracted with item keys or a callable, and extraction errors fail
+        fire_event.
+        '''
+        yield self.inst.stop()
+        self.inst = self.factory(
+            ('username', 'role'), detail_extractor=extractors.items('user', 'role'))
+        self.inst.start()
+        listen_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(listen_fn, 'during', username='bob', role=None)
+
+        yield self.inst.fire_event({'user': 'bob', 'role': 'admin'})
+        yield self.inst.fire_event({'user': 'susan', 'role': 'admin'})
+        listen_fn.assert_called_once_with({'user': 'bob', 'role': 'admin'})
+
+        yield self.assertFailure(self.inst.fire_event({'role': 'admin'}), KeyError)
+        yield self.assertFailure(
+            self.inst.fire_events([
+                ({'user': 'bob', 'role': 'admin'}, {}),
+                ({'role': 'admin'}, {})]),
+            KeyError)
+        listen_fn.assert_called_once_with({'user': 'bob', 'role': 'admin'})
+        self.assertRaises(
+            ValueError, self.factory, ('username', 'role'), detail_extractor='fields')
+
+    @defer.inlineCallbacks
+    def test_coroutine_handler(self):
+        '''
+        Test that a generator function handler is run as a coroutine and that the phase waits
+        for it to return.
+        '''
+        calls = []
+        during_deferred = defer.Deferred()
+
+        def during_fn(event):
+            '''Coroutine waiting on during_deferred'''
+            calls.append('during')
+            value = yield during_deferred
+            calls.append(value)
+            defer.returnValue(event * 2)
+
+        yield self.inst.add_event_handler(
+            during_fn, 'during', use_weakref=False, sync=True, role='admin')
+        yield self.inst.add_event_handler(
+            lambda event: calls.append('after'), 'after', use_weakref=False)
+
+        fired = self.inst.fire_events([(21, {'role': 'admin'})], collect_results=True)
+        self.assertEqual(calls, ['during'])
+
+        during_deferred.callback('resumed')
+        results = yield fired
+        self.assertEqual(calls, ['during', 'resumed', 'after'])
+        self.assertEqual(results, [[(True, 42), (True, None)]])
+
+    @defer.inlineCallbacks
+    def test_coroutine_method_auto_remove(self):
+        '''
+        Test that a weakly referenced coroutine method is auto removed once collected.
+        '''
+        class Listener(object):
+            '''Object with a coroutine method'''
+            def __init__(self):
+                self.events = []
+
+            def on_event(self, event):
+                '''Coroutine recording event'''
+                yield defer.succeed(None)
+                self.events.append(event)
+
+        listener = Listener()
+        yield self.inst.add_event_handler(listener.on_event, 'during')
+        yield self.inst.fire_event('some_event', role='admin')
+        self.assertEqual(listener.events, ['some_event'])
+
+        del listener
+        yield self.inst.fire_event('some_event', role='admin')
+        self.assertEqual(self.inst.memory_stats()['handlers'], 0)
+
+    @defer.inlineCallbacks
+    def test_max_calls(self):
+        '''
+        Test that a handler with max_calls is removed once it's been called that many times.
+        '''
+        listen_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(listen_fn, 'during', max_calls=2, role='admin')
+
+        for event in ('first', 'second', 'third'):
+            yield self.inst.fire_event(event, role='admin')
+
+        self.assertEqual(listen_fn.call_args_list, [mock.call('first'), mock.call('second')])
+        self.assertEqual(self.inst.memory_stats()['handlers'], 0)
+
+    @defer.inlineCallbacks
+    def test_max_calls_removed_before_event_completes(self):
+        '''
+        Test that a one-shot handler is removed as its event is fired so events fired while it's
+        in flight don't see it.
+        '''
+        during_deferred = defer.Deferred()
+        listen_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(
+            mock.Mock(return_value=during_deferred), 'during', use_weakref=False,
+            role='admin')
+        yield self.inst.add_event_handler(listen_fn, 'after', max_calls=1)
+
+        first = self.inst.fire_event('first', role='admin')
+        yield self.inst.fire_event('second', role='user')
+        self.assertFalse(listen_fn.called)
+
+        during_deferred.callback(None)
+        yield first
+        listen_fn.assert_called_once_with('first')
+
+    @defer.inlineCallbacks
+    def test_max_calls_fire_events(self):
+        '''
+        Test that max_calls is counted for each event in a batch.
+        '''
+        listen_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(listen_fn, 'during', max_calls=1)
+
+        yield self.inst.fire_events([
+            ('first', {'role': 'admin'}),
+            ('second', {'role': 'admin'}),
+            ('third', {'role': 'user'})])
+
+        listen_fn.assert_called_once_with('first')
+
+    def test_invalid_max_calls(self):
+        '''
+        Test that max_calls must be positive and can't be used with coalesce.
+        '''
+        self.assertRaises(
+            ValueError, self.inst.add_event_handler, self.listen_fn_mock(), 'during',
+            max_calls=0)
+        self.assertRaises(
+            ValueError, self.inst.add_event_handler, self.listen_fn_mock(), 'during',
+            max_calls=1, coalesce=Coalesce(max_events=1))
+
+    @defer.inlineCallbacks
+    def test_add_match_spec_keyword(self):
+        '''
+        Test a keyword can be added while events are dispatched, existing handlers matching any
+        value of it and handlers added meanwhile being registered against it.
+        '''
+        listen_fn = self.listen_fn_mock()
+        source_fn = self.listen_fn_mock()
+        for _ in range(5):
+            yield self.inst.add_event_handler(
+                self.listen_fn_mock(), 'before', use_weakref=False, role='user')
+        yield self.inst.add_event_handler(listen_fn, 'during', role='admin')
+
+        changed = self.inst.add_match_spec_keyword('source', chunk_size=2)
+        added = self.inst.add_event_handler(source_fn, 'during', role='admin')
+        self.assertEqual(self.inst.allowed_match_spec_keywords, ('username', 'role'))
+        yield self.inst.fire_event('during_change', role='admin')
+        listen_fn.assert_called_once_with('during_change')
+
+        yield changed
+        yield added
+        self.assertEqual(self.inst.allowed_match_spec_keywords, ('username', 'role', 'source'))
+        yield self.inst.add_event_handler(source_fn, 'after', source='web')
+        yield self.inst.fire_event('after_change', role='admin', source='web')
+        yield self.inst.fire_event('other_source', role='admin', source='cli')
+
+        self.assertEqual(listen_fn.call_count, 3)
+        self.assertEqual(source_fn.call_args_list, [
+            mock.call('after_change'), mock.call('after_change'), mock.call('other_source')])
+        yield self.assertFailure(self.inst.add_match_spec_keyword('source'), ValueError)
+        yield self.assertFailure(self.inst.add_match_spec_keyword('priority'), ValueError)
+        yield self.assertFailure(self.inst.add_match_spec_keyword('tag'), ValueError)
+
+    @defer.inlineCallbacks
+    def test_remove_match_spec_keyword(self):
+        '''
+        Test a keyword can only be removed once no handler constrains it.
+        '''
+        listen_fn = self.listen_fn_mock()
+        yield self.inst.add_event_handler(listen_fn, 'during', username='bob')
+        role_id = yield self.inst.add_event_handler(
+            self.listen_fn_mock(), 'during', use_weakref=False, role='admin')
+
+        yield self.assertFailure(self.inst.remove_match_spec_keyword('role'), ValueError)
+        yield self.inst.remove_event_handler(role_id)
+        yield self.inst.remove_match_spec_keyword('role', chunk_size=1)
+
+        self.assertEqual(self.inst.allowed_match_spec_keywords, ('username',))
+        self.assertRaises(
+            ValueError, self.inst.add_event_handler, self.listen_fn_mock(), 'during', role='x')
+        yield self.inst.fire_event('some_event', username='bob')
+        listen_fn.assert_called_once_with('some_event')
+        yield self.assertFailure(self.inst.remove_match_spec_keyword('role'), ValueError)
+
+    @defer.inlineCallbacks
+    def test_handler_removed_during_keyword_change(self):
+        '''
+        Test a handler removed by max_calls while the indexes are rebuilt isn't left in the new
+        indexes.
+        '''
+        one_shot_fn = self.listen_fn_mock()
+        for _ in range(5):
+            yield self.inst.add_event_handler(
+                self.listen_fn_mock(), 'before', use_weakref=False, role='user')
+        yield self.inst.add_event_handler(one_shot_fn, 'during', max_calls=1, role='admin')
+
+        changed = self.inst.add_match_spec_keyword('source', chunk_size=2)
+        yield self.inst.fire_event('first', role='admin')
+        yield changed
+        yield self.inst.fire_event('second', role='admin')
+
+        one_shot_fn.assert_called_once_with('first')
+        self.assertEqual(self.inst.memory_stats()['handlers'], 5)
+
+    def test_keyword_change_uses_reactor(self):
+        '''
+        Test indexes are rebuilt for new keywords on the dispatcher's reactor.
+        '''
+        clock = task.Clock()
+        inst = self.factory(('username',), reactor=clock)
+        inst.start()
+        changed = inst.add_match_spec_keyword('role')
+        self.assertNoResult(changed)
+
+        for _ in range(5):
+            clock.advance(0)
+        self.assertEqual(self.successResultOf(changed), None)
+        self.assertEqual(inst.allowed_match_spec_keywords, ('username', 'role'))
+
+    def test_queued_keyword_changes(self):
+        '''
+        Test keyword changes requested back to back are each made against the keywords left by
+        the one before.
+        '''
+        clock = task.Clock()
+        inst = self.factory(('a', 'b', 'c'), reactor=clock)
+        inst.start()
+        listen_fn = self.listen_fn_mock()
+        inst.add_event_handler(listen_fn, 'during', b='bob')
+        changes = [
+            inst.remove_match_spec_keyword('a'),
+            inst.remove_match_spec_keyword('c'),
+            inst.add_match_spec_keyword('x'),
+            inst.add_match_spec_keyword('y'),
+            inst.add_match_spec_keyword('x'),
+        ]
+        for _ in range(20):
+            clock.advance(0)
+
+        for change in changes[:4]:
+            self.assertEqual(self.successResultOf(change), None)
+        self.failureResultOf(changes[4], ValueError)
+        self.assertEqual(inst.allowed_match_spec_keywords, ('b', 'x', 'y'))
+        inst.fire_event('match', b='bob', x=1, y=2)
+        inst.fire_event('no_match', b='alice', x=1, y=2)
+        listen_fn.assert_called_once_with('match')
+
+    @defer.inlineCallbacks
+    def test_unhashable_details(self):
+        '''
+        Test firing events with unhashable event_details fails the returned Deferred rather
+        than raising.
+        '''
+        yield self.assertFailure(self.inst.fire_event('some_event', username=['bob']), TypeError)
+        yield self.assertFailure(
+            self.inst.fire_events([('some_event', {'username': ['bob']})]), TypeError)
+
+
+class TestBitsetEventDispatcher(TestEventDispatcher):
+    '''
+    Test EventDispatcher using the bitset index engine
+    '''
+    factory = functools.partial(EventDispatcher, index_engine='bitset')
+
+    @defer.inlineCallbacks
+    def test_slot_reuse(self):
+        '''
+        Test that slots freed by removed handlers are reused without matching stale handlers.
+        '''
+        first_fn = self.listen_fn_mock()
+        second_fn = self.listen_fn_mock()
+
+        handle = yield self.inst.add_event_handler(first_fn, 'during', role='admin')
+        yield self.inst.remove_event_handler(handle)
+        yield self.inst.add_event_handler(second_fn, 'during', role='user')
+
+        yield self.inst.fire_event('admin_event', role='admin')
+        yield self.inst.fire_event('user_event', role='user')
+
+        self.assertFalse(first_fn.called, 'removed function should not have been called')
+        second_fn.assert_called_once_with('user_event')
+
+    def test_invalid_index_engine(self):
+        '''
+        Test that asking for an unknown index engine raises an exception.
+        '''
+        self.assertRaises(
+            ValueError, EventDispatcher, ('username', 'role'), index_engine='unknown')
+
+    def test_reserved_keywords(self):
+        '''
+        Test that arguments of add_event_handler, subscribe and fire_event can't be match spec
+        keywords.
+        '''
+        for keyword in ('priority', 'tag', 'sync', 'executor', 'coalesce', 'max_calls',
+                        'timeout', 'max_size', 'overflow_policy'):
+            self.assertRaises(ValueError, EventDispatcher, ('username', keyword))
+
+
+class TestIndexMemory(unittest.TestCase):
+    '''
+    Test that index memory is bounded by what's registered rather than what's been fired
+    '''
+    index_engine = 'set'
+
+    def setUp(self):
+        '''setUp test'''
+        self.inst = EventDispatcher(
+            ('username', 'role'), plan_cache_size=0, index_engine=self.index_engine)
+        self.inst.start()
+
+    def tearDown(self):
+        '''tearDown test'''
+        return self.inst.stop()
+
+    @defer.inlineCallbacks
+    def test_fire_does_not_grow_index(self):
+        '''
+        Test that firing events with new values or unknown keywords doesn't add postings.
+        '''
+        yield self.inst.add_event_handler(
+            mock.Mock(spec='__call__'), 'during', use_weakref=False, role='admin')
+        before = self.inst.memory_stats()
+
+        for username in range(100):
+            yield self.inst.fire_event('some_event', username=username, password='secret')
+            yield self.inst.fire_event('some_event', username=username, role=username)
+
+        self.assertEqual(self.inst.memory_stats(), before)
+
+    @defer.inlineCallbacks
+    def test_remove_prunes_postings(self):
+        '''
+        Test that removing every handler leaves no postings behind.
+        '''
+        handles = []
+        for username in range(10):
+            handle = yield self.inst.add_event_handler(
+                mock.Mock(spec='__call__'), 'during', use_weakref=False, username=username)
+            handles.append(handle)
+
+        stats = self.inst.memory_stats()
+        self.assertEqual(stats['handlers'], 10)
+        # One posting per username and one for the role wildcard
+        self.assertEqual(stats['postings'], 11)
+
+        for handle in handles:
+            yield self.inst.remove_event_handler(handle)
+
+        stats = self.inst.memory_stats()
+        self.assertEqual(stats['handlers'], 0)
+        self.assertEqual(stats['postings'], 0)
+
+    @defer.inlineCallbacks
+    def test_remove_prunes_matchers(self):
+        '''
+        Test that removing handlers with matchers leaves no postings behind.
+        '''
+        handles = []
+        for username in ('bob', 'bobby', 'susan'):
+            handle = yield self.inst.add_event_handler(
+                mock.Mock(spec='__call__'), 'during', use_weakref=False,
+                username=Prefix(username), role=OneOf('admin', username))
+            handles.append(handle)
+        handle = yield self.inst.add_event_handler(
+            mock.Mock(spec='__call__'), 'during', use_weakref=False, username=Range(1, 10))
+        handles.append(handle)
+
+        for handle in handles:
+            yield self.inst.remove_event_handler(handle)
+
+        stats = self.inst.memory_stats()
+        self.assertEqual(stats['handlers'], 0)
+        self.assertEqual(stats['postings'], 0)
+
+    @defer.inlineCallbacks
+    def test_memory_linear_in_handlers(self):
+        '''
+        Test that the memory used for each handler doesn't grow with the number of handlers
+        when each is matched on a username of its own.
+        '''
+        bytes_per_handler = []
+        for first_username, handler_count in ((0, 1000), (1000, 4000)):
+            for username in range(first_username, handler_count):
+                yield self.inst.add_event_handler(
+                    mock.Mock(spec='__call__'), 'during', use_weakref=False, username=username)
+            bytes_per_handler.append(
+                self.inst.memory_stats()['estimated_bytes'] / float(handler_count))
+
+        self.assertLess(bytes_per_handler[1], bytes_per_handler[0] * 1.5)
+
+    @defer.inlineCallbacks
+    def test_dense_postings(self):
+        '''
+        Test that handlers sharing a value match correctly as their number rises and falls.
+        '''
+        listen_fns = [mock.Mock(spec='__call__') for _ in range(100)]
+        handles = []
+        for index, listen_fn in enumerate(listen_fns):
+            handle = yield self.inst.add_event_handler(
+                listen_fn, 'during', use_weakref=False, role='admin',
+                username=None if index % 2 else 'bob')
+            handles.append(handle)
+        yield self.inst.fire_event('crowded', username='bob', role='admin')
+
+        for handle in handles[:90]:
+            yield self.inst.remove_event_handler(handle)
+        yield self.inst.fire_event('sparse', username='susan', role='admin')
+
+        self.assertEqual(
+            [listen_fn.call_args_list for listen_fn in listen_fns[90:]],
+            [[mock.call('crowded'), mock.call('sparse')] if index % 2 else [mock.call('crowded')]
+             for index in range(90, 100)])
+        self.assertTrue(all(listen_fn.call_count == 1 for listen_fn in listen_fns[:90]))
+
+
+class TestBitsetIndexMemory(TestIndexMemory):
+    '''
+    Test index memory using the bitset index engine
+    '''
+    index_engine = 'bitset'
+
+
+class TestBackpressure(unittest.TestCase):
+    '''
+    Test limits on events in flight and queued
+    '''
+    def make_dispatcher(self, **kwargs):
+        '''
+        Create started dispatcher with a handler for every event that won't complete until the
+        test calls back the Deferred for it.
+        '''
+        inst = EventDispatcher(('username',), max_in_flight_events=1, **kwargs)
+        self.pending = []
+
+        def slow_fn(event):
+            '''Return Deferred that the test controls'''
+            pending_deferred = defer.Deferred()
+            self.pending.append((event, pending_deferred))
+            return pending_deferred
+
+        inst.add_event_handler(slow_fn, 'during', use_weakref=False)
+        inst.start()
+        return inst
+
+    def complete_next(self):
+        '''
+        Complete the oldest handler call still waiting.
+        '''
+        event, pending_deferred = self.pending.pop(0)
+        pending_deferred.callback(None)
+        return event
+
+    def test_events_queued_beyond_in_flight_limit(self):
+        '''
+        Test events are queued in order while max_in_flight_events are in flight.
+        '''
+        inst = self.make_dispatcher()
+        completed = []
+        for event in ('event_1', 'event_2', 'event_3'):
+            inst.fire_event(event, username='bob').addCallback(
+                lambda _, event=event: completed.append(event))
+
+        self.assertEqual(inst.queue_stats()['in_flight'], 1)
+        self.assertEqual(inst.queue_stats()['queued'], 2)
+
+        self.assertEqual(self.complete_next(), 'event_1')
+        self.assertEqual(self.complete_next(), 'event_2')
+        self.assertEqual(self.complete_next(), 'event_3')
+
+        self.assertEqual(completed, ['event_1', 'event_2', 'event_3'])
+        self.assertEqual(inst.queue_stats()['in_flight'], 0)
+        self.assertEqual(inst.queue_stats()['queued'], 0)
+
+    def test_reject_when_queue_full(self):
+        '''
+        Test events beyond max_queued_events are rejected by default.
+        '''
+        inst = self.make_dispatcher(max_queued_events=1)
+        inst.fire_event('event_1', username='bob')
+        inst.fire_event('event_2', username='bob')
+        rejected = inst.fire_event('event_3', username='bob')
+
+        self.failureResultOf(rejected, DispatchQueueFull)
+        self.assertEqual(inst.queue_stats()['rejected'], 1)
+
+    def test_drop_oldest_when_queue_full(self):
+        '''
+        Test the oldest queued event is dropped to make room with the drop_oldest policy.
+        '''
+        inst = self.make_dispatcher(max_queued_events=1, overflow_policy='drop_oldest')
+        inst.fire_event('event_1', username='bob')
+        dropped = inst.fire_event('event_2', username='bob')
+        inst.fire_event('event_3', username='bob')
+
+        self.failureResultOf(dropped, EventDropped)
+        self.assertEqual(inst.queue_stats()['dropped'], 1)
+        self.assertEqual(self.complete_next(), 'event_1')
+        self.assertEqual(self.complete_next(), 'event_3')
+
+    def test_wait_when_queue_full(self):
+        '''
+        Test events beyond max_queued_events wait for admission with the wait policy.
+        '''
+        inst = self.make_dispatcher(max_queued_events=1, overflow_policy='wait')
+        events = ('event_1', 'event_2', 'event_3')
+        fired = [inst.fire_event(event, username='bob') for event in events]
+
+        self.assertEqual(inst.queue_stats()['waiting'], 1)
+        for expected_event, fire_deferred in zip(events, fired):
+            self.assertNoResult(fire_deferred)
+            self.assertEqual(self.complete_next(), expected_event)
+            self.successResultOf(fire_deferred)
+
+    def test_wait_for_admission(self):
+        '''
+        Test producers can wait until an event fired would be queued rather than held.
+        '''
+        inst = self.make_dispatcher(max_queued_events=1, overflow_policy='wait')
+        self.successResultOf(inst.wait_for_admission())
+        for event in ('event_1', 'event_2', 'event_3'):
+            inst.fire_event(event, username='bob')
+
+        room = inst.wait_for_admission()
+        self.assertNoResult(room)
+        self.assertEqual(self.complete_next(), 'event_1')
+        self.assertNoResult(room)
+        self.assertEqual(self.complete_next(), 'event_2')
+        self.successResultOf(room)
+
+    def test_phase_concurrency(self):
+        '''
+        Test no more than the configured number of handlers run at once in a phase.
+        '''
+        inst = EventDispatcher(('username',), phase_concurrency={'during': 1})
+        pending = []
+        for _ in range(2):
+            inst.add_event_handler(
+                lambda event: pending.append(defer.Deferred()) or pending[-1],
+                'during',
+                use_weakref=False)
+        inst.start()
+
+        inst.fire_event('event_1', username='bob')
+        self.assertEqual(len(pending), 1)
+
+        pending[0].callback(None)
+        self.assertEqual(len(pending), 2)
+
+    def test_priority_order(self):
+        '''
+        Test queued events are admitted highest priority first and FIFO within a priority.
+        '''
+        inst = self.make_dispatcher()
+        inst.fire_event('event_1', username='bob')
+        inst.fire_event('low_1', priority=-1, username='bob')
+        inst.fire_event('normal_1', username='bob')
+        inst.fire_event('urgent_1', priority=10, username='bob')
+        inst.fire_event('urgent_2', priority=10, username='bob')
+
+        priorities = inst.queue_stats()['priorities']
+        self.assertEqual(
+            {priority: stats['queued'] for priority, stats in priorities.iteritems()},
+            {-1: 1, 0: 1, 10: 2})
+
+        completed = [self.complete_next() for _ in range(5)]
+        self.assertEqual(completed, ['event_1', 'urgent_1', 'urgent_2', 'normal_1', 'low_1'])
+
+        priorities = inst.queue_stats()['priorities']
+        self.assertEqual(priorities[10]['admitted'], 2)
+        self.assertEqual(priorities[10]['queued'], 0)
+        self.assertIsNone(priorities[10]['oldest_wait'])
+        self.assertGreaterEqual(priorities[-1]['max_wait'], priorities[-1]['mean_wait'])
+
+    def test_starvation_limit(self):
+        '''
+        Test an old low priority event is admitted once starvation_limit events have overtaken
+        it.
+        '''
+        inst = self.make_dispatcher(starvation_limit=2)
+        inst.fire_event('event_1', username='bob')
+        inst.fire_event('low', priority=-1, username='bob')
+        for index in range(4):
+            inst.fire_event('urgent_{}'.format(index), priority=1, username='bob')
+
+        completed = [self.complete_next() for _ in range(6)]
+        self.assertEqual(
+            completed, ['event_1', 'urgent_0', 'urgent_1', 'low', 'urgent_2', 'urgent_3'])
+        self.assertEqual(inst.queue_stats()['promoted'], 1)
+
+    def test_drop_lowest_priority_when_queue_full(self):
+        '''
+        Test drop_oldest drops the lowest priority event, or the new one if it's lower still.
+        '''
+        inst = self.make_dispatcher(max_queued_events=2, overflow_policy='drop_oldest')
+        inst.fire_event('event_1', username='bob')
+        inst.fire_event('normal', username='bob')
+        dropped = inst.fire_event('low', priority=-1, username='bob')
+        inst.fire_event('urgent', priority=1, username='bob')
+        rejected = inst.fire_event('lowest', priority=-2, username='bob')
+
+        self.failureResultOf(dropped, EventDropped)
+        self.failureResultOf(rejected, EventDropped)
+        self.assertEqual(inst.queue_stats()['dropped'], 2)
+        completed = [self.complete_next() for _ in range(3)]
+        self.assertEqual(completed, ['event_1', 'urgent', 'normal'])
+
+    def test_drop_oldest_without_queue(self):
+        '''
+        Test drop_oldest drops the new event when max_queued_events is 0.
+        '''
+        inst = self.make_dispatcher(max_queued_events=0, overflow_policy='drop_oldest')
+        inst.fire_event('event_1', username='bob')
+        dropped = inst.fire_event('event_2', username='bob')
+
+        self.failureResultOf(dropped, EventDropped)
+        self.assertEqual(inst.queue_stats()['dropped'], 1)
+        self.assertEqual(self.complete_next(), 'event_1')
+
+    def test_queued_dispatch_raising(self):
+        '''
+        Test a queued dispatch raising fails its own Deferred and later events are admitted.
+        '''
+        inst = self.make_dispatcher()
+        inst.fire_event('event_1', username='bob')
+        inst._dispatch_event = mock.Mock(side_effect=ValueError('bad dispatch'))
+        failed = inst.fire_event('bad', username='bob')
+        del inst._dispatch_event
+        inst.fire_event('event_3', username='bob')
+
+        self.assertEqual(self.complete_next(), 'event_1')
+        self.failureResultOf(failed, ValueError)
+        self.assertEqual(self.complete_next(), 'event_3')
+
+
+class TestInstrumentation(unittest.TestCase):
+    '''
+    Test dispatch instrumentation
+    '''
+    def setUp(self):
+        '''setUp test'''
+        self.sink = InMemorySink()
+        self.inst = EventDispatcher(('username',), instrumentation_sinks=(self.sink,))
+        self.inst.start()
+
+    def tearDown(self):
+        '''tearDown test'''
+        return self.inst.stop()
+
+    @defer.inlineCallbacks
+    def test_handler_and_phase_metrics(self):
+        '''
+        Test handler calls, errors, phases and whole events are recorded.
+        '''
+        ok_id = yield self.inst.add_event_handler(
+            mock.Mock(return_value=None), 'before', use_weakref=False)
+        error_id = yield self.inst.add_event_handler(
+            mock.Mock(side_effect=ValueError('bad event')), 'after', use_weakref=False)
+
+        yield self.inst.fire_event('event_1', username='bob')
+        yield self.inst.fire_event('event_2', username='susan')
+        self.flushLoggedErrors(ValueError)
+
+        snapshot = self.sink.snapshot()
+        self.assertEqual(snapshot['handlers'][ok_id]['calls'], 2)
+        self.assertEqual(snapshot['handlers'][ok_id]['errors'], 0)
+        self.assertEqual(snapshot['handlers'][error_id]['calls'], 2)
+        self.assertEqual(snapshot['handlers'][error_id]['errors'], 2)
+        self.assertEqual(snapshot['phases']['before']['count'], 2)
+        self.assertEqual(snapshot['phases']['after']['count'], 2)
+        self.assertNotIn('during', snapshot['phases'])
+        self.assertEqual(snapshot['fire_latency']['count'], 2)
+
+    @defer.inlineCallbacks
+    def test_deferred_handler_latency(self):
+        '''
+        Test a handler returning a Deferred is timed until the Deferred fires.
+        '''
+        records = []
+        self.inst.add_instrumentation_sink(CallbackSink(
+            lambda metric, key, duration, failed: records.append((metric, key, failed))))
+        handler_deferred = defer.Deferred()
+        handler_id = yield self.inst.add_event_handler(
+            mock.Mock(return_value=handler_deferred), 'during', use_weakref=False)
+
+        self.inst.fire_event('event_1', username='bob')
+        self.assertEqual(records, [])
+
+        handler_deferred.callback(None)
+        self.assertEqual(records, [
+            ('handler', handler_id, False),
+            ('phase', 'during', False),
+            ('fire', None, False),
+        ])
+
+    @defer.inlineCallbacks
+    def test_disabled(self):
+        '''
+        Test nothing is recorded once the last sink is removed.
+        '''
+        yield self.inst.add_event_handler(
+            mock.Mock(return_value=None), 'during', use_weakref=False)
+        yield self.inst.fire_event('event_1', username='bob')
+
+        self.inst.remove_instrumentation_sink(self.sink)
+        self.sink.reset()
+        yield self.inst.fire_event('event_1', username='bob')
+
+        snapshot = self.sink.snapshot()
+        self.assertEqual(snapshot['handlers'], {})
+        self.assertEqual(snapshot['fire_latency']['count'], 0)
+
+
+class TestExecutors(unittest.TestCase):
+    '''
+    Test handlers run by executors
+    '''
+    def setUp(self):
+        '''setUp test'''
+        self.inst = EventDispatcher(('username',))
+        self.inst.start()
+
+    def tearDown(self):
+        '''tearDown test'''
+        return self.inst.stop()
+
+    @defer.inlineCallbacks
+    def test_thread_executor(self):
+        '''
+        Test handler runs in a thread and its result is waited for.
+        '''
+        yield self.inst.add_event_handler(
+            lambda event: (threading.current_thread().name, event),
+            'during', use_weakref=False, executor='thread')
+
+        results = yield self.inst.fire_events([('event_1', {'username': 'bob'})], True)
+        ((success, (thread_name, event)),), = results
+        self.assertTrue(success)
+        self.assertEqual(event, 'event_1')
+        self.assertNotEqual(thread_name, threading.current_thread().name)
+
+    @defer.inlineCallbacks
+    def test_process_executor(self):
+        '''
+        Test handler runs in another process and remote errors come back as failures.
+        '''
+        yield self.inst.add_event_handler(_process_handler, 'during', executor='process')
+
+        results = yield self.inst.fire_events(
+            [(21, {'username': 'bob'}), (None, {'username': 'bob'})], True)
+        (success, (pid, value)), = results[0]
+        self.assertTrue(success)
+        self.assertEqual(value, 42)
+        self.assertNotEqual(pid, os.getpid())
+
+        (success, remote_failure), = results[1]
+        self.assertFalse(success)
+        self.assertIsInstance(remote_failure.value, RemoteHandlerError)
+        self.assertIn('No event', str(remote_failure.value))
+
+    def test_process_executor_unpicklable(self):
+        '''
+        Test handlers that can't be sent to another process are rejected at registration.
+        '''
+        self.assertRaises(
+            ValueError,
+            self.inst.add_event_handler,
+            lambda event: None, 'during', use_weakref=False, executor='process')
+
+    def test_unknown_executor(self):
+        '''
+        Test unknown executor names are rejected.
+        '''
+        self.assertRaises(
+            ValueError,
+            self.inst.add_event_handler,
+            _process_handler, 'during', executor='gpu')
+
+    @defer.inlineCallbacks
+    def test_max_pending(self):
+        '''
+        Test executor rejects calls beyond max_pending.
+        '''
+        release = threading.Event()
+        executor = ThreadPoolExecutor(size=1, max_pending=1)
+        self.addCleanup(executor.stop)
+        yield self.inst.add_event_handler(
+            lambda event: release.wait(), 'during', use_weakref=False, executor=executor)
+
+        first = self.inst.fire_event('event_1', username='bob')
+        second = self.inst.fire_events([('event_2', {'username': 'bob'})], True)
+        rejected = executor.rejected
+        release.set()
+        yield first
+
+        ((success, rejected_failure),), = yield second
+        self.assertFalse(success)
+        rejected_failure.trap(ExecutorQueueFull)
+        self.assertEqual(rejected, 1)
+        self.assertEqual(executor.pending, 0)
+
+    @defer.inlineCallbacks
+    def test_process_executor_unpicklable_event(self):
+        '''
+        Test an event that can't be sent to another process fails its handler call.
+        '''
+        yield self.inst.add_event_handler(_process_handler, 'during', executor='process')
+
+        results = yield self.inst.fire_events([(lambda: None, {'username': 'bob'})], True)
+        ((success, unpicklable_failure),), = results
+        self.assertFalse(success)
+        unpicklable_failure.trap(ValueError)
+        self.assertEqual(self.inst._executors['process'].pending, 0)
+
+    @defer.inlineCallbacks
+    def test_max_pending_after_timeout(self):
+        '''
+        Test a call whose handler timed out stays pending until its thread finishes it.
+        '''
+        release = threading.Event()
+        clock = task.Clock()
+        executor = ThreadPoolExecutor(size=1, max_pending=1)
+        self.addCleanup(executor.stop)
+        self.addCleanup(release.set)
+        inst = EventDispatcher(('username',), reactor=clock)
+        inst.start()
+        yield inst.add_event_handler(
+            lambda event: release.wait(), 'during', use_weakref=False, executor=executor,
+            timeout=1)
+
+        timed_out = inst.fire_events([('event_1', {'username': 'bob'})], True)
+        clock.advance(1)
+        ((success, timeout_failure),), = yield timed_out
+        self.assertFalse(success)
+        timeout_failure.trap(HandlerTimeout)
+        self.assertEqual(executor.pending, 1)
+
+        rejected = inst.fire_events([('event_2', {'username': 'bob'})], True)
+        self.assertEqual(executor.rejected, 1)
+        ((success, rejected_failure),), = yield rejected
+        self.assertFalse(success)
+        rejected_failure.trap(ExecutorQueueFull)
+
+        release.set()
+        while executor.pending:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        yield inst.stop()
+
+
+class TestShardedEventDispatcher(unittest.TestCase):
+    '''
+    Test ShardedEventDispatcher with real worker processes
+    '''
+    def setUp(self):
+        '''setUp test'''
+        self.inst = ShardedEventDispatcher(('username', 'role'), 'username', worker_count=2)
+        return self.inst.start()
+
+    def tearDown(self):
+        '''tearDown test'''
+        return self.inst.stop()
+
+    @defer.inlineCallbacks
+    def test_partitioned(self):
+        '''
+        Test events are handled in worker processes with one worker per partition key.
+        '''
+        yield self.inst.add_event_handler(_process_handler, 'during', role='admin')
+
+        usernames = ['user_{}'.format(index) for index in range(8)]
+        results = yield self.inst.fire_events(
+            [(index, {'username': username, 'role': 'admin'})
+             for username in usernames for index in range(3)] +
+            [(1, {'username': 'bob', 'role': 'guest'})],
+            collect_results=True)
+
+        self.assertEqual(results[-1], [])
+        pids_by_username = {}
+        for username, event_results in zip(
+                (username for username in usernames for _ in range(3)), results[:-1]):
+            (success, (pid, _)), = event_results
+            self.assertTrue(success)
+            self.assertNotEqual(pid, os.getpid())
+            pids_by_username.setdefault(username, set()).add(pid)
+        self.assertTrue(all(len(pids) == 1 for pids in pids_by_username.itervalues()))
+        self.assertEqual(len(set.union(*pids_by_username.values())), 2)
+
+    @defer.inlineCallbacks
+    def test_partition_order(self):
+        '''
+        Test events with the same partition key complete in the order they were fired.
+        '''
+        yield self.inst.add_event_handler(_delayed_handler, 'during')
+
+        first = self.inst.fire_events([(('first', 0.05), {'username': 'bob'})], True)
+        second = self.inst.fire_events([(('second', 0), {'username': 'bob'})], True)
+        yield first
+        ((success, completed),), = yield second
+        self.assertTrue(success)
+        self.assertEqual(completed, ['first', 'second'])
+
+    @defer.inlineCallbacks
+    def test_remote_error_and_remove(self):
+        '''
+        Test handler errors are returned as RemoteHandlerError and removed handlers aren't run.
+        '''
+        handler_id = yield self.inst.add_event_handler(_process_handler, 'during')
+
+        ((success, remote_failure),), = yield self.inst.fire_events(
+            [(None, {'username': 'bob'})], True)
+        self.assertFalse(success)
+        remote_failure.trap(RemoteHandlerError)
+        self.assertIn('No event', str(remote_failure.value))
+
+        yield self.inst.remove_event_handler(handler_id)
+        results = yield self.inst.fire_events([(None, {'username': 'bob'})], True)
+        self.assertEqual(results, [[]])
+        yield self.assertFailure(self.inst.remove_event_handler(handler_id), KeyError)
+
+    @defer.inlineCallbacks
+    def test_restart(self):
+        '''
+        Test handlers are registered with new workers when restarted.
+        '''
+        yield self.inst.add_event_handler(_process_handler, 'during')
+        yield self.inst.stop()
+        self.assertFalse(self.inst.running)
+        yield self.inst.start()
+
+        ((success, (_, value)),), = yield self.inst.fire_events(
+            [(2, {'username': 'bob'})], True)
+        self.assertTrue(success)
+        self.assertEqual(value, 4)
+
+    def test_invalid_handlers(self):
+        '''
+        Test handlers that can't be registered with the workers are rejected.
+        '''
+        self.assertRaises(
+            ValueError, self.inst.add_event_handler, lambda event: None, 'during')
+        self.assertRaises(
+            ValueError, self.inst.add_event_handler, _process_handler, 'during', colour='red')
+        self.assertRaises(
+            ValueError, self.inst.add_event_handler, _process_handler, 'sometime')
+
+
+class TestCoalescing(unittest.TestCase):
+    '''
+    Test coalesced handlers
+    '''
+    def setUp(self):
+        '''setUp test'''
+        self.clock = task.Clock()
+        self.inst = EventDispatcher(('username', 'role'), reactor=self.clock)
+        self.inst.start()
+
+    def tearDown(self):
+        '''tearDown test'''
+        return self.inst.stop()
+
+    @defer.inlineCallbacks
+    def test_last_in_window(self):
+        '''
+        Test only the latest event for each event_details is delivered once the window passes.
+        '''
+        listen_fn = mock.Mock(spec='__call__')
+        handler_id = yield self.inst.add_event_handler(
+            listen_fn, 'during', use_weakref=False, coalesce=Coalesce(window=1))
+
+        for index in range(5):
+            yield self.inst.fire_event(('bob', index), username='bob')
+        yield self.inst.fire_event(('susan', 0), username='susan')
+        self.assertFalse(listen_fn.called, 'function should not have been called yet')
+
+        self.clock.advance(1)
+        self.assertEqual(
+            sorted(listen_fn.call_args_list), [mock.call(('bob', 4)), mock.call(('susan', 0))])
+        self.assertEqual(
+            self.inst.coalesce_stats(),
+            {handler_id: {'received': 6, 'delivered': 2, 'buffered': 0}})
+
+    @defer.inlineCallbacks
+    def test_batch_max_events(self):
+        '''
+        Test batches are delivered as soon as max_events are buffered.
+        '''
+        listen_fn = mock.Mock(spec='__call__')
+        yield self.inst.add_event_handler(
+            listen_fn, 'during', use_weakref=False,
+            coalesce=Coalesce(window=10, max_events=3, deliver='batch'))
+
+        for index in range(4):
+            yield self.inst.fire_event(index, username='bob')
+        listen_fn.assert_called_once_with([0, 1, 2])
+
+        self.clock.advance(10)
+        self.assertEqual(listen_fn.call_args_list, [mock.call([0, 1, 2]), mock.call([3])])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @defer.inlineCallbacks
+    def test_flushed_on_stop(self):
+        '''
+        Test buffers are delivered when the dispatcher is stopped and discarded when the handler
+        is removed.
+        '''
+        kept_fn = mock.Mock(spec='__call__')
+        removed_fn = mock.Mock(spec='__call__')
+        yield self.inst.add_event_handler(
+            kept_fn, 'during', use_weakref=False, coalesce=Coalesce(max_events=10))
+        removed_id = yield self.inst.add_event_handler(
+            removed_fn, 'during', use_weakref=False, coalesce=Coalesce(window=1))
+
+        yield self.inst.fire_event('some_event', username='bob')
+        yield self.inst.remove_event_handler(removed_id)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        yield self.inst.stop()
+        kept_fn.assert_called_once_with('some_event')
+        self.assertFalse(removed_fn.called, 'removed function should not have been called')
+
+    def test_invalid(self):
+        '''
+        Test coalescing needs a window or max_events and a known delivery.
+        '''
+        self.assertRaises(ValueError, Coalesce)
+        self.assertRaises(ValueError, Coalesce, window=1, deliver='first')
+
+
+class TestJournal(unittest.TestCase):
+    '''
+    Test journaling and replay of events
+    '''
+    def setUp(self):
+        '''setUp test'''
+        self.path = self.mktemp()
+        self.journal = EventJournal(self.path, flush_interval=0.01, fsync=False)
+        self.inst = EventDispatcher(('username', 'role'), journal=self.journal)
+        self.inst.start()
+
+    def tearDown(self):
+        '''tearDown test'''
+        return self.inst.stop().addCallback(lambda _: self.journal.close())
+
+    @defer.inlineCallbacks
+    def test_group_commit(self):
+        '''
+        Test records are buffered until the flush interval passes or max_batch_size are buffered.
+        '''
+        yield self.inst.fire_event('first', username='bob')
+        yield self.inst.fire_events([('second', {'role': 'admin'}), ('third', {})])
+        self.assertEqual(self.journal.stats()['buffered'], 3)
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(self.journal.stats()['buffered'], 0)
+        yield self.journal.flush()
+        self.assertEqual(self.journal.stats()['flushes'], 1)
+        self.assertEqual(os.path.getsize(self.path), self.journal.end_offset)
+
+        batched = EventJournal(self.mktemp(), flush_interval=60, max_batch_size=2, fsync=False)
+        self.addCleanup(batched.close)
+        batched.append('first', {})
+        batched.append('second', {})
+        self.assertEqual(batched.stats()['writing'], 2)
+        self.assertEqual(batched.stats()['buffered'], 0)
+
+    @defer.inlineCallbacks
+    def test_append_while_writing(self):
+        '''
+        Test records appended while a write is in progress are buffered for the next one.
+        '''
+        self.journal.append('first', {})
+        writing = self.journal.flush()
+        self.journal.append('second', {})
+        self.assertEqual(self.journal.stats()['writing'], 1)
+        self.assertEqual(self.journal.stats()['buffered'], 1)
+
+        yield self.journal.flush()
+        self.assertTrue(writing.called)
+        self.assertEqual(self.journal.stats()['flushes'], 2)
+        self.assertEqual(os.path.getsize(self.path), self.journal.end_offset)
+        self.assertEqual(
+            [event for _, event, _ in self.journal.read()], ['first', 'second'])
+
+    @defer.inlineCallbacks
+    def test_replay(self):
+        '''
+        Test events are replayed in order from an offset through a new dispatcher using the same
+        journal file, without being journaled again.
+        '''
+        yield self.inst.fire_event('first', username='bob')
+        offset = self.journal.end_offset
+        yield self.inst.fire_event('second', username='bob')
+        yield self.inst.fire_event('third', username='alice')
+        yield self.inst.stop()
+        yield self.journal.close()
+
+        self.journal = EventJournal(self.path, fsync=False)
+        self.inst = EventDispatcher(('username', 'role'), journal=self.journal)
+        self.inst.start()
+        listen_fn = mock.Mock(spec='__call__')
+        yield self.inst.add_event_handler(listen_fn, 'during', use_weakref=False, username='bob')
+
+        replayed_offset = yield self.inst.replay_journal(batch_size=2)
+        self.assertEqual(listen_fn.call_args_list, [mock.call('first'), mock.call('second')])
+        self.assertEqual(replayed_offset, self.journal.end_offset)
+        self.assertEqual(self.journal.stats()['appended'], 0)
+
+        listen_fn.reset_mock()
+        yield self.inst.replay_journal(offset)
+        self.assertEqual(listen_fn.call_args_list, [mock.call('second')])
+
+    @defer.inlineCallbacks
+    def test_incomplete_record_ignored(self):
+        '''
+        Test an incomplete record left at the end of the journal by a crash isn't read.
+        '''
+        yield self.inst.fire_event('first', username='bob')
+        yield self.journal.flush()
+        with open(self.path, 'ab') as journal_file:
+            journal_file.write('\x00\x00\x01\x00partial')
+
+        self.assertEqual(
+            [event for _, event, _ in self.journal.read()], ['first'])
+
+    def test_unpicklable_event(self):
+        '''
+        Test firing an event that can't be journaled fails.
+        '''
+        fired = self.inst.fire_event(lambda: None, username='bob')
+        return self.assertFailure(fired, Exception)
+
+    @defer.inlineCallbacks
+    def test_only_admitted_events_journaled(self):
+        '''
+        Test events rejected by the admission queue aren't journaled.
+        '''
+        slow_deferred = defer.Deferred()
+        inst = EventDispatcher(
+            ('username',), journal=self.journal, max_in_flight_events=1, max_queued_events=1)
+        inst.start()
+        yield inst.add_event_handler(
+            mock.Mock(return_value=slow_deferred), 'during', use_weakref=False)
+
+        first = inst.fire_event('first', username='bob')
+        queued = inst.fire_event('queued', username='bob')
+        rejected = inst.fire_event('rejected', username='bob')
+        yield self.assertFailure(rejected, DispatchQueueFull)
+        self.assertEqual(self.journal.stats()['appended'], 1)
+
+        slow_deferred.callback(None)
+        yield first
+        yield queued
+        yield inst.stop()
+        self.assertEqual(
+            [event for _, event, _ in self.journal.read()], ['first', 'queued'])
+
+    def test_replay_without_journal(self):
+        '''
+        Test replaying a dispatcher without a journal fails.
+        '''
+        inst = EventDispatcher(('username',))
+        inst.start()
+        return self.assertFailure(inst.replay_journal(), ValueError)
+
+    @defer.inlineCallbacks
+    def test_unpicklable_batch(self):
+        '''
+        Test a batch with an event that can't be journaled fails without journaling any of it.
+        '''
+        fired = self.inst.fire_events(
+            [('first', {'username': 'bob'}), (lambda: None, {'username': 'bob'})])
+        yield self.assertFailure(fired, Exception)
+        self.assertEqual(self.journal.stats()['appended'], 0)
+
+    @defer.inlineCallbacks
+    def test_failed_write_truncated(self):
+        '''
+        Test part of a record left by a failed write is cut off so later records can be read.
+        '''
+        self.journal.append('first', {})
+        yield self.journal.flush()
+        good_offset = self.journal.end_offset
+
+        def torn_write(fd, data, fsync):
+            '''Write part of data then fail'''
+            os.write(fd, data[:3])
+            raise OSError(errno.ENOSPC, 'No space left on device')
+
+        self.journal._write = torn_write
+        self.journal.append('lost', {})
+        yield self.assertFailure(self.journal.flush(), OSError)
+        del self.journal._write
+        self.assertEqual(os.path.getsize(self.path), good_offset)
+
+        self.journal.append('second', {})
+        yield self.journal.flush()
+        self.assertEqual(
+            [event for _, event, _ in self.journal.read()], ['first', 'second'])
+
+
+class TestOrdering(unittest.TestCase):
+    '''
+    Test events are ordered by ordering_keyword
+    '''
+    def setUp(self):
+        '''setUp test'''
+        self.inst = EventDispatcher(('username', 'role'), ordering_keyword='username')
+        self.inst.start()
+        self.calls = []
+        self.during_deferreds = {}
+
+    def tearDown(self):
+        '''tearDown test'''
+        return self.inst.stop()
+
+    @defer.inlineCallbacks
+    def add_handlers(self):
+        '''
+        Add handlers recording each phase, the during phase waiting on a Deferred per event
+        '''
+        def during_fn(event):
+            '''Record call and wait for this event's Deferred'''
+            self.calls.append(('during', event))
+            during_deferred = self.during_deferreds[event] = defer.Deferred()
+            return during_deferred
+
+        yield self.inst.add_event_handler(
+            lambda event: self.calls.append(('before', event)), 'before', use_weakref=False)
+        yield self.inst.add_event_handler(during_fn, 'during', use_weakref=False)
+        yield self.inst.add_event_handler(
+            lambda event: self.calls.append(('after', event)), 'after', use_weakref=False)
+
+    @defer.inlineCallbacks
+    def test_same_key_serialised(self):
+        '''
+        Test an event waits for the previous event with the same key to complete every phase
+        while events with other keys carry on.
+        '''
+        yield self.add_handlers()
+        fired = [
+            self.inst.fire_event('bob_1', username='bob'),
+            self.inst.fire_event('bob_2', username='bob'),
+            self.inst.fire_event('alice_1', username='alice'),
+        ]
+        self.assertEqual(self.calls, [
+            ('before', 'bob_1'), ('during', 'bob_1'),
+            ('before', 'alice_1'), ('during', 'alice_1')])
+
+        del self.calls[:]
+        self.during_deferreds['bob_1'].callback(None)
+        self.assertEqual(self.calls, [
+            ('after', 'bob_1'), ('before', 'bob_2'), ('during', 'bob_2')])
+
+        self.during_deferreds['bob_2'].callback(None)
+        self.during_deferreds['alice_1'].callback(None)
+        yield defer.gatherResults(fired)
+        self.assertEqual(self.inst.queue_stats()['in_flight'], 0)
+
+    @defer.inlineCallbacks
+    def test_fire_events_ordered(self):
+        '''
+        Test events in a batch are ordered by key and their results collected.
+        '''
+        yield self.add_handlers()
+        fired = self.inst.fire_events([
+            ('bob_1', {'username': 'bob'}),
+            ('alice_1', {'username': 'alice'}),
+            ('bob_2', {'username': 'bob'}),
+        ], collect_results=True)
+        self.assertEqual(sorted(self.during_deferreds), ['alice_1', 'bob_1'])
+
+        self.during_deferreds['bob_1'].callback('bob_1 done')
+        self.during_deferreds['alice_1'].callback('alice_1 done')
+        self.during_deferreds['bob_2'].callback('bob_2 done')
+        results = yield fired
+        self.assertEqual(
+            [event_results[1] for event_results in results],
+            [(True, 'bob_1 done'), (True, 'alice_1 done'), (True, 'bob_2 done')])
+
+    def test_invalid_ordering_keyword(self):
+        '''
+        Test ordering_keyword must be an allowed keyword.
+        '''
+        self.assertRaises(
+            ValueError, EventDispatcher, ('username', 'role'), ordering_keyword='colour')
+
+
+class TestHandlerTimeout(unittest.TestCase):
+    '''
+    Test handler timeouts
+    '''
+    def setUp(self):
+        '''setUp test'''
+        self.clock = task.Clock()
+        self.inst = EventDispatcher(('username', 'role'), reactor=self.clock, handler_timeout=5)
+        self.inst.start()
+
+    def tearDown(self):
+        '''tearDown test'''
+        return self.inst.stop()
+
+    @defer.inlineCallbacks
+    def test_timeout_cancels_handler(self):
+        '''
+        Test a handler whose Deferred doesn't fire in time is cancelled, fails with
+        HandlerTimeout and is counted, while the phase carries on.
+        '''
+        hung_deferred = defer.Deferred()
+        after_fn = mock.Mock(spec='__call__')
+        hung_id = yield self.inst.add_event_handler(
+            mock.Mock(return_value=hung_deferred), 'during', use_weakref=False, timeout=1)
+        yield self.inst.add_event_handler(after_fn, 'after', use_weakref=False)
+
+        fired = self.inst.fire_events([('some_event', {'username': 'bob'})], True)
+        self.clock.advance(1)
+        results = yield fired
+
+        (success, result), after_result = results[0]
+        self.assertFalse(success)
+        result.trap(HandlerTimeout)
+        self.assertTrue(after_result[0])
+        after_fn.assert_called_once_with('some_event')
+        self.assertEqual(self.inst.timeout_stats(), {hung_id: 1})
+
+        yield self.inst.remove_event_handler(hung_id)
+        self.assertEqual(self.inst.timeout_stats(), {})
+
+    @defer.inlineCallbacks
+    def test_default_timeout(self):
+        '''
+        Test handler_timeout applies to handlers without their own timeout and isn't counted
+        against handlers that complete in time.
+        '''
+        slow_deferreds = []
+
+        def slow_fn(event):
+            '''Return a Deferred that fires later'''
+            slow_deferreds.append(defer.Deferred())
+            return slow_deferreds[-1]
+
+        slow_id = yield self.inst.add_event_handler(slow_fn, 'during', use_weakref=False)
+
+        first = self.inst.fire_event('first', username='bob')
+        self.clock.advance(4)
+        slow_deferreds[0].callback(None)
+        yield first
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.inst.timeout_stats(), {})
+
+        second = self.inst.fire_events([('second', {'username': 'bob'})], True)
+        self.clock.advance(5)
+        ((success, result),), = yield second
+        self.assertFalse(success)
+        result.trap(HandlerTimeout)
+        self.assertEqual(self.inst.timeout_stats(), {slow_id: 1})
+
+
+class TestSubscriptions(unittest.TestCase):
+    '''
+    Test pull based subscriptions
+    '''
+    def setUp(self):
+        '''setUp test'''
+        self.inst = EventDispatcher(('username', 'role'))
+        self.inst.start()
+
+    def tearDown(self):
+        '''tearDown test'''
+        return self.inst.stop()
+
+    @defer.inlineCallbacks
+    def test_get_and_drain(self):
+        '''
+        Test matching events can be taken one at a time or in batches, and that a pending get
+        receives the next event.
+        '''
+        subscription = yield self.inst.subscribe('during', role='admin')
+        pending = subscription.get()
+
+        for index in range(5):
+            yield self.inst.fire_event(index, role='admin')
+        yield self.inst.fire_event('ignored', role='user')
+
+        self.assertEqual((yield pending), 0)
+        self.assertEqual((yield subscription.get()), 1)
+        self.assertEqual(subscription.drain(2), [2, 3])
+        self.assertEqual(subscription.drain(), [4])
+        self.assertEqual(subscription.drain(), [])
+        self.assertEqual(subscription.stats()['delivered'], 5)
+
+    @defer.inlineCallbacks
+    def test_drop_policies(self):
+        '''
+        Test a full buffer drops the oldest or newest event and counts it.
+        '''
+        oldest = yield self.inst.subscribe('during', max_size=2)
+        newest = yield self.inst.subscribe('during', max_size=2, overflow_policy='drop_newest')
+
+        for index in range(4):
+            yield self.inst.fire_event(index, role='admin')
+
+        self.assertEqual(oldest.drain(), [2, 3])
+        self.assertEqual(oldest.stats()['dropped_oldest'], 2)
+        self.assertEqual(newest.drain(), [0, 1])
+        self.assertEqual(newest.stats()['dropped_newest'], 2)
+
+    @defer.inlineCallbacks
+    def test_wait_policy(self):
+        '''
+        Test a full buffer with the wait policy holds the event's phase until there's room.
+        '''
+        subscription = yield self.inst.subscribe('during', max_size=1, overflow_policy='wait')
+        after_fn = mock.Mock(spec='__call__')
+        yield self.inst.add_event_handler(after_fn, 'after', use_weakref=False)
+
+        yield self.inst.fire_event('first', role='admin')
+        second = self.inst.fire_event('second', role='admin')
+        self.assertEqual(after_fn.call_count, 1)
+        self.assertEqual(subscription.stats()['waiting'], 1)
+
+        self.assertEqual((yield subscription.get()), 'first')
+        yield second
+        self.assertEqual(after_fn.call_count, 2)
+        self.assertEqual(subscription.drain(), ['second'])
+
+    @defer.inlineCallbacks
+    def test_close(self):
+        '''
+        Test closing removes the registration and fails pending gets.
+        '''
+        subscription = yield self.inst.subscribe('during', username='bob')
+        pending = subscription.get()
+
+        yield subscription.close()
+        yield self.assertFailure(pending, SubscriptionClosed)
+        self.assertEqual(self.inst.memory_stats()['handlers'], 0)
+        yield self.inst.fire_event('some_event', username='bob')
+        yield self.assertFailure(subscription.get(), SubscriptionClosed)
+
+    def test_invalid(self):
+        '''
+        Test max_size and overflow_policy are checked.
+        '''
+        self.assertRaises(ValueError, self.inst.subscribe, 'during', max_size=0)
+        self.assertRaises(ValueError, self.inst.subscribe, 'during', overflow_policy='reject')
+
+    @defer.inlineCallbacks
+    def test_cancelled_get(self):
+        '''
+        Test an event isn't lost to a get() cancelled before it arrived.
+        '''
+        subscription = yield self.inst.subscribe('during')
+        cancelled = subscription.get()
+        cancelled.cancel()
+        self.failureResultOf(cancelled, defer.CancelledError)
+
+        yield self.inst.fire_event('some_event', role='admin')
+        self.assertEqual(subscription.stats()['buffered'], 1)
+        self.assertEqual(self.successResultOf(subscription.get()), 'some_event')